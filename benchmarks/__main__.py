@@ -0,0 +1,90 @@
+################################################################################
+# Copyright (c) 2017-2018, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Run the benchmarks in the current environment without asv.
+
+Usage: python -m benchmarks [-r REPEAT] [PATTERN ...]
+
+This runs every benchmark whose name ('<module>.<class>.<method>') contains
+any of the patterns (or all of them if none are given) and prints the best
+time of `repeat` runs or the figure of merit of tracking benchmarks.
+"""
+
+from __future__ import print_function
+
+import importlib
+import inspect
+import optparse
+import pkgutil
+import os
+import time
+
+
+def benchmarks(patterns):
+    """Generate (name, class, method name) of selected benchmarks."""
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    for _, module_name, _ in pkgutil.iter_modules([package_dir]):
+        if not module_name.startswith('bench_'):
+            continue
+        module = importlib.import_module('benchmarks.' + module_name)
+        classes = inspect.getmembers(module, inspect.isclass)
+        for class_name, cls in sorted(classes):
+            if cls.__module__ != module.__name__:
+                continue
+            for method_name in sorted(dir(cls)):
+                if not method_name.startswith(('time_', 'track_')):
+                    continue
+                name = '.'.join((module_name, class_name, method_name))
+                if not patterns or any(p in name for p in patterns):
+                    yield name, cls, method_name
+
+
+def run(cls, method_name, repeat):
+    """Run a single benchmark and return its result as a string."""
+    benchmark = cls()
+    try:
+        if hasattr(benchmark, 'setup'):
+            benchmark.setup()
+    except NotImplementedError as err:
+        return 'skipped ({})'.format(err)
+    try:
+        method = getattr(benchmark, method_name)
+        if method_name.startswith('track_'):
+            return '{:.4g} {}'.format(method(), getattr(method, 'unit', ''))
+        repeat = getattr(cls, 'repeat', repeat)
+        durations = []
+        for n in range(repeat):
+            start = time.time()
+            method()
+            durations.append(time.time() - start)
+        return '{:.4g} s (best of {})'.format(min(durations), repeat)
+    finally:
+        if hasattr(benchmark, 'teardown'):
+            benchmark.teardown()
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [PATTERN ...]')
+    parser.add_option('-r', '--repeat', type=int, default=3,
+                      help='Number of timing runs unless benchmark overrides '
+                           'it (default %default)')
+    options, patterns = parser.parse_args()
+    for name, cls, method_name in benchmarks(patterns):
+        print('{:<60} {}'.format(name, run(cls, method_name, options.repeat)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+################################################################################
+# Copyright (c) 2017-2018, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""End-to-end benchmarks of a v4 dataset with its chunks served via S3.
+
+The `time_*` methods are timed, while the `track_*` methods report their
+own figure of merit (e.g. throughput in GB/s). These follow the conventions
+of airspeed velocity (asv) but can also be run via ``python -m benchmarks``.
+"""
+
+import imp
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import katdal
+from katdal.chunkstore_stats import collect_stats
+
+from .common import capture_block
+
+
+class OpenDataset(object):
+    """Open the RDB file of a dataset and connect to its chunk store."""
+
+    def setup(self):
+        self.rdb_filename = capture_block().rdb_filename
+
+    def time_open(self):
+        katdal.open(self.rdb_filename)
+
+
+class ReadVis(object):
+    """Read all visibilities of the dataset."""
+    # Each read is slow enough to be timed on its own
+    number = 1
+    repeat = 5
+    # Keyword arguments of :meth:`DataSet.select` applied before reading
+    selection = {}
+
+    def setup(self):
+        self.data = katdal.open(capture_block().rdb_filename)
+        self.data.select(**self.selection)
+        self.store = self.data.source.data.store
+
+    def time_vis(self):
+        self.data.vis[:]
+
+    def _read_stats(self):
+        """Read visibilities and return statistics of chunk store requests."""
+        with collect_stats(self.store) as stats:
+            self.data.vis[:]
+        ops = stats.to_dict()['stores'][type(self.store).__name__]['operations']
+        return sum(op['bytes'] for op in ops.values()), stats.elapsed
+
+    def track_chunk_bytes(self):
+        nbytes, elapsed = self._read_stats()
+        return nbytes / 1e6
+    track_chunk_bytes.unit = 'MB'
+
+    def track_chunk_throughput(self):
+        nbytes, elapsed = self._read_stats()
+        return nbytes / elapsed / 1e9
+    track_chunk_throughput.unit = 'GB/s'
+
+
+class ReadVisNarrowChannels(ReadVis):
+    """Read a few channels of all dumps and correlation products."""
+    selection = {'channels': slice(512, 520)}
+
+
+class ReadVisNarrowBaselines(ReadVis):
+    """Read a single baseline of all dumps and channels."""
+    selection = {'ants': 'm000,m001', 'corrprods': 'cross'}
+
+
+class IterateScans(object):
+    """Step through the scans of the dataset, inspecting their metadata."""
+
+    def setup(self):
+        self.data = katdal.open(capture_block().rdb_filename)
+
+    def time_scans(self):
+        for scan, state, target in self.data.scans():
+            self.data.timestamps[:]
+            self.data.vis.shape
+
+
+class ConvertToMS(object):
+    """Convert the dataset to a MeasurementSet via the mvftoms script."""
+    number = 1
+    repeat = 3
+    timeout = 600
+
+    def setup(self):
+        try:
+            import casacore.tables  # noqa: F401
+            import numba  # noqa: F401
+        except ImportError:
+            # This is how asv skips a benchmark
+            raise NotImplementedError('mvftoms needs python-casacore and numba')
+        script = os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), 'scripts', 'mvftoms.py')
+        self.mvftoms = imp.load_source('mvftoms', script)
+        self.rdb_filename = capture_block().rdb_filename
+        self.vis_bytes = capture_block().vis_bytes
+        self.tempdir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _convert(self):
+        """Run mvftoms on the dataset, replacing any previous output."""
+        ms_name = os.path.join(self.tempdir, 'benchmark.ms')
+        shutil.rmtree(ms_name, ignore_errors=True)
+        argv = sys.argv
+        sys.argv = ['mvftoms.py', '--quack=0', '-o', ms_name,
+                    self.rdb_filename]
+        try:
+            self.mvftoms.main()
+        finally:
+            sys.argv = argv
+
+    def time_mvftoms(self):
+        self._convert()
+
+    def track_mvftoms_throughput(self):
+        start = time.time()
+        self._convert()
+        return self.vis_bytes / (time.time() - start) / 1e9
+    track_mvftoms_throughput.unit = 'GB/s'
@@ -0,0 +1,103 @@
+################################################################################
+# Copyright (c) 2017-2018, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Synthetic capture block served by an in-process S3 stand-in.
+
+The capture block is generated once per process (the first time it is
+requested) by :func:`katdal.synthetic.make_dataset` and consists of an RDB
+file in a temporary directory, with the visibilities, flags and weights held
+in memory by a local S3 server. This keeps the benchmarks reproducible and
+independent of any network.
+"""
+
+import atexit
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from katdal.chunkstore_s3 import S3ChunkStore
+from katdal.synthetic import make_dataset
+from katdal.test.s3_server import S3Server
+
+
+CAPTURE_BLOCK_ID = '1500000000'
+STREAM_NAME = 'sdp_l0'
+# Bucket names may not contain underscores
+BUCKET = CAPTURE_BLOCK_ID + '-' + STREAM_NAME.replace('_', '-')
+# Size of dataset: 16 dual-pol antennas give 544 correlation products,
+# resulting in 136 MiB of visibilities (plus flags and weights, which mostly
+# consist of constant chunks stored as single elements)
+N_DUMPS = 32
+N_CHANS = 1024
+N_ANTS = 16
+# Size of the visibility chunk, similar to what ingest produces
+CHUNK_BYTES = 2 ** 22
+# Each scan consists of a slew followed by a track of this many dumps
+SCAN_DUMPS = 8
+
+
+class CaptureBlock(object):
+    """A synthetic capture block and the S3 server that serves it.
+
+    Attributes
+    ----------
+    server : :class:`katdal.test.s3_server.S3Server` object
+        S3 stand-in holding the chunks
+    store : :class:`katdal.chunkstore_s3.S3ChunkStore` object
+        Chunk store connected to `server`
+    rdb_filename : string
+        RDB file containing the telstate of the capture block (the dataset)
+    vis_bytes : int
+        Number of bytes of visibility data in capture block
+    """
+    def __init__(self, n_dumps=N_DUMPS, n_chans=N_CHANS, n_ants=N_ANTS,
+                 chunk_bytes=CHUNK_BYTES):
+        self.tempdir = tempfile.mkdtemp()
+        self.server = S3Server()
+        self.store = S3ChunkStore.from_url(self.server.url)
+        # Place RDB file in a subdirectory, as in the archive
+        rdb_dir = os.path.join(self.tempdir, CAPTURE_BLOCK_ID)
+        os.mkdir(rdb_dir)
+        self.rdb_filename = os.path.join(
+            rdb_dir, '{}_{}.rdb'.format(CAPTURE_BLOCK_ID, STREAM_NAME))
+        telstate = make_dataset(self.store, self.rdb_filename, n_dumps,
+                                n_chans, n_ants, chunk_bytes,
+                                capture_block_id=CAPTURE_BLOCK_ID,
+                                stream_name=STREAM_NAME, chunk_name=BUCKET,
+                                scan_dumps=SCAN_DUMPS,
+                                s3_endpoint_url=self.server.url)
+        n_corrprods = len(telstate.view(STREAM_NAME)['bls_ordering'])
+        self.vis_bytes = n_dumps * n_chans * n_corrprods * \
+            np.dtype(np.complex64).itemsize
+
+    def close(self):
+        """Stop the S3 server and remove the RDB file."""
+        self.server.close()
+        shutil.rmtree(self.tempdir)
+
+
+_capture_block = None
+
+
+def capture_block():
+    """The synthetic capture block of this process, created on first use."""
+    global _capture_block
+    if _capture_block is None:
+        _capture_block = CaptureBlock()
+        atexit.register(_capture_block.close)
+    return _capture_block
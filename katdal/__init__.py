@@ -330,6 +330,22 @@ def open(filename, ref_ant='', time_offset=0.0, **kwargs):
             partition data set even if real timestamps are irregular, thereby
             avoiding the slow loading of real timestamps at the cost of
             slightly inaccurate label borders
+        cache_dir : string, optional
+            [VisibilityDataV4] Local directory in which to cache chunks that
+            are retrieved from S3, which speeds up subsequent reads
+        cache_size : float, optional
+            [VisibilityDataV4] Upper limit on size of `cache_dir`, in bytes
+            (the least recently used chunks are removed beyond this size)
+        s3_endpoint_url : string, optional
+            [VisibilityDataV4] S3 endpoint(s) to use instead of the one in
+            the metadata (separate several equivalent endpoints by commas)
+        timeout, max_retries, hedge_percentile, ... : optional
+            [VisibilityDataV4] Settings of the S3 chunk store, passed on to
+            :meth:`katdal.chunkstore_s3.S3ChunkStore.from_url`
+        fused : bool, optional
+            [VisibilityDataV4] Load visibilities, flags and weights of each
+            chunk together in one task, which is faster if all of them are
+            needed but wasteful if only e.g. visibilities are accessed
 
     Returns
     -------
@@ -0,0 +1,338 @@
+################################################################################
+# Copyright (c) 2018, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Chunk layouts tailored to the access patterns of a workload.
+
+:func:`~katdal.chunkstore.generate_chunks` picks a chunk shape based on the
+chunk size and the order of dimensions only, while the best shape depends on
+how the data is read. Spectral-line work reads a few channels over long time
+spans, while continuum work reads all channels of each dump. Recording is
+opt-in: the selections made via :class:`~katdal.lazy_indexer.DaskLazyIndexer`
+objects (i.e. `d.vis`, `d.flags` and `d.weights`) are only kept while an
+:class:`AccessRecorder` is active, which is most easily done for a block of
+code via :func:`record_accesses`, e.g.
+
+  with record_accesses() as accesses:
+      d.select(channels=slice(1000, 1010))
+      vis = d.vis[:]
+  chunks = accesses.recommend_chunks(2 ** 22)
+
+The recommended chunks minimise the number of bytes in the chunks touched
+by the recorded selections, compared to other chunks of roughly the same
+size. This can then guide the chunking of the next capture block (or of a
+copy of this one) via :meth:`~katdal.chunkstore.ChunkStore.put_dask_array`.
+"""
+
+import collections
+import contextlib
+import logging
+import threading
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+_recorders = []
+_recorders_lock = threading.Lock()
+
+
+class Access(collections.namedtuple('Access', 'name shape itemsize chunks '
+                                                'starts stops')):
+    """Selection on a chunked array.
+
+    The selected elements along each dimension are described by a sorted
+    series of disjoint runs of indices, from `starts[dim][n]` to
+    `stops[dim][n]` (not inclusive). The overall selection is their outer
+    product.
+
+    Attributes
+    ----------
+    name : string
+        Name of dask array (as in :attr:`DaskLazyIndexer.name`)
+    shape : tuple of int
+        Shape of the full array
+    itemsize : int
+        Number of bytes per array element
+    chunks : tuple of tuple of int
+        Dask chunk specification of the array (i.e. its existing layout)
+    starts, stops : tuple of array of int
+        Start and stop indices of runs of selected elements per dimension
+    """
+    __slots__ = ()
+
+
+def _index_runs(indices):
+    """Start and stop of each run of consecutive values in set of `indices`."""
+    indices = np.unique(indices)
+    if not len(indices):
+        return indices, indices
+    breaks = np.flatnonzero(np.diff(indices) != 1)
+    starts = indices[np.r_[0, breaks + 1]]
+    stops = indices[np.r_[breaks, len(indices) - 1]] + 1
+    return starts, stops
+
+
+def _touched_elements(offsets, starts, stops):
+    """Number of elements in chunks touched by runs of selected indices.
+
+    Parameters
+    ----------
+    offsets : array of int, shape (*C* + 1,)
+        Index of the first element of each chunk along a dimension, followed
+        by the length of the dimension
+    starts, stops : array of int
+        Start and stop indices of sorted, disjoint runs of selected elements
+
+    Returns
+    -------
+    touched : int
+        Total size of chunks containing at least one selected element
+    """
+    if not len(starts):
+        return 0
+    first = np.searchsorted(offsets, starts, side='right') - 1
+    last = np.searchsorted(offsets, stops - 1, side='right') - 1
+    touched = np.sum(offsets[last + 1] - offsets[first])
+    # Neighbouring runs overlap by at most one chunk, which is counted twice
+    shared = last[:-1][last[:-1] == first[1:]]
+    touched -= np.sum(offsets[shared + 1] - offsets[shared])
+    return int(touched)
+
+
+def _regular_chunks(length, size):
+    """Chunks of given `size` along dimension of `length` (the last smaller)."""
+    return (size,) * (length // size) + ((length % size,) if length % size
+                                         else ())
+
+
+class AccessRecorder(object):
+    """Selections made on chunked arrays and the chunk layouts they favour.
+
+    All methods are thread-safe.
+
+    Attributes
+    ----------
+    accesses : list of :class:`Access` objects
+        Recorded selections, in the order in which they were made
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.accesses = []
+
+    def reset(self):
+        """Forget all recorded selections."""
+        with self._lock:
+            self.accesses = []
+
+    def record(self, name, shape, dtype, chunks, indices):
+        """Record a selection on a chunked array.
+
+        Parameters
+        ----------
+        name : string
+            Name of array
+        shape : tuple of int
+            Shape of the full array
+        dtype : :class:`numpy.dtype` object or equivalent
+            Data type of array
+        chunks : tuple of tuple of int
+            Dask chunk specification of array
+        indices : sequence of array of int
+            Selected indices along each dimension of the full array
+        """
+        runs = [_index_runs(np.atleast_1d(index)) for index in indices]
+        starts, stops = zip(*runs) if runs else ((), ())
+        access = Access(name, tuple(shape), np.dtype(dtype).itemsize,
+                        tuple(chunks), starts, stops)
+        with self._lock:
+            self.accesses.append(access)
+
+    def _selected(self, names):
+        """Accesses to the arrays in `names` (or all), which share a shape."""
+        with self._lock:
+            accesses = [access for access in self.accesses
+                        if names is None or access.name in names]
+        if not accesses:
+            raise ValueError('No accesses recorded' +
+                             (' for arrays {}'.format(list(names))
+                              if names is not None else ''))
+        shapes = set(access.shape for access in accesses)
+        if len(shapes) > 1:
+            raise ValueError('Accesses involve arrays of different shapes {} - '
+                             'please select some of them via their names'
+                             .format(sorted(shapes)))
+        return accesses
+
+    def bytes_read(self, chunks=None, names=None):
+        """Total size of chunks touched by the recorded selections.
+
+        Parameters
+        ----------
+        chunks : tuple of tuple of int, optional
+            Dask chunk specification of the layout to evaluate (the default
+            is the existing layout of each array)
+        names : sequence of string, optional
+            Only consider selections on arrays with these names (default all)
+
+        Returns
+        -------
+        nbytes : int
+            Number of bytes in chunks touched by the selections, summed over
+            all selections (divide by number of selections for an average)
+
+        Raises
+        ------
+        ValueError
+            If `chunks` is given while there are no relevant selections, or
+            if they involve arrays of different shapes
+        """
+        if chunks is None:
+            with self._lock:
+                accesses = [access for access in self.accesses
+                            if names is None or access.name in names]
+        else:
+            accesses = self._selected(names)
+        nbytes = 0
+        for access in accesses:
+            layout = access.chunks if chunks is None else chunks
+            touched = access.itemsize
+            for dim_chunks, starts, stops in zip(layout, access.starts,
+                                                 access.stops):
+                offsets = np.cumsum((0,) + tuple(dim_chunks))
+                touched *= _touched_elements(offsets, starts, stops)
+            nbytes += touched
+        return nbytes
+
+    def recommend_chunks(self, max_chunk_size, dtype=np.complex64,
+                         dims_to_split=None, names=None):
+        """Chunk layout that minimises the bytes read by recorded selections.
+
+        The candidate layouts have power-of-two chunk sizes along each
+        dimension (unless the chunk spans the dimension), similar to
+        :func:`~katdal.chunkstore.generate_chunks` with `power_of_two` set.
+        Their chunks are limited to `max_chunk_size` bytes but are also more
+        than half that size if possible, to keep the number of chunks (and
+        therefore the overhead of chunk requests) the same as for chunking
+        based on size only. Ties are broken in favour of bigger chunks and
+        splitting the earlier dimensions first, again like `generate_chunks`.
+
+        Parameters
+        ----------
+        max_chunk_size : float or int
+            Upper limit on chunk size, in bytes
+        dtype : :class:`numpy.dtype` object or equivalent, optional
+            Data type that determines chunk size (the default is that of the
+            visibilities, which also sets the chunks of flags and weights)
+        dims_to_split : sequence of int, optional
+            Indices of dimensions that may be split into chunks (default all)
+        names : sequence of string, optional
+            Only consider selections on arrays with these names (default all)
+
+        Returns
+        -------
+        chunks : tuple of tuple of int
+            Dask chunk specification, indicating chunk sizes along each dimension
+
+        Raises
+        ------
+        ValueError
+            If there are no relevant selections, or they involve arrays of
+            different shapes
+        """
+        accesses = self._selected(names)
+        shape = accesses[0].shape
+        itemsize = np.dtype(dtype).itemsize
+        if np.prod(shape) * itemsize <= max_chunk_size:
+            return tuple((length,) for length in shape)
+        if dims_to_split is None:
+            dims_to_split = range(len(shape))
+        candidates = []
+        for dim, length in enumerate(shape):
+            sizes = [length]
+            if dim in dims_to_split:
+                sizes = [2 ** n for n in range(int(np.log2(length)) + 1)
+                         if 2 ** n < length] + sizes
+            candidates.append(np.array(sizes))
+        # Number of touched elements per dimension, access and candidate size
+        touched = []
+        for dim, (length, sizes) in enumerate(zip(shape, candidates)):
+            offsets = [np.r_[0:length:size, length] for size in sizes]
+            touched.append(np.array([[_touched_elements(
+                                          dim_offsets, access.starts[dim],
+                                          access.stops[dim])
+                                      for dim_offsets in offsets]
+                                     for access in accesses]))
+        cost = np.zeros(tuple(len(sizes) for sizes in candidates))
+        for n, access in enumerate(accesses):
+            access_cost = np.array(float(access.itemsize))
+            for dim_touched in touched:
+                access_cost = np.multiply.outer(access_cost, dim_touched[n])
+            cost += access_cost
+        chunk_size = np.array(float(itemsize))
+        for sizes in candidates:
+            chunk_size = np.multiply.outer(chunk_size, sizes)
+        allowed = chunk_size <= max_chunk_size
+        big_enough = allowed & (chunk_size > max_chunk_size / 2.)
+        if big_enough.any():
+            allowed = big_enough
+        cost[~allowed] = np.inf
+        # Sort on cost, then chunk size, then chunk sizes of the last dims
+        grids = np.meshgrid(*candidates, indexing='ij')
+        keys = [-grid.ravel() for grid in grids]
+        keys += [-chunk_size.ravel(), cost.ravel()]
+        best = np.unravel_index(np.lexsort(keys)[0], cost.shape)
+        chunks = tuple(_regular_chunks(length, sizes[n])
+                       for length, sizes, n in zip(shape, candidates, best))
+        logger.debug('Recommended chunk shape %s reads %g bytes per access',
+                     tuple(sizes[n] for sizes, n in zip(candidates, best)),
+                     cost[best] / len(accesses))
+        return chunks
+
+
+def active_recorders():
+    """Access recorders that are currently active (see :func:`record_accesses`)."""
+    return list(_recorders)
+
+
+@contextlib.contextmanager
+def record_accesses(recorder=None):
+    """Record the selections made on chunked arrays in a block of code.
+
+    This activates an :class:`AccessRecorder` that receives the selections
+    made via all :class:`~katdal.lazy_indexer.DaskLazyIndexer` objects
+    (including those of all datasets) for the duration of the block.
+
+    Parameters
+    ----------
+    recorder : :class:`AccessRecorder` object, optional
+        Existing recorder to add selections to (the default is a new one)
+
+    Yields
+    ------
+    recorder : :class:`AccessRecorder` object
+        Recorder of selections, which stops accumulating when block is done
+    """
+    if recorder is None:
+        recorder = AccessRecorder()
+    with _recorders_lock:
+        _recorders.append(recorder)
+    try:
+        yield recorder
+    finally:
+        with _recorders_lock:
+            _recorders.remove(recorder)
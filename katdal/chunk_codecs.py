@@ -0,0 +1,347 @@
+################################################################################
+# Copyright (c) 2018, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Serialisation of chunks in NPY format, with optional compression codecs.
+
+A plain chunk is stored as a standard NPY file. An encoded chunk is stored as
+
+  <CODEC_MAGIC> <name length (1 byte)> <codec name> <NPY header> <data>
+
+where the NPY header describes the decoded chunk and the data is the C-order
+array data compressed by the codec. Readers detect the codec from the stored
+chunk itself, so only writers need to select a codec (typically per array,
+via the 'codec' entry in its chunk info).
+
+Chunks with all elements equal (e.g. flags of clean data or zero weights) may
+also be stored as a single element via the 'constant' pseudo-codec.
+"""
+
+import io
+import struct
+import zlib
+
+import numpy as np
+
+from .chunkstore import BadChunk, _read_array_into
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# An encoded chunk starts with this instead of the NPY magic string
+CODEC_MAGIC = b'\x93CODEC'
+
+
+class Codec(object):
+    """Lossless compression of chunk data, with optional byte shuffle.
+
+    Parameters
+    ----------
+    name : string
+        Name of codec, as recorded in each encoded chunk
+    compress, decompress : callable
+        Functions that compress and decompress a byte string, respectively
+    shuffle : bool, optional
+        Group the bytes of array items by significance before compression,
+        which greatly improves the compression of slowly varying numbers
+    """
+
+    def __init__(self, name, compress, decompress, shuffle=False):
+        self.name = name
+        self._compress = compress
+        self._decompress = decompress
+        self.shuffle = shuffle
+
+    def __repr__(self):
+        return "<katdal.Codec '{}' at {:#x}>".format(self.name, id(self))
+
+    def encode(self, chunk):
+        """Compress chunk into a byte string (of its data in C order)."""
+        data = np.ascontiguousarray(chunk).reshape(-1).view(np.uint8)
+        itemsize = chunk.dtype.itemsize
+        if self.shuffle and itemsize > 1:
+            data = data.reshape(-1, itemsize).T
+        return self._compress(data.tobytes())
+
+    def decode(self, data, dtype):
+        """Decompress byte string into flat uint8 array of items of `dtype`."""
+        data = np.frombuffer(self._decompress(data), np.uint8)
+        itemsize = np.dtype(dtype).itemsize
+        if self.shuffle and itemsize > 1:
+            data = data.reshape(itemsize, -1).T.reshape(-1)
+        return data
+
+    def decode_into(self, data, out, fortran_order):
+        """Decompress byte string into array `out`."""
+        data = self.decode(data, out.dtype)
+        if data.size != out.nbytes:
+            raise BadChunk('Decoded chunk has {} bytes, expected {} bytes'
+                           .format(data.size, out.nbytes))
+        chunk = data.view(out.dtype)
+        if fortran_order:
+            out[...] = chunk.reshape(out.shape[::-1]).T
+        else:
+            out[...] = chunk.reshape(out.shape)
+
+
+class _ConstantCodec(Codec):
+    """Pseudo-codec that represents a constant chunk by a single element."""
+
+    def __init__(self):
+        super(_ConstantCodec, self).__init__('constant', None, None)
+
+    def encode(self, chunk):
+        """Store the first element of chunk, after checking that it is constant."""
+        if not is_constant(chunk):
+            raise ValueError('Only chunks with all elements equal can be '
+                             'encoded by the constant codec')
+        return np.ascontiguousarray(chunk).reshape(-1)[:1].tobytes()
+
+    def decode(self, data, dtype):
+        """Return the single element of chunk as a flat uint8 array."""
+        return np.frombuffer(data, np.uint8)
+
+    def decode_into(self, data, out, fortran_order):
+        """Fill `out` with the single element of chunk."""
+        value = np.frombuffer(data, out.dtype)
+        if out.size and value.size != 1:
+            raise BadChunk('Constant chunk has {} elements instead of 1'
+                           .format(value.size))
+        out[...] = value[:1]
+
+
+def is_constant(chunk):
+    """True if all elements of `chunk` are equal (and there is at least one)."""
+    chunk = np.asarray(chunk)
+    return chunk.size > 0 and bool(np.all(chunk == chunk.flat[0]))
+
+
+def _zlib_compress(data):
+    """Compress with zlib, preferring speed over compression ratio."""
+    return zlib.compress(data, 1)
+
+
+def _zstd_compress(data):
+    """Compress with Zstandard (compressor objects are not thread-safe)."""
+    return zstandard.ZstdCompressor().compress(data)
+
+
+def _zstd_decompress(data):
+    """Decompress with Zstandard (decompressor objects are not thread-safe)."""
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+_compressors = [('zlib', _zlib_compress, zlib.decompress)]
+if lz4 is not None:
+    _compressors.append(('lz4', lz4.frame.compress, lz4.frame.decompress))
+if zstandard is not None:
+    _compressors.append(('zstd', _zstd_compress, _zstd_decompress))
+
+# All available codecs, each with and without byte shuffle
+CODECS = {'constant': _ConstantCodec()}
+for _name, _compress, _decompress in _compressors:
+    CODECS[_name] = Codec(_name, _compress, _decompress)
+    CODECS['shuffle+' + _name] = Codec('shuffle+' + _name, _compress,
+                                       _decompress, shuffle=True)
+
+
+def get_codec(name):
+    """Look up codec by name.
+
+    Raises
+    ------
+    ValueError
+        If codec is unknown or not available (e.g. missing optional package)
+    """
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError('Unknown or unavailable codec {!r} (available: {})'
+                         .format(name, ', '.join(sorted(CODECS))))
+
+
+def write_chunk(fp, chunk, codec=None, elide_constant=False):
+    """Write `chunk` to file-like `fp` in NPY format, optionally compressed.
+
+    Parameters
+    ----------
+    fp : file-like object
+        Binary file-like object with a `write` method
+    chunk : :class:`numpy.ndarray` object
+        Chunk to write
+    codec : string, optional
+        Name of codec used to compress the chunk (no compression by default)
+    elide_constant : bool, optional
+        Write only a single element if all elements of the chunk are equal
+        (using the 'constant' codec instead of `codec`)
+
+    Raises
+    ------
+    ValueError
+        If codec is unknown or not available
+    """
+    if elide_constant and chunk.size > 1 and is_constant(chunk):
+        codec = 'constant'
+    if codec is None:
+        np.lib.format.write_array(fp, chunk, allow_pickle=False)
+        return
+    codec = get_codec(codec)
+    fp.write(_encoded_header(chunk, codec))
+    fp.write(codec.encode(chunk))
+
+
+def _encoded_header(chunk, codec):
+    """Header of `chunk` encoded by `codec` (magic, codec name, NPY header)."""
+    fp = io.BytesIO()
+    name = codec.name.encode('ascii')
+    fp.write(CODEC_MAGIC + struct.pack('B', len(name)) + name)
+    header = {'descr': np.lib.format.dtype_to_descr(chunk.dtype),
+              'fortran_order': False, 'shape': chunk.shape}
+    np.lib.format.write_array_header_1_0(fp, header)
+    return fp.getvalue()
+
+
+def chunk_buffers(chunk, codec=None, elide_constant=False):
+    """Serialise `chunk` like :func:`write_chunk` but into a list of buffers.
+
+    The buffers concatenate to the bytes that :func:`write_chunk` would write.
+    If the chunk is not encoded and is contiguous, its array data is not
+    copied at all: the last buffer is then a view of the chunk's memory, so
+    the chunk should not be modified while the buffers are in use.
+
+    Parameters
+    ----------
+    chunk : :class:`numpy.ndarray` object
+        Chunk to serialise
+    codec : string, optional
+        Name of codec used to compress the chunk (no compression by default)
+    elide_constant : bool, optional
+        Serialise only a single element if all elements of the chunk are equal
+        (using the 'constant' codec instead of `codec`)
+
+    Returns
+    -------
+    buffers : list of bytes or :class:`memoryview` objects
+        Header followed by (possibly encoded) array data
+
+    Raises
+    ------
+    ValueError
+        If codec is unknown or not available, or if the chunk contains objects
+    """
+    if elide_constant and chunk.size > 1 and is_constant(chunk):
+        codec = 'constant'
+    if codec is not None:
+        codec = get_codec(codec)
+        return [_encoded_header(chunk, codec), codec.encode(chunk)]
+    if chunk.dtype.hasobject:
+        raise ValueError('Chunks with Python objects cannot be serialised')
+    # Mimic np.lib.format.write_array, which picks the memory order like this
+    header = np.lib.format.header_data_from_array_1_0(chunk)
+    fp = io.BytesIO()
+    np.lib.format.write_array_header_1_0(fp, header)
+    data = chunk.T if header['fortran_order'] else np.ascontiguousarray(chunk)
+    return [fp.getvalue(), memoryview(data.reshape(-1).view(np.uint8))]
+
+
+def read_chunk_header(fp):
+    """Read header of chunk from file-like `fp`.
+
+    This leaves `fp` positioned at the start of the (possibly encoded) array
+    data, ready for :func:`read_chunk_into`.
+
+    Returns
+    -------
+    shape : tuple of int
+        Shape of chunk
+    fortran_order : bool
+        True if array data is stored in Fortran order
+    dtype : :class:`numpy.dtype` object
+        Data type of chunk
+    codec : :class:`Codec` object or None
+        Codec that compressed the array data (None if not compressed)
+
+    Raises
+    ------
+    ValueError
+        If the header is not a valid NPY header
+    :exc:`chunkstore.BadChunk`
+        If chunk has an unknown or unavailable codec
+    """
+    prefix = fp.read(len(CODEC_MAGIC))
+    codec = None
+    if prefix == CODEC_MAGIC:
+        name_length = bytearray(fp.read(1))
+        name = fp.read(name_length[0] if name_length else 0).decode('ascii')
+        try:
+            codec = get_codec(name)
+        except ValueError as err:
+            raise BadChunk('Chunk was compressed by a codec that is not '
+                           'available here: {}'.format(err))
+        prefix = fp.read(len(np.lib.format.MAGIC_PREFIX))
+    if prefix != np.lib.format.MAGIC_PREFIX:
+        raise ValueError('The magic string is not correct; expected {!r}, got '
+                         '{!r}'.format(np.lib.format.MAGIC_PREFIX, prefix))
+    version = tuple(bytearray(fp.read(2)))
+    if version == (1, 0):
+        header = np.lib.format.read_array_header_1_0(fp)
+    elif version == (2, 0):
+        header = np.lib.format.read_array_header_2_0(fp)
+    else:
+        raise ValueError('Unsupported NPY format version {}'.format(version))
+    return header + (codec,)
+
+
+def read_chunk_into(fp, out, fortran_order, dtype, codec=None):
+    """Read (possibly encoded) array data from file-like `fp` into `out`.
+
+    Unencoded data is read straight into the memory of `out`, while encoded
+    data is first read in full and then decoded into `out`.
+
+    Raises
+    ------
+    :exc:`chunkstore.BadChunk`
+        If the data has the wrong size or could not be decoded
+    """
+    dtype = np.dtype(dtype)
+    if codec is None:
+        _read_array_into(fp, out, fortran_order, dtype)
+        return
+    dest = out if out.dtype == dtype else np.empty(out.shape, dtype)
+    try:
+        codec.decode_into(fp.read(), dest, fortran_order)
+    except BadChunk:
+        raise
+    except Exception as err:
+        raise BadChunk('Could not decode chunk with codec {!r}: {}'
+                       .format(codec.name, err))
+    if dest is not out:
+        out[...] = dest
+
+
+def chunk_from_bytes(data):
+    """Turn bytes of a serialised chunk (encoded or not) into an array."""
+    fp = io.BytesIO(data)
+    shape, fortran_order, dtype, codec = read_chunk_header(fp)
+    chunk = np.empty(shape, dtype)
+    read_chunk_into(fp, chunk, fortran_order, dtype, codec)
+    return chunk
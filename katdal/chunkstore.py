@@ -20,7 +20,12 @@ from __future__ import division
 
 import contextlib
 import functools
+import itertools
+import multiprocessing.pool
+import threading
+import time
 import uuid
+import zlib
 
 import numpy as np
 import dask
@@ -129,6 +134,383 @@ def _scalar_to_chunk(func):
     return func_returning_chunk
 
 
+def _map_concurrently(func, items, max_workers, threads=None):
+    """Apply `func` to each of `items` using up to `max_workers` threads.
+
+    This returns a list of results in the same order as `items` and
+    falls back to a simple loop if only a single thread is needed. The
+    threads come from the pool returned by `threads` if given (which should
+    have `max_workers` threads and is only called if needed), otherwise a
+    temporary pool is started for the occasion.
+    """
+    items = list(items)
+    num_workers = min(max_workers, len(items))
+    if num_workers <= 1:
+        return [func(item) for item in items]
+    if threads is not None:
+        return threads().map(func, items, chunksize=1)
+    # XXX Revisit with concurrent.futures when Python 3 only
+    pool = multiprocessing.pool.ThreadPool(num_workers)
+    try:
+        return pool.map(func, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _get_chunk_batch(get_chunks, array_name, slices_list, dtype):
+    """Retrieve neighbouring chunks in one go and assemble them into a block.
+
+    The chunks identified by `slices_list` should tile a rectangular block
+    of the parent array and be listed in C order (i.e. first chunk at the
+    origin of the block and last chunk in the opposite corner).
+    """
+    chunks = get_chunks(array_name, slices_list, dtype)
+    if len(chunks) == 1:
+        return chunks[0]
+    origin = [s.start for s in slices_list[0]]
+    shape = [s.stop - i for (s, i) in zip(slices_list[-1], origin)]
+    block = np.empty(shape, dtype)
+    for slices, chunk in zip(slices_list, chunks):
+        block[tuple(slice(s.start - i, s.stop - i)
+                    for (s, i) in zip(slices, origin))] = chunk
+    return block
+
+
+def _batch_slices(chunks, offset, batch):
+    """Slices of store chunks in each batch of neighbouring chunks, per dimension.
+
+    Returns a list with an entry per dimension, which is a list of batches
+    along that dimension, each in turn a list of the slices of its chunks.
+    """
+    offset = tuple(offset) + (0,) * (len(chunks) - len(offset))
+    slices_per_dim = []
+    for dim_chunks, dim_batch, dim_offset in zip(chunks, batch, offset):
+        start = dim_offset
+        dim_slices = []
+        for size in dim_chunks:
+            dim_slices.append(slice(start, start + size))
+            start += size
+        slices_per_dim.append([dim_slices[n:n + dim_batch] for n in
+                               range(0, len(dim_slices), dim_batch)])
+    return slices_per_dim
+
+
+def _put_chunk_batch(put_chunks, array_name, slices_list, chunks):
+    """Put a batch of chunks into the store, returning success of each."""
+    return put_chunks(array_name, slices_list, chunks)
+
+
+def _batch_success(success, n, ndim):
+    """Success of the n'th chunk of a batch, as a singleton chunk."""
+    return np.full(ndim * (1,), success[n])
+
+
+def _c_contiguous_parts(array):
+    """Split `array` into C-contiguous pieces (where possible), in C order."""
+    if array.flags.c_contiguous or array.ndim <= 1:
+        return [array]
+    return [part for subarray in array for part in _c_contiguous_parts(subarray)]
+
+
+def _read_array_into(fp, out, fortran_order, dtype):
+    """Read raw array data of given `dtype` from file-like `fp` into `out`.
+
+    The data is read straight into the memory of `out` via the `readinto`
+    method of `fp` for each contiguous piece of `out` (which could be a view
+    of a bigger array), avoiding a temporary copy of the whole array. A small
+    intermediate buffer is only used for non-contiguous pieces or if the
+    dtype of `out` differs from `dtype`.
+    """
+    dest = out.T if fortran_order else out
+    for part in _c_contiguous_parts(dest):
+        if part.flags.c_contiguous and part.dtype == dtype:
+            buf = part
+        else:
+            buf = np.empty(part.shape, dtype)
+        view = memoryview(buf.reshape(-1).view(np.uint8))
+        while len(view):
+            bytes_read = fp.readinto(view)
+            if not bytes_read:
+                raise BadChunk('Array data ended prematurely')
+            view = view[bytes_read:]
+        if buf is not part:
+            part[...] = buf
+
+
+def _normalise_region(shape, subregion):
+    """Turn `subregion` of chunk with `shape` into slices with explicit bounds.
+
+    Raises
+    ------
+    :exc:`chunkstore.BadChunk`
+        If `subregion` is not a tuple of unit-stride slices within the chunk
+    """
+    subregion = tuple(subregion)
+    if len(subregion) > len(shape) or \
+       not all(isinstance(s, slice) for s in subregion):
+        raise BadChunk('Chunk subregion {} is not a sequence of slices for '
+                       'chunk with shape {}'.format(subregion, shape))
+    subregion += (slice(None),) * (len(shape) - len(subregion))
+    region = []
+    for s, length in zip(subregion, shape):
+        start, stop, step = s.indices(length)
+        if step != 1:
+            raise BadChunk('Chunk subregion {} does not have unit strides'
+                           .format(subregion))
+        region.append(slice(start, max(start, stop)))
+    return tuple(region)
+
+
+def _region_byte_ranges(shape, itemsize, region, max_gap=0):
+    """Byte ranges of C-order array data that contain a region of the array.
+
+    Each byte range covers a contiguous run of the array data, which spans
+    the trailing axes that are selected in full as well as the last axis that
+    is not. Runs separated by no more than `max_gap` bytes are merged.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of array
+    itemsize : int
+        Size of each array element, in bytes
+    region : tuple of slice
+        Region of array, as normalised by :func:`_normalise_region`
+    max_gap : int, optional
+        Merge runs with at most this many unselected bytes in between
+
+    Returns
+    -------
+    ranges : list of (int, int) tuples
+        Start and stop offset of each byte range, in increasing order
+    """
+    if any(s.stop == s.start for s in region):
+        return []
+    if not shape:
+        return [(0, itemsize)]
+    strides = itemsize * np.cumprod((1,) + shape[:0:-1])[::-1]
+    # Find the last axis that is not selected in full
+    axis = len(shape) - 1
+    while axis > 0 and region[axis] == slice(0, shape[axis]):
+        axis -= 1
+    run = (region[axis].stop - region[axis].start) * int(strides[axis])
+    offsets = np.array([region[axis].start * strides[axis]])
+    for n in reversed(range(axis)):
+        indices = np.arange(region[n].start, region[n].stop)
+        offsets = (indices[:, np.newaxis] * strides[n] + offsets).ravel()
+    gaps = offsets[1:] - offsets[:-1] - run
+    breaks = np.flatnonzero(gaps > max_gap)
+    starts = np.r_[offsets[0], offsets[breaks + 1]]
+    stops = np.r_[offsets[breaks], offsets[-1]] + run
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+def _plan_region(shape, dtype, region, max_gap, max_ranges,
+                 max_fraction=0.5):
+    """Byte ranges to read for a region of a chunk, or None to read it all.
+
+    A partial read only pays off if it needs at most `max_ranges` requests
+    and skips a substantial part of the chunk (at least `1 - max_fraction`).
+    """
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    ranges = _region_byte_ranges(shape, dtype.itemsize, region, max_gap)
+    if len(ranges) > max_ranges or \
+       sum(stop - start for start, stop in ranges) > max_fraction * nbytes:
+        return None
+    return ranges
+
+
+def _read_region(read_into, shape, dtype, region, ranges):
+    """Assemble region of chunk from byte ranges of its C-order data.
+
+    The byte ranges are read via ``read_into(offset, view)``, which should
+    fill the writable buffer `view` with the data starting at `offset` in
+    the chunk. Only the pages of the chunk-sized buffer that are actually
+    written to take up memory. The total size of the byte ranges is reported
+    as the bytes transferred by the instrumented call in progress.
+    """
+    buf = np.empty(int(np.prod(shape)) * dtype.itemsize, np.uint8)
+    for start, stop in ranges:
+        read_into(start, memoryview(buf[start:stop]))
+    _report_transferred_bytes(sum(stop - start for start, stop in ranges))
+    return buf.view(dtype).reshape(shape)[region].copy()
+
+
+def _chunk_id_prefixes(chunk_ids, num_prefixes):
+    """Prefixes of chunk IDs that split them into a given number of groups.
+
+    This considers prefixes of the first index in each chunk ID (i.e. the
+    dump index for visibility data) and picks the shortest prefix length that
+    results in at least `num_prefixes` distinct prefixes, or else the full
+    first index. Every chunk ID in `chunk_ids` starts with one of the prefixes.
+    """
+    first_indices = set(chunk_id.split('_', 1)[0] for chunk_id in chunk_ids)
+    max_length = max([len(index) for index in first_indices] + [0])
+    prefixes = sorted(first_indices)
+    for length in range(1, max_length + 1):
+        prefixes = sorted(set(index[:length] for index in first_indices))
+        if len(prefixes) >= num_prefixes:
+            break
+    return prefixes
+
+
+def _manifest_slices(chunks, offset=()):
+    """Chunk ID of manifest of array with given `chunks` and `offset`.
+
+    The manifest has one element per chunk of the array and is identified by
+    the array offset, which allows arrays that are stored piecemeal (at
+    different offsets) to have a manifest per piece.
+    """
+    offset = offset if offset else len(chunks) * (0,)
+    return tuple(slice(i, i + len(c)) for (i, c) in zip(offset, chunks))
+
+
+def _manifest_entry(chunk, success):
+    """Manifest entry of `chunk`, given `success` array from its put_chunk."""
+    present = success.item() is None
+    crc32 = zlib.crc32(np.ascontiguousarray(chunk)) & 0xffffffff
+    return (present, chunk.nbytes, crc32)
+
+
+def _put_manifest(put_chunk, array_name, slices, entries):
+    """Assemble manifest from its `entries` and put it in the store."""
+    shape = tuple(s.stop - s.start for s in slices)
+    manifest = np.array(entries, dtype=ChunkStore.MANIFEST_DTYPE).reshape(shape)
+    return put_chunk(array_name, slices, manifest)
+
+
+def _put_success(success, manifest_success):
+    """Success of chunk put, which fails too if the manifest put failed."""
+    if success.item() is None and manifest_success is not None:
+        return np.full(success.shape, manifest_success)
+    return success
+
+
+# Instrumented calls in progress in each thread, from outermost to innermost
+_instrumented_calls = threading.local()
+
+
+class _InstrumentedCall(object):
+    """Chunk store method call in progress and the bytes it has transferred."""
+
+    def __init__(self, store, op):
+        self.store = store
+        self.op = op
+        self.nbytes = None
+
+
+def _transferred_bytes(op, args, kwargs, result):
+    """Number of bytes of chunk data moved by call of chunk store method."""
+    if op == 'get':
+        # The chunk is either returned or written into the `out` argument
+        chunk = result if result is not None else kwargs.get('out', args[-1])
+    elif op == 'put':
+        chunk = args[2] if len(args) > 2 else kwargs.get('chunk')
+    else:
+        return 0
+    return getattr(chunk, 'nbytes', 0)
+
+
+def _report_transferred_bytes(nbytes):
+    """Report bytes of chunk data moved by innermost instrumented call.
+
+    This is needed if the call moves a different amount of data than what it
+    returns or receives, e.g. a :meth:`ChunkStore.get_chunk_region` that
+    reads the byte ranges containing a region (instead of just the region).
+    Multiple reports by the same call add up. It does nothing if there is no
+    instrumented call in progress in the current thread.
+    """
+    calls = getattr(_instrumented_calls, 'calls', None)
+    if calls:
+        call = calls[-1]
+        call.nbytes = (call.nbytes or 0) + nbytes
+
+
+def _instrumented(op):
+    """Decorator that reports calls of a chunk store method to its `stats`.
+
+    If the store has a :attr:`ChunkStore.stats` object, the duration, number
+    of bytes transferred and error (if any) of each call is recorded as an
+    operation of type `op`. The number of bytes is that of the chunk data
+    returned or received, unless the call reports the actual amount via
+    :func:`_report_transferred_bytes`. Calls made by another instrumented
+    method of the same store in the same thread (e.g. a
+    :meth:`ChunkStore.get_chunk_into` that calls :meth:`ChunkStore.get_chunk`)
+    are not recorded again, but their bytes count towards the outer call if
+    it is of the same type (as in a :meth:`ChunkStore.get_chunk_region` that
+    retrieves the full chunk instead).
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def instrumented_method(self, *args, **kwargs):
+            if self.stats is None:
+                return method(self, *args, **kwargs)
+            calls = _instrumented_calls.__dict__.setdefault('calls', [])
+            outer = [c for c in calls if c.store is self]
+            call = _InstrumentedCall(self, op)
+            calls.append(call)
+            start = time.time()
+            try:
+                result = method(self, *args, **kwargs)
+            except Exception as err:
+                if not outer:
+                    self._record(op, time.time() - start, error=err)
+                raise
+            finally:
+                calls.pop()
+            nbytes = call.nbytes
+            if nbytes is None:
+                nbytes = _transferred_bytes(op, args, kwargs, result)
+            if not outer:
+                self._record(op, time.time() - start, nbytes)
+            elif outer[-1].op == op:
+                outer[-1].nbytes = (outer[-1].nbytes or 0) + nbytes
+            return result
+        return instrumented_method
+    return decorator
+
+
+class _ChunkGetter(object):
+    """Dask getter that retrieves chunks from a store (or zeros if missing).
+
+    This is called as ``getter(array_name, slices)`` by the dask graph, while
+    :meth:`get_into` allows the chunk to be written straight into an existing
+    array instead (as used by :class:`~katdal.lazy_indexer.DaskLazyIndexer`).
+    """
+
+    def __init__(self, store, dtype, offset=()):
+        self.store = store
+        self.dtype = np.dtype(dtype)
+        self.offset = offset
+
+    def _offset_slices(self, slices):
+        if not self.offset:
+            return slices
+        return tuple(slice(s.start + i, s.stop + i)
+                     for (s, i) in zip(slices, self.offset))
+
+    def __call__(self, array_name, slices):
+        return self.store.get_chunk_or_zeros(
+            array_name, self._offset_slices(slices), self.dtype)
+
+    def get_into(self, array_name, slices, out):
+        """Get chunk from the store and write it into `out` (zeros if missing)."""
+        try:
+            self.store.get_chunk_into(
+                array_name, self._offset_slices(slices), self.dtype, out)
+        except ChunkNotFound:
+            out[...] = 0
+
+    def get_region_into(self, array_name, slices, subregion, out):
+        """Get part of chunk from the store and write it into `out`."""
+        try:
+            out[...] = self.store.get_chunk_region(
+                array_name, self._offset_slices(slices), self.dtype, subregion)
+        except ChunkNotFound:
+            out[...] = 0
+
+
 class ChunkStore(object):
     """Base class for accessing a store of chunks (i.e. N-dimensional arrays).
 
@@ -158,17 +540,42 @@ class ChunkStore(object):
 
       VALID_BUCKET = re.compile(r'^[a-zA-Z0-9.\-_]{1,255}$')
 
+    Chunk stores can report the latency and throughput of their operations
+    (see :mod:`katdal.chunkstore_stats`) if a statistics object is assigned
+    to their :attr:`stats` attribute.
+
+    Stores start threads on demand (e.g. to service batched requests), which
+    they keep for reuse until :meth:`close` is called. Close stores that are
+    no longer needed if a process creates many of them.
+
     Parameters
     ----------
     error_map : dict mapping :class:`Exception` to :class:`Exception`, optional
         Dict that maps store-specific errors to standard ChunkStore errors
     """
 
+    # Statistics of store operations (None disables instrumentation)
+    stats = None
+
     def __init__(self, error_map=None):
         if error_map is None:
             error_map = {OSError: StoreUnavailable, KeyError: ChunkNotFound,
                          ValueError: BadChunk}
         self._error_map = error_map
+        self._thread_pool = None
+        self._thread_pool_lock = threading.Lock()
+
+    def _record(self, op, duration, nbytes=0, error=None):
+        """Report an operation to :attr:`stats` (if instrumentation is on)."""
+        stats = self.stats
+        if stats is not None:
+            stats.record(type(self).__name__, op, duration, nbytes, error)
+
+    def _count(self, event, n=1):
+        """Report `n` events to :attr:`stats` (if instrumentation is on)."""
+        stats = self.stats
+        if stats is not None:
+            stats.increment(type(self).__name__, event, n)
 
     def get_chunk(self, array_name, slices, dtype):
         """Get chunk from the store.
@@ -207,7 +614,177 @@ class ChunkStore(object):
             chunk_name, shape = self.chunk_metadata(array_name, slices)
             return np.zeros(shape, dtype)
 
-    def put_chunk(self, array_name, slices, chunk):
+    @_instrumented('get')
+    def get_chunk_into(self, array_name, slices, dtype, out):
+        """Get chunk from the store and write it into an existing array.
+
+        This is useful to assemble chunks into a bigger array (with `out` a
+        view of the relevant part of it). Stores that are able to decode their
+        chunks straight into `out` avoid a temporary copy of each chunk, while
+        the base implementation merely copies the result of :meth:`get_chunk`.
+        The contents of `out` are undefined if an exception is raised.
+
+        Parameters
+        ----------
+        array_name : string
+            Identifier of parent array `x` of chunk
+        slices : sequence of unit-stride slice objects
+            Identifier of individual chunk, to be extracted as `x[slices]`
+        dtype : :class:`numpy.dtype` object or equivalent
+            Data type of array `x`
+        out : :class:`numpy.ndarray` object
+            Output array with shape dictated by `slices` (and preferably with
+            dtype `dtype`, although it will be cast otherwise)
+
+        Raises
+        ------
+        :exc:`chunkstore.BadChunk`
+            If requested `dtype` does not match underlying parent array dtype,
+            `slices` has wrong specification, `out` has the wrong shape or
+            stored buffer has wrong size
+        :exc:`chunkstore.StoreUnavailable`
+            If interaction with chunk store failed (offline, bad auth, bad config)
+        :exc:`chunkstore.ChunkNotFound`
+            If requested chunk was not found in store
+        """
+        self.chunk_metadata(array_name, slices, chunk=out, dtype=dtype)
+        out[...] = self.get_chunk(array_name, slices, dtype)
+
+    @_instrumented('get')
+    def get_chunk_region(self, array_name, slices, dtype, subregion):
+        """Get part of a chunk from the store.
+
+        This is useful if only a small part of a big chunk is needed. Stores
+        that are able to read parts of stored chunks (such as uncompressed
+        chunks in C order) only retrieve the byte ranges of the chunk that
+        contain the region, if that saves enough I/O. The base implementation
+        retrieves the whole chunk via :meth:`get_chunk` and extracts the
+        region from it.
+
+        Parameters
+        ----------
+        array_name : string
+            Identifier of parent array `x` of chunk
+        slices : sequence of unit-stride slice objects
+            Identifier of individual chunk, to be extracted as `x[slices]`
+        dtype : :class:`numpy.dtype` object or equivalent
+            Data type of array `x`
+        subregion : sequence of unit-stride slice objects
+            Part of chunk to extract, relative to the start of the chunk
+
+        Returns
+        -------
+        region : :class:`numpy.ndarray` object
+            Part of chunk with dtype `dtype` and shape dictated by `subregion`
+
+        Raises
+        ------
+        :exc:`chunkstore.BadChunk`
+            If requested `dtype` does not match underlying parent array dtype,
+            `slices` or `subregion` has wrong specification or stored buffer
+            has wrong size
+        :exc:`chunkstore.StoreUnavailable`
+            If interaction with chunk store failed (offline, bad auth, bad config)
+        :exc:`chunkstore.ChunkNotFound`
+            If requested chunk was not found in store
+        """
+        chunk_name, shape = self.chunk_metadata(array_name, slices, dtype=dtype)
+        region = _normalise_region(shape, subregion)
+        return self.get_chunk(array_name, slices, dtype)[region]
+
+    # Maximum number of chunks that get_chunks() retrieves simultaneously
+    max_concurrency = 1
+
+    def _threads(self):
+        """Pool of :attr:`max_concurrency` threads (created on demand).
+
+        The pool is shared by all batched requests, which avoids starting
+        and stopping threads for every batch (e.g. every dask task). Tasks
+        running on the pool should not use it in turn, lest they deadlock.
+        """
+        with self._thread_pool_lock:
+            if self._thread_pool is None:
+                # XXX Revisit with concurrent.futures when Python 3 only
+                self._thread_pool = multiprocessing.pool.ThreadPool(
+                    self.max_concurrency)
+            return self._thread_pool
+
+    def close(self):
+        """Stop the threads of the store (requests in progress may fail).
+
+        The store remains usable and starts new threads when they are needed.
+        """
+        with self._thread_pool_lock:
+            pool, self._thread_pool = self._thread_pool, None
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    def get_chunks_noraise(self, array_name, slices_list, dtype):
+        """Get multiple chunks from the store but return errors as well.
+
+        This retrieves up to :attr:`max_concurrency` chunks at a time, which
+        decouples I/O concurrency from the number of threads calling it. Any
+        :exc:`ChunkStoreError` exceptions are returned in the place of the
+        corresponding chunks instead of being raised. The base implementation
+        calls :meth:`get_chunk` from a pool of threads that is shared by all
+        calls, while stores with native asynchronous I/O can do better.
+
+        Parameters
+        ----------
+        array_name : string
+            Identifier of parent array `x` of chunks
+        slices_list : sequence of sequences of unit-stride slice objects
+            Identifiers of individual chunks, to be extracted as `x[slices]`
+        dtype : :class:`numpy.dtype` object or equivalent
+            Data type of array `x`
+
+        Returns
+        -------
+        chunks : list of :class:`numpy.ndarray` or :exc:`ChunkStoreError` objects
+            Chunks (or errors) in the same order as `slices_list`
+        """
+        def get(slices):
+            """Get a chunk from the store but return errors as well."""
+            try:
+                return self.get_chunk(array_name, slices, dtype)
+            except ChunkStoreError as err:
+                return err
+        return _map_concurrently(get, slices_list, self.max_concurrency,
+                                 self._threads)
+
+    def get_chunks(self, array_name, slices_list, dtype):
+        """Get multiple chunks from the store.
+
+        The chunks are retrieved concurrently as explained in the docstring of
+        :meth:`get_chunks_noraise` and the first error encountered is raised.
+        See :meth:`get_chunk` for the parameters and exceptions.
+
+        Returns
+        -------
+        chunks : list of :class:`numpy.ndarray` objects
+            Chunks in the same order as `slices_list`
+        """
+        chunks = self.get_chunks_noraise(array_name, slices_list, dtype)
+        for chunk in chunks:
+            if isinstance(chunk, ChunkStoreError):
+                raise chunk
+        return chunks
+
+    def get_chunks_or_zeros(self, array_name, slices_list, dtype):
+        """Get multiple chunks from the store but replace missing ones by zeros."""
+        chunks = self.get_chunks_noraise(array_name, slices_list, dtype)
+        for n, chunk in enumerate(chunks):
+            if isinstance(chunk, ChunkNotFound):
+                chunk_name, shape = self.chunk_metadata(array_name,
+                                                        slices_list[n])
+                chunks[n] = np.zeros(shape, dtype)
+            elif isinstance(chunk, ChunkStoreError):
+                raise chunk
+        return chunks
+
+    def put_chunk(self, array_name, slices, chunk, codec=None,
+                  elide_constant=False):
         """Put chunk into the store.
 
         Parameters
@@ -218,6 +795,15 @@ class ChunkStore(object):
             Identifier of individual chunk, to be extracted as `x[slices]`
         chunk : :class:`numpy.ndarray` object
             Chunk as ndarray with shape commensurate with `slices`
+        codec : string, optional
+            Name of codec that compresses the chunk in the store (see
+            :mod:`katdal.chunk_codecs`). The codec is recorded with the
+            chunk so that :meth:`get_chunk` decodes it transparently. Stores
+            that do not serialise chunks ignore this.
+        elide_constant : bool, optional
+            If all elements of the chunk are equal, only store a single
+            element, which :meth:`get_chunk` expands to the full chunk
+            again. This saves a lot of space for e.g. clean flags.
 
         Raises
         ------
@@ -227,18 +813,55 @@ class ChunkStore(object):
             If interaction with chunk store failed (offline, bad auth, bad config)
         :exc:`chunkstore.ChunkNotFound`
             If `array_name` is incompatible with store
+        ValueError
+            If `codec` is unknown or not available
         """
         raise NotImplementedError
 
-    def put_chunk_noraise(self, array_name, slices, chunk):
-        """Put chunk into store but return any exceptions instead of raising."""
+    def put_chunks_noraise(self, array_name, slices_list, chunks, **kwargs):
+        """Put multiple chunks into the store but return errors instead of raising.
+
+        This stores up to :attr:`max_concurrency` chunks at a time, just like
+        :meth:`get_chunks_noraise` retrieves them. The base implementation
+        calls :meth:`put_chunk` from a pool of threads, while stores with
+        native asynchronous I/O can do better. Extra keyword arguments are
+        passed on to :meth:`put_chunk`.
+
+        Parameters
+        ----------
+        array_name : string
+            Identifier of parent array `x` of chunks
+        slices_list : sequence of sequences of unit-stride slice objects
+            Identifiers of individual chunks, to be extracted as `x[slices]`
+        chunks : sequence of :class:`numpy.ndarray` objects
+            Chunk data in the same order as `slices_list`
+
+        Returns
+        -------
+        success : list of None or :exc:`ChunkStoreError` objects
+            None for each chunk that was stored successfully, otherwise the
+            error encountered, in the same order as `slices_list`
+        """
+        def put(item):
+            """Put a chunk into the store but return errors as well."""
+            slices, chunk = item
+            return self.put_chunk_noraise(array_name, slices, chunk, **kwargs)
+        return _map_concurrently(put, zip(slices_list, chunks),
+                                 self.max_concurrency, self._threads)
+
+    def put_chunk_noraise(self, array_name, slices, chunk, **kwargs):
+        """Put chunk into store but return any exceptions instead of raising.
+
+        Extra keyword arguments are passed on to :meth:`put_chunk`.
+        """
         try:
-            self.put_chunk(array_name, slices, chunk)
+            self.put_chunk(array_name, slices, chunk, **kwargs)
         except ChunkStoreError as err:
             return err
         else:
             return None
 
+    @_instrumented('has')
     def has_chunk(self, array_name, slices, dtype):
         """Check if chunk is in the store.
 
@@ -273,6 +896,9 @@ class ChunkStore(object):
     NAME_SEP = '/'
     # Width sufficient to store any dump / channel / corrprod index for MeerKAT
     NAME_INDEX_WIDTH = 5
+    # Each array manifest entry describes the corresponding chunk of the array
+    MANIFEST_DTYPE = np.dtype([('present', np.bool_), ('nbytes', '<i8'),
+                               ('crc32', '<u4')])
 
     @classmethod
     def join(cls, *names):
@@ -372,7 +998,7 @@ class ChunkStore(object):
             prefix = 'Chunk {!r}: '.format(chunk_name) if chunk_name else ''
             raise StandardisedError(prefix + str(e))
 
-    def get_dask_array(self, array_name, chunks, dtype, offset=()):
+    def get_dask_array(self, array_name, chunks, dtype, offset=(), batch=()):
         """Get dask array from the store.
 
         Any missing chunks are replaced with zeros, suppressing any
@@ -388,20 +1014,41 @@ class ChunkStore(object):
             Data type of array
         offset : tuple of int, optional
             Offset to add to each dimension when addressing chunks in store
+        batch : tuple of int, optional
+            Number of neighbouring chunks in the store to combine into a single
+            dask chunk along each dimension (the default is one store chunk per
+            dask chunk). Each batch of chunks is then retrieved by a single
+            task via :meth:`get_chunks_or_zeros`, which results in a smaller
+            dask graph and leaves the I/O concurrency up to the store.
 
         Returns
         -------
         array : :class:`dask.array.Array` object
             Dask array of given dtype
         """
-        getter = functools.partial(self.get_chunk_or_zeros, dtype=dtype)
-        if offset:
-            getter = _add_offset_to_slices(getter, offset)
-        # Use dask utility function that forms the core of da.from_array
-        dask_graph = da.core.getem(array_name, chunks, getter)
-        return da.Array(dask_graph, array_name, chunks, dtype)
-
-    def put_dask_array(self, array_name, array, offset=()):
+        batch = tuple(batch) + (1,) * (len(chunks) - len(batch))
+        if all(b == 1 for b in batch):
+            getter = _ChunkGetter(self, dtype, offset)
+            # Use dask utility function that forms the core of da.from_array
+            dask_graph = da.core.getem(array_name, chunks, getter)
+            return da.Array(dask_graph, array_name, chunks, dtype)
+        out_name = '{}-batch-{}'.format(array_name, '_'.join(map(str, batch)))
+        slices_per_dim = _batch_slices(chunks, offset, batch)
+        out_chunks = tuple(tuple(s[-1].stop - s[0].start for s in dim_slices)
+                           for dim_slices in slices_per_dim)
+        dask_graph = {}
+        for index in itertools.product(*[range(len(dim_slices))
+                                         for dim_slices in slices_per_dim]):
+            batch_slices = [dim_slices[n] for (dim_slices, n)
+                            in zip(slices_per_dim, index)]
+            slices_list = list(itertools.product(*batch_slices))
+            dask_graph[(out_name,) + index] = (
+                _get_chunk_batch, self.get_chunks_or_zeros,
+                array_name, slices_list, np.dtype(dtype))
+        return da.Array(dask_graph, out_name, out_chunks, dtype)
+
+    def put_dask_array(self, array_name, array, offset=(), manifest=False,
+                       codec=None, elide_constant=False, batch=()):
         """Put dask array into the store.
 
         Parameters
@@ -412,6 +1059,21 @@ class ChunkStore(object):
             Dask input array
         offset : tuple of int, optional
             Offset to add to each dimension when addressing chunks in store
+        manifest : bool, optional
+            Also put a manifest of the array in the store once all its chunks
+            are stored, which records the presence, size and checksum of each
+            chunk (see :meth:`get_manifest`)
+        codec : string, optional
+            Name of codec that compresses each chunk in the store (no
+            compression by default, see :meth:`put_chunk`)
+        elide_constant : bool, optional
+            Store chunks with all elements equal as a single element (see
+            :meth:`put_chunk`)
+        batch : tuple of int, optional
+            Number of neighbouring chunks to put into the store by a single
+            task along each dimension (the default is one task per chunk).
+            Each batch is stored via :meth:`put_chunks_noraise`, which leaves
+            the I/O concurrency up to the store.
 
         Returns
         -------
@@ -426,25 +1088,140 @@ class ChunkStore(object):
         out_name = array_name
         # Make out_name unique to avoid clashes and caches
         out_name = 'store-{}-{}-{}'.format(out_name, offset, uuid.uuid4().hex)
-        put = _scalar_to_chunk(self.put_chunk_noraise)
-        if offset:
-            put = _add_offset_to_slices(put, offset)
-        # Construct output graph on same chunks as input, but with new name
-        graph = da.core.getem(array_name, array.chunks, put, out_name=out_name)
-        # Set chunk parameter of put_chunk() to corresponding key in input array
-        graph = {k: v + ((in_name,) + k[1:],) for k, v in graph.items()}
+        # Only pass on non-default options to put_chunk()
+        put_kwargs = {}
+        if codec is not None:
+            put_kwargs['codec'] = codec
+        if elide_constant:
+            put_kwargs['elide_constant'] = elide_constant
+        batch = tuple(batch) + (1,) * (array.ndim - len(batch))
+        if all(b == 1 for b in batch):
+            put = functools.partial(self.put_chunk_noraise, **put_kwargs)
+            put = _scalar_to_chunk(put)
+            if offset:
+                put = _add_offset_to_slices(put, offset)
+            # Construct output graph on same chunks as input, but with new name
+            graph = da.core.getem(array_name, array.chunks, put,
+                                  out_name=out_name)
+            # Set chunk parameter of put_chunk() to corresponding key in input
+            graph = {k: v + ((in_name,) + k[1:],) for k, v in graph.items()}
+        else:
+            put_chunks = functools.partial(self.put_chunks_noraise,
+                                           **put_kwargs)
+            graph = self._batch_put_tasks(put_chunks, array_name, array.chunks,
+                                          offset, batch, in_name, out_name)
+        if manifest:
+            graph = self._add_manifest_tasks(graph, array_name, array.chunks,
+                                             offset, in_name, out_name)
         dask_graph.update(graph)
         # The success array has one element per chunk in the input array
         out_chunks = tuple(len(c) * (1,) for c in array.chunks)
         return da.Array(dask_graph, out_name, out_chunks, np.object)
 
-    def list_chunk_ids(self, array_name):
+    def _batch_put_tasks(self, put_chunks, array_name, chunks, offset, batch,
+                         in_name, out_name):
+        """Graph that puts batches of chunks, with a success task per chunk."""
+        batch_name = 'batch-' + out_name
+        slices_per_dim = _batch_slices(chunks, offset, batch)
+        graph = {}
+        for batch_index in itertools.product(*[range(len(dim_slices))
+                                               for dim_slices in slices_per_dim]):
+            # Chunk indices and slices of all chunks in the batch, in C order
+            ranges = [range(n * b, n * b + len(dim_slices[n]))
+                      for (n, b, dim_slices)
+                      in zip(batch_index, batch, slices_per_dim)]
+            indices = list(itertools.product(*ranges))
+            slices_list = list(itertools.product(
+                *[dim_slices[n] for (n, dim_slices)
+                  in zip(batch_index, slices_per_dim)]))
+            batch_key = (batch_name,) + batch_index
+            graph[batch_key] = (_put_chunk_batch, put_chunks, array_name,
+                                slices_list,
+                                [(in_name,) + index for index in indices])
+            for n, index in enumerate(indices):
+                graph[(out_name,) + index] = (_batch_success, batch_key, n,
+                                              len(chunks))
+        return graph
+
+    def _add_manifest_tasks(self, graph, array_name, chunks, offset, in_name,
+                            out_name):
+        """Extend graph of put_chunk tasks to also put the array manifest."""
+        put_name = 'put-' + out_name
+        entry_name = 'manifest-entry-' + out_name
+        manifest_key = 'manifest-' + out_name
+        new_graph = {}
+        for key, task in graph.items():
+            if key[0] != out_name:
+                # Leave other tasks (like puts of batches) as they are
+                new_graph[key] = task
+                continue
+            index = key[1:]
+            new_graph[(put_name,) + index] = task
+            new_graph[(entry_name,) + index] = (_manifest_entry,
+                                                (in_name,) + index,
+                                                (put_name,) + index)
+            new_graph[key] = (_put_success, (put_name,) + index, manifest_key)
+        # Manifest entries are listed in C order to match the chunk grid
+        indices = itertools.product(*[range(len(c)) for c in chunks])
+        entry_keys = [(entry_name,) + index for index in indices]
+        new_graph[manifest_key] = (_put_manifest, self.put_chunk_noraise,
+                                   self.join(array_name, 'manifest'),
+                                   _manifest_slices(chunks, offset),
+                                   entry_keys)
+        return new_graph
+
+    def get_manifest(self, array_name, chunks, offset=()):
+        """Get manifest of array from the store.
+
+        The manifest is stored as a separate chunk next to the chunks of the
+        array by :meth:`put_dask_array` and has the structured dtype
+        :attr:`MANIFEST_DTYPE`. It is much cheaper to retrieve than checking
+        the presence of each chunk individually or listing the store.
+
+        Parameters
+        ----------
+        array_name : string
+            Identifier of array in chunk store
+        chunks : tuple of tuples of ints
+            Chunk specification
+        offset : tuple of int, optional
+            Offset to add to each dimension when addressing chunks in store
+
+        Returns
+        -------
+        manifest : :class:`numpy.ndarray` object
+            Structured array with one element per chunk, containing fields
+            'present' (chunk was successfully stored), 'nbytes' (size of chunk
+            in bytes) and 'crc32' (CRC-32 checksum of chunk data)
+
+        Raises
+        ------
+        :exc:`chunkstore.ChunkNotFound`
+            If the array has no manifest matching `chunks` and `offset`
+        :exc:`chunkstore.StoreUnavailable`
+            If interaction with chunk store failed (offline, bad auth, bad config)
+        """
+        manifest_name = self.join(array_name, 'manifest')
+        slices = _manifest_slices(chunks, offset)
+        try:
+            return self.get_chunk(manifest_name, slices, self.MANIFEST_DTYPE)
+        except BadChunk as err:
+            # The array was written with a different chunking scheme
+            raise ChunkNotFound('Manifest of array {!r} does not match chunks:'
+                                ' {}'.format(array_name, err))
+
+    def list_chunk_ids(self, array_name, prefixes=None):
         """List all chunk ID strings associated with given array in chunk store.
 
         Parameters
         ----------
         array_name : string
             Identifier of array in chunk store
+        prefixes : sequence of string, optional
+            Only list chunk IDs that start with one of these (non-overlapping)
+            prefixes, e.g. '00012' for all chunks of the 13th row of the
+            array (the default is to list all chunk IDs). Stores may use this
+            to partition a large listing into concurrent smaller ones.
 
         Returns
         -------
@@ -462,6 +1239,8 @@ class ChunkStore(object):
         """Check if array is in the store.
 
         This is an optional optimised version of :meth:`has_dask_array`.
+        It uses the array manifest if available and otherwise compares
+        the expected chunks to those returned by :meth:`list_chunk_ids`.
 
         Parameters
         ----------
@@ -482,9 +1261,11 @@ class ChunkStore(object):
         NotImplementedError
             If the underlying store does not have an efficient implementation
         """
-        # Obtain ID strings of all chunks in store associated with array_name
-        # This might not be implemented by underlying store
-        store_ids = set(self.list_chunk_ids(array_name))
+        # Prefer the manifest, which is a single small object
+        try:
+            return self.get_manifest(array_name, chunks, offset)['present']
+        except ChunkNotFound:
+            pass
         # Turn chunks + offset into list of expected chunk ID strings
         slices = da.core.slices_from_chunks(chunks)
         if offset:
@@ -492,6 +1273,10 @@ class ChunkStore(object):
                             for (ss, i) in zip(s, offset))
                       for s in slices]
         chunk_ids = [self.chunk_id_str(s) for s in slices]
+        # Obtain ID strings of all chunks in store associated with array_name
+        # This might not be implemented by underlying store
+        prefixes = _chunk_id_prefixes(chunk_ids, self.max_concurrency)
+        store_ids = set(self.list_chunk_ids(array_name, prefixes))
         # Look up expected IDs in set of actual IDs in store
         success = np.array([cid in store_ids for cid in chunk_ids])
         return success.reshape(tuple(len(c) for c in chunks))
@@ -0,0 +1,682 @@
+################################################################################
+# Copyright (c) 2018, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Chunk stores that cache the chunks of another (slower) chunk store."""
+
+import collections
+import threading
+import multiprocessing.pool
+import logging
+import atexit
+import weakref
+import os
+
+import numpy as np
+
+from .chunkstore import (ChunkStore, ChunkStoreError, ChunkNotFound, BadChunk,
+                         _instrumented)
+from .chunkstore_npy import NpyFileChunkStore
+
+
+logger = logging.getLogger(__name__)
+
+
+class _ReadThroughChunkStore(ChunkStore):
+    """Base class for chunk stores that cache the chunks of another store.
+
+    Subclasses manage the actual cache by implementing :meth:`_get_cached`,
+    :meth:`_is_cached`, :meth:`_insert` and :meth:`_discard`, while this
+    class routes the requests and keeps the statistics.
+
+    Parameters
+    ----------
+    store : :class:`ChunkStore` object
+        Underlying chunk store that provides the chunks
+    """
+
+    def __init__(self, store):
+        super(_ReadThroughChunkStore, self).__init__()
+        self.store = store
+        self.hits = self.misses = self.evictions = 0
+        self._lock = threading.Lock()
+
+    def close(self):
+        """Stop the threads of this store and the underlying store."""
+        self.store.close()
+        super(_ReadThroughChunkStore, self).close()
+
+    def _get_cached(self, chunk_name, array_name, slices, dtype):
+        """Get chunk from the cache, or None if it is not there."""
+        raise NotImplementedError
+
+    def _is_cached(self, chunk_name):
+        """True if the chunk is in the cache."""
+        raise NotImplementedError
+
+    def _insert(self, chunk_name, array_name, slices, chunk):
+        """Add chunk to the cache, evicting others if the cache is full.
+
+        This returns the chunk to pass on to the caller, which may be a
+        (read-only) view of `chunk` if the cache shares it between callers.
+        """
+        raise NotImplementedError
+
+    def _discard(self, chunk_name):
+        """Remove chunk from the cache if it is there."""
+        raise NotImplementedError
+
+    def _lookup(self, chunk_name, array_name, slices, dtype):
+        """Get chunk from the cache (or None if not there) and update stats."""
+        chunk = self._get_cached(chunk_name, array_name, slices, dtype)
+        shape = tuple(s.stop - s.start for s in slices)
+        if chunk is not None and (chunk.shape != shape or chunk.dtype != dtype):
+            # The same chunk name may describe different shapes (e.g. manifest)
+            chunk = None
+        with self._lock:
+            if chunk is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        self._count('cache_misses' if chunk is None else 'cache_hits')
+        return chunk
+
+    @_instrumented('get')
+    def get_chunk(self, array_name, slices, dtype):
+        """See the docstring of :meth:`ChunkStore.get_chunk`."""
+        chunk_name, _ = self.chunk_metadata(array_name, slices, dtype=dtype)
+        chunk = self._lookup(chunk_name, array_name, slices, dtype)
+        if chunk is None:
+            chunk = self.store.get_chunk(array_name, slices, dtype)
+            chunk = self._insert(chunk_name, array_name, slices, chunk)
+        return chunk
+
+    def get_chunks_noraise(self, array_name, slices_list, dtype):
+        """See the docstring of :meth:`ChunkStore.get_chunks_noraise`.
+
+        The chunks that are not in the cache are retrieved from the underlying
+        store in a single batch.
+        """
+        chunk_names = []
+        chunks = []
+        for slices in slices_list:
+            try:
+                chunk_name, _ = self.chunk_metadata(array_name, slices,
+                                                    dtype=dtype)
+            except BadChunk as err:
+                chunk_names.append(None)
+                chunks.append(err)
+            else:
+                chunk_names.append(chunk_name)
+                chunks.append(self._lookup(chunk_name, array_name,
+                                           slices, dtype))
+        missing = [n for n, chunk in enumerate(chunks) if chunk is None]
+        fetched = self.store.get_chunks_noraise(
+            array_name, [slices_list[n] for n in missing], dtype)
+        for n, chunk in zip(missing, fetched):
+            if not isinstance(chunk, ChunkStoreError):
+                chunk = self._insert(chunk_names[n], array_name,
+                                     slices_list[n], chunk)
+            chunks[n] = chunk
+        return chunks
+
+    @_instrumented('put')
+    def put_chunk(self, array_name, slices, chunk, **kwargs):
+        """See the docstring of :meth:`ChunkStore.put_chunk`."""
+        chunk_name, _ = self.chunk_metadata(array_name, slices, chunk=chunk)
+        self._discard(chunk_name)
+        self.store.put_chunk(array_name, slices, chunk, **kwargs)
+
+    @_instrumented('has')
+    def has_chunk(self, array_name, slices, dtype):
+        """See the docstring of :meth:`ChunkStore.has_chunk`."""
+        chunk_name, _ = self.chunk_metadata(array_name, slices, dtype=dtype)
+        return (self._is_cached(chunk_name) or
+                self.store.has_chunk(array_name, slices, dtype))
+
+    @_instrumented('list')
+    def list_chunk_ids(self, array_name, prefixes=None):
+        """See the docstring of :meth:`ChunkStore.list_chunk_ids`."""
+        return self.store.list_chunk_ids(array_name, prefixes)
+
+    get_chunk.__doc__ = ChunkStore.get_chunk.__doc__
+    put_chunk.__doc__ = ChunkStore.put_chunk.__doc__
+    has_chunk.__doc__ = ChunkStore.has_chunk.__doc__
+    list_chunk_ids.__doc__ = ChunkStore.list_chunk_ids.__doc__
+
+
+class CachingChunkStore(_ReadThroughChunkStore):
+    """A chunk store that keeps recently used chunks of another store in memory.
+
+    This wraps an existing chunk store and keeps the chunks retrieved from it
+    in a least-recently-used (LRU) cache, which is bounded by the total size
+    of the cached chunks in bytes. Chunks are keyed by their full chunk name
+    (see :meth:`ChunkStore.chunk_metadata`). Any chunks put into the store are
+    passed on to the underlying store and evicted from the cache.
+
+    The cached chunks are shared between callers and are therefore returned as
+    read-only views, while the arrays of the underlying store are left alone.
+    Missing chunks are not cached.
+
+    Parameters
+    ----------
+    store : :class:`ChunkStore` object
+        Underlying chunk store that provides the chunks
+    max_bytes : int or float, optional
+        Upper limit on total size of chunks in cache, in bytes
+
+    Attributes
+    ----------
+    hits : int
+        Number of chunk requests that were served from the cache
+    misses : int
+        Number of chunk requests that were passed on to the underlying store
+    evictions : int
+        Number of chunks discarded from the cache to make room for others
+    """
+
+    def __init__(self, store, max_bytes=2 ** 30):
+        super(CachingChunkStore, self).__init__(store)
+        self.max_bytes = max_bytes
+        self._cache = collections.OrderedDict()
+        self._nbytes = 0
+
+    @property
+    def nbytes(self):
+        """Total size of chunks currently in the cache, in bytes."""
+        return self._nbytes
+
+    def __len__(self):
+        """Number of chunks currently in the cache."""
+        return len(self._cache)
+
+    def clear(self):
+        """Discard all cached chunks (but keep the statistics)."""
+        with self._lock:
+            self._cache.clear()
+            self._nbytes = 0
+
+    def _get_cached(self, chunk_name, array_name, slices, dtype):
+        with self._lock:
+            chunk = self._cache.get(chunk_name)
+            if chunk is None or chunk.dtype != dtype:
+                return None
+            # Move chunk to the most recently used end of the queue
+            del self._cache[chunk_name]
+            self._cache[chunk_name] = chunk
+            return chunk
+
+    def _is_cached(self, chunk_name):
+        with self._lock:
+            return chunk_name in self._cache
+
+    def _insert(self, chunk_name, array_name, slices, chunk):
+        if chunk.nbytes > self.max_bytes:
+            return chunk
+        # Leave the array of the underlying store alone (it may be its data)
+        chunk = chunk.view()
+        chunk.flags.writeable = False
+        with self._lock:
+            old_chunk = self._cache.pop(chunk_name, None)
+            if old_chunk is not None:
+                self._nbytes -= old_chunk.nbytes
+            while self._cache and self._nbytes + chunk.nbytes > self.max_bytes:
+                _, evicted_chunk = self._cache.popitem(last=False)
+                self._nbytes -= evicted_chunk.nbytes
+                self.evictions += 1
+                self._count('cache_evictions')
+            self._cache[chunk_name] = chunk
+            self._nbytes += chunk.nbytes
+        return chunk
+
+    def _discard(self, chunk_name):
+        with self._lock:
+            chunk = self._cache.pop(chunk_name, None)
+            if chunk is not None:
+                self._nbytes -= chunk.nbytes
+
+
+class DiskCachingChunkStore(_ReadThroughChunkStore):
+    """A chunk store that keeps chunks of another store in a local directory.
+
+    This wraps an existing (typically remote) chunk store such as
+    :class:`~katdal.chunkstore_s3.S3ChunkStore` and acts as a read-through
+    cache: chunks retrieved from the underlying store are written to a local
+    directory as NPY files, using the same layout as :class:`NpyFileChunkStore`,
+    and later requests for the same chunks are served from there. The cache
+    persists between sessions and may be shared by consecutive processes.
+
+    If the total size of the cached files exceeds `max_bytes`, the least
+    recently used files are deleted. The usage order is tracked via the access
+    and modification times of the files, which are updated on every cache hit
+    (so it does not depend on the file system recording access times).
+
+    Parameters
+    ----------
+    store : :class:`ChunkStore` object
+        Underlying chunk store that provides the chunks
+    path : string
+        Local directory that contains the cached NPY files (created if needed)
+    max_bytes : int or float or None, optional
+        Upper limit on total size of cached files, in bytes (None = no limit)
+
+    Attributes
+    ----------
+    hits : int
+        Number of chunk requests that were served from the local directory
+    misses : int
+        Number of chunk requests that were passed on to the underlying store
+    evictions : int
+        Number of files deleted from the local directory to make room for others
+
+    Raises
+    ------
+    :exc:`chunkstore.StoreUnavailable`
+        If `path` could not be created or is not a directory
+    """
+
+    def __init__(self, store, path, max_bytes=None):
+        super(DiskCachingChunkStore, self).__init__(store)
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Let NpyFileChunkStore figure out if path is usable
+            pass
+        self.cache = NpyFileChunkStore(path)
+        self.max_bytes = max_bytes
+        self._files = collections.OrderedDict()
+        self._nbytes = 0
+        self._scan()
+
+    def _filename(self, chunk_name):
+        return os.path.join(self.cache.path, chunk_name) + '.npy'
+
+    def _scan(self):
+        """Find existing cached files, ordered from least to most recent use."""
+        found = []
+        for dirpath, _, filenames in os.walk(self.cache.path):
+            for filename in filenames:
+                if not filename.endswith('.npy') or \
+                   filename.endswith('.writing.npy'):
+                    continue
+                full_filename = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(full_filename)
+                except OSError:
+                    continue
+                chunk_name = os.path.relpath(full_filename, self.cache.path)
+                chunk_name = chunk_name[:-4].replace(os.sep, self.NAME_SEP)
+                found.append((stat.st_atime, chunk_name, stat.st_size))
+        with self._lock:
+            for _, chunk_name, size in sorted(found):
+                self._files[chunk_name] = size
+                self._nbytes += size
+            self._evict()
+
+    @property
+    def nbytes(self):
+        """Total size of files currently in the cache, in bytes."""
+        return self._nbytes
+
+    def __len__(self):
+        """Number of chunks currently in the cache."""
+        return len(self._files)
+
+    def _evict(self):
+        """Delete least recently used files until cache is small enough."""
+        while (self._files and self.max_bytes is not None and
+               self._nbytes > self.max_bytes):
+            chunk_name, size = self._files.popitem(last=False)
+            self._nbytes -= size
+            self.evictions += 1
+            self._count('cache_evictions')
+            try:
+                os.remove(self._filename(chunk_name))
+            except OSError:
+                pass
+
+    def _get_cached(self, chunk_name, array_name, slices, dtype):
+        with self._lock:
+            if chunk_name not in self._files:
+                return None
+            # Move chunk to the most recently used end of the queue
+            self._files[chunk_name] = self._files.pop(chunk_name)
+        try:
+            chunk = self.cache.get_chunk(array_name, slices, dtype)
+        except ChunkStoreError:
+            # Another process removed or is rewriting the file, or the file
+            # is stale (e.g. a manifest that describes another shape)
+            self._discard(chunk_name)
+            return None
+        try:
+            os.utime(self._filename(chunk_name), None)
+        except OSError:
+            pass
+        return chunk
+
+    def _is_cached(self, chunk_name):
+        with self._lock:
+            return chunk_name in self._files
+
+    def _insert(self, chunk_name, array_name, slices, chunk):
+        try:
+            self.cache.put_chunk(array_name, slices, chunk)
+            size = os.path.getsize(self._filename(chunk_name))
+        except (ChunkStoreError, OSError) as err:
+            logger.warning('Could not cache chunk %r: %s', chunk_name, err)
+            return chunk
+        with self._lock:
+            old_size = self._files.pop(chunk_name, None)
+            if old_size is not None:
+                self._nbytes -= old_size
+            self._files[chunk_name] = size
+            self._nbytes += size
+            self._evict()
+        return chunk
+
+    def _discard(self, chunk_name):
+        with self._lock:
+            size = self._files.pop(chunk_name, None)
+            if size is not None:
+                self._nbytes -= size
+                try:
+                    os.remove(self._filename(chunk_name))
+                except OSError:
+                    pass
+
+
+class TieredChunkStore(ChunkStore):
+    """A hierarchy of chunk stores, ordered from fastest to slowest.
+
+    Chunks are retrieved from the fastest tier that has them and then copied
+    to all faster tiers (*promoted*) so that the next request for them is
+    served faster. The slowest (last) tier is the backing store, which is
+    expected to have all chunks. A typical hierarchy is a local directory on
+    fast disk (:class:`~katdal.chunkstore_npy.NpyFileChunkStore`) in front of
+    an archive (:class:`~katdal.chunkstore_s3.S3ChunkStore`), possibly with a
+    :class:`~katdal.chunkstore_dict.DictChunkStore` of preloaded arrays in
+    front (which ignores promotions of chunks of other arrays). Errors in the
+    faster tiers are treated as misses, while errors in the backing store are
+    passed on to the caller (unless the chunk is missing from the backing
+    store but bad in a faster tier, in which case the latter is reported).
+
+    Chunks put into the store are written to all tiers, from slowest to
+    fastest, before returning. Alternatively a *staging* tier accepts the
+    writes, which are copied to the slower tiers in the background by a
+    pool of threads (*write-back*). This hides the latency of the backing
+    store from the writer. Call :meth:`flush` to wait for the copies, or
+    :meth:`close` to also stop the threads. Copies that are still pending
+    when the interpreter exits are completed before it does.
+
+    Parameters
+    ----------
+    tiers : sequence of :class:`ChunkStore` objects
+        Chunk stores in order from fastest to slowest
+    promote : bool, optional
+        True if chunks found in slower tiers are copied to faster tiers
+    staging_tier : int or None, optional
+        Index of tier that accepts writes for write-back (None disables it)
+    flush_threads : int, optional
+        Number of threads that copy staged chunks to slower tiers
+
+    Attributes
+    ----------
+    hits : list of int
+        Number of chunk requests served by each tier
+    """
+
+    def __init__(self, tiers, promote=True, staging_tier=None,
+                 flush_threads=4):
+        super(TieredChunkStore, self).__init__()
+        if not tiers:
+            raise ValueError('Tiered chunk store needs at least one tier')
+        self.tiers = list(tiers)
+        self.promote = promote
+        if staging_tier is not None and staging_tier >= len(self.tiers) - 1:
+            raise ValueError('Staging tier {} should be faster than the '
+                             'backing store'.format(staging_tier))
+        self.staging_tier = staging_tier
+        self.flush_threads = flush_threads
+        self.hits = len(self.tiers) * [0]
+        self._lock = threading.Lock()
+        self._flushed = threading.Condition(self._lock)
+        self._flush_pool = None
+        self._pending = collections.Counter()
+        self._flush_errors = []
+
+    @property
+    def max_concurrency(self):
+        """Concurrency of the backing store (typically the bottleneck)."""
+        return self.tiers[-1].max_concurrency
+
+    def _hit(self, n, array_name, slices, chunk):
+        """Record that tier `n` served the chunk and promote it if needed."""
+        with self._lock:
+            self.hits[n] += 1
+        # Anything served by the backing store is a miss of the faster tiers
+        last = len(self.tiers) - 1
+        self._count('cache_hits' if n < last else 'cache_misses')
+        if self.promote:
+            for tier in self.tiers[:n]:
+                tier.put_chunk_noraise(array_name, slices, chunk)
+
+    def _get_from_tiers(self, method, array_name, slices, dtype, *args):
+        """Call `method` of each tier in turn until it succeeds.
+
+        Returns the index of the successful tier and the result of its call.
+        A bad chunk in a faster tier is reported instead of a missing chunk
+        in the backing store (e.g. if the chunk has not been copied there).
+        """
+        bad = None
+        last = len(self.tiers) - 1
+        for n, tier in enumerate(self.tiers):
+            try:
+                return n, getattr(tier, method)(array_name, slices, dtype, *args)
+            except ChunkNotFound:
+                if n == last:
+                    if bad is not None:
+                        raise bad
+                    raise
+            except BadChunk as err:
+                if n == last:
+                    raise
+                bad = bad or err
+            except ChunkStoreError:
+                if n == last:
+                    raise
+
+    @_instrumented('get')
+    def get_chunk(self, array_name, slices, dtype):
+        """See the docstring of :meth:`ChunkStore.get_chunk`."""
+        n, chunk = self._get_from_tiers('get_chunk', array_name, slices, dtype)
+        self._hit(n, array_name, slices, chunk)
+        return chunk
+
+    @_instrumented('get')
+    def get_chunk_into(self, array_name, slices, dtype, out):
+        """See the docstring of :meth:`ChunkStore.get_chunk_into`."""
+        n, _ = self._get_from_tiers('get_chunk_into', array_name, slices,
+                                    dtype, out)
+        # The caller's `out` may have another dtype or be a strided view
+        self._hit(n, array_name, slices,
+                  np.ascontiguousarray(out, dtype=dtype))
+
+    def get_chunks_noraise(self, array_name, slices_list, dtype):
+        """See the docstring of :meth:`ChunkStore.get_chunks_noraise`.
+
+        The chunks missing from each tier are retrieved from the next tier
+        in a single batch.
+        """
+        chunks = len(slices_list) * [None]
+        missing = range(len(slices_list))
+        bad = {}
+        for n, tier in enumerate(self.tiers):
+            fetched = tier.get_chunks_noraise(
+                array_name, [slices_list[i] for i in missing], dtype)
+            still_missing = []
+            last_tier = (n == len(self.tiers) - 1)
+            for i, chunk in zip(missing, fetched):
+                if not isinstance(chunk, ChunkStoreError):
+                    self._hit(n, array_name, slices_list[i], chunk)
+                elif not last_tier:
+                    if isinstance(chunk, BadChunk):
+                        bad.setdefault(i, chunk)
+                    still_missing.append(i)
+                    continue
+                elif isinstance(chunk, ChunkNotFound):
+                    chunk = bad.get(i, chunk)
+                chunks[i] = chunk
+            missing = still_missing
+            if not missing:
+                break
+        return chunks
+
+    def _flush_threads(self):
+        """Pool of threads that copy staged chunks (created on demand)."""
+        with self._lock:
+            if self._flush_pool is None:
+                self._flush_pool = multiprocessing.pool.ThreadPool(
+                    self.flush_threads)
+                atexit.register(_close_at_exit, weakref.ref(self))
+            return self._flush_pool
+
+    def _write_back(self, array_name, slices, dtype, kwargs):
+        """Copy a staged chunk to the slower tiers."""
+        staging = self.tiers[self.staging_tier]
+        chunk = staging.get_chunk(array_name, slices, dtype)
+        for tier in reversed(self.tiers[self.staging_tier + 1:]):
+            tier.put_chunk(array_name, slices, chunk, **kwargs)
+
+    @_instrumented('put')
+    def put_chunk(self, array_name, slices, chunk, **kwargs):
+        """See the docstring of :meth:`ChunkStore.put_chunk`.
+
+        If write-back is enabled, this returns as soon as the staging tier
+        has the chunk, and any errors in the slower tiers are reported by
+        :meth:`flush` instead.
+        """
+        chunk_name, _ = self.chunk_metadata(array_name, slices, chunk=chunk)
+        if self.staging_tier is None:
+            for tier in reversed(self.tiers):
+                tier.put_chunk(array_name, slices, chunk, **kwargs)
+            return
+        self.tiers[self.staging_tier].put_chunk(array_name, slices, chunk,
+                                                **kwargs)
+        # Faster tiers than the staging tier should not keep stale chunks
+        for tier in self.tiers[:self.staging_tier]:
+            tier.put_chunk_noraise(array_name, slices, chunk, **kwargs)
+
+        def done(result, chunk_name=chunk_name):
+            """Stop tracking the copy once it is done (for good or bad)."""
+            with self._lock:
+                self._pending[chunk_name] -= 1
+                if self._pending[chunk_name] <= 0:
+                    del self._pending[chunk_name]
+                if isinstance(result, Exception):
+                    self._flush_errors.append(result)
+                self._flushed.notify_all()
+
+        def write_back():
+            """Copy chunk but return errors instead of raising them."""
+            # Catch all errors, as the callback (and hence flush) hinges on it
+            try:
+                self._write_back(array_name, slices, chunk.dtype, kwargs)
+            except Exception as err:
+                return err
+
+        with self._lock:
+            self._pending[chunk_name] += 1
+        self._flush_threads().apply_async(write_back, callback=done)
+
+    def flush(self):
+        """Wait until all staged chunks have been copied to the slower tiers.
+
+        Raises
+        ------
+        :exc:`chunkstore.ChunkStoreError`
+            The first error encountered while copying chunks since the last
+            flush (the remaining chunks are still copied)
+        """
+        with self._lock:
+            while self._pending:
+                self._flushed.wait()
+            errors, self._flush_errors = self._flush_errors, []
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        """Flush staged chunks and stop the threads of the store and its tiers.
+
+        The threads are started again if the store is used again.
+
+        Raises
+        ------
+        :exc:`chunkstore.ChunkStoreError`
+            The first error encountered while copying chunks since the last
+            flush (the threads are stopped regardless)
+        """
+        try:
+            self.flush()
+        finally:
+            with self._lock:
+                pool, self._flush_pool = self._flush_pool, None
+            if pool is not None:
+                pool.close()
+                pool.join()
+            for tier in self.tiers:
+                tier.close()
+            super(TieredChunkStore, self).close()
+
+    @property
+    def pending(self):
+        """Number of staged chunks not copied to the slower tiers yet."""
+        with self._lock:
+            return sum(self._pending.values())
+
+    @_instrumented('has')
+    def has_chunk(self, array_name, slices, dtype):
+        """See the docstring of :meth:`ChunkStore.has_chunk`."""
+        return any(tier.has_chunk(array_name, slices, dtype)
+                   for tier in self.tiers)
+
+    @_instrumented('list')
+    def list_chunk_ids(self, array_name, prefixes=None):
+        """See the docstring of :meth:`ChunkStore.list_chunk_ids`.
+
+        This lists the backing store, as well as the staging tier if there is
+        one (since it may have chunks that have not been copied yet).
+        """
+        chunk_ids = set(self.tiers[-1].list_chunk_ids(array_name, prefixes))
+        if self.staging_tier is not None:
+            staging = self.tiers[self.staging_tier]
+            chunk_ids.update(staging.list_chunk_ids(array_name, prefixes))
+        return list(chunk_ids)
+
+    get_chunk.__doc__ = ChunkStore.get_chunk.__doc__
+    get_chunk_into.__doc__ = ChunkStore.get_chunk_into.__doc__
+    has_chunk.__doc__ = ChunkStore.has_chunk.__doc__
+    list_chunk_ids.__doc__ = ChunkStore.list_chunk_ids.__doc__
+
+
+def _close_at_exit(store_ref):
+    """Complete the write-back of a tiered store (if it still exists)."""
+    store = store_ref()
+    if store is None:
+        return
+    try:
+        store.close()
+    except Exception as err:
+        logger.error('Staged chunks could not be copied to slower tiers '
+                     'at exit: %s', err)
@@ -16,7 +16,7 @@
 
 """A store of chunks (i.e. N-dimensional arrays) based on a dict of arrays."""
 
-from .chunkstore import ChunkStore, ChunkNotFound, BadChunk
+from .chunkstore import ChunkStore, ChunkNotFound, BadChunk, _instrumented
 
 
 class DictChunkStore(ChunkStore):
@@ -35,6 +35,7 @@ class DictChunkStore(ChunkStore):
         super(DictChunkStore, self).__init__(error_map)
         self.arrays = kwargs
 
+    @_instrumented('get')
     def get_chunk(self, array_name, slices, dtype):
         """See the docstring of :meth:`ChunkStore.get_chunk`."""
         chunk_name, shape = self.chunk_metadata(array_name, slices, dtype=dtype)
@@ -49,7 +50,9 @@ class DictChunkStore(ChunkStore):
                                    dtype, shape))
         return chunk
 
-    def put_chunk(self, array_name, slices, chunk):
+    @_instrumented('put')
+    def put_chunk(self, array_name, slices, chunk, codec=None,
+                  elide_constant=False):
         """See the docstring of :meth:`ChunkStore.put_chunk`."""
         self.chunk_metadata(array_name, slices, chunk=chunk)
         self.get_chunk(array_name, slices, chunk.dtype)[()] = chunk
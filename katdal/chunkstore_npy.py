@@ -17,10 +17,21 @@
 """A store of chunks (i.e. N-dimensional arrays) based on NPY files."""
 
 import os
+import io
+import contextlib
+import logging
+import time
 
 import numpy as np
 
-from .chunkstore import ChunkStore, StoreUnavailable, ChunkNotFound, BadChunk
+from .chunkstore import (ChunkStore, ChunkStoreError, StoreUnavailable,
+                         ChunkNotFound, BadChunk, _map_concurrently,
+                         _instrumented, _normalise_region, _plan_region,
+                         _read_region, _report_transferred_bytes)
+from .chunk_codecs import write_chunk, read_chunk_header, read_chunk_into
+
+
+logger = logging.getLogger(__name__)
 
 
 class NpyFileChunkStore(ChunkStore):
@@ -33,71 +44,303 @@ class NpyFileChunkStore(ChunkStore):
 
     where "<path>" is the chunk store directory specified on construction,
     "<array>" is the name of the parent array of the chunk and "<idx>" is
-    the index string of each chunk (e.g. "00001_00512").
+    the index string of each chunk (e.g. "00001_00512"). Chunks that are
+    compressed by a codec are stored in a variant of the NPY format
+    described in :mod:`katdal.chunk_codecs`.
 
     For a description of the ``.npy`` format, see :py:mod:`numpy.lib.format`
     or the relevant NumPy Enhancement Proposal
     `here <http://docs.scipy.org/doc/numpy/neps/npy-format.html>`_.
 
+    Uncompressed chunks may optionally be retrieved as memory-mapped arrays
+    (see :class:`numpy.memmap`) instead of being read into memory. Only the
+    pages of the NPY file that are actually accessed are then read from disk,
+    and those pages live in the OS page cache, which is shared by all
+    processes reading the same chunks. This suits selections that only touch
+    a small part of each chunk. Compressed chunks are still decoded in full.
+
+    Chunks are written to a temporary file that is renamed once complete, but
+    by default nothing is flushed to disk, which is fastest but could lose
+    chunks that were recently stored if the machine crashes. For durability,
+    chunk files can be synced as they are written and their directory entries
+    synced after each chunk or after each batch of chunks stored by
+    :meth:`put_chunks_noraise` (the latter is much cheaper).
+
     Parameters
     ----------
     path : string
         Top-level directory that contains NPY files of chunk store
+    mmap_mode : {None, 'r', 'c'}, optional
+        If not None, :meth:`get_chunk` returns uncompressed chunks as memory
+        maps with this mode: read-only ('r') or copy-on-write ('c'), where
+        changes to the latter are never written back to the NPY file
+    fsync : {None, 'chunk', 'batch'}, optional
+        Durability of stored chunks: no syncing (None), sync each chunk file
+        and its directory after each chunk ('chunk'), or sync each chunk file
+        and only sync the directories once per batch of chunks ('batch').
+        A single :meth:`put_chunk` is treated as a batch of one chunk.
 
     Raises
     ------
     :exc:`chunkstore.StoreUnavailable`
         If path does not exist / is not readable
+    ValueError
+        If `mmap_mode` is unknown or would allow writes to the store, or if
+        `fsync` is unknown
     """
 
-    def __init__(self, path):
+    def __init__(self, path, mmap_mode=None, fsync=None):
         super(NpyFileChunkStore, self).__init__({IOError: ChunkNotFound,
                                                  ValueError: ChunkNotFound})
         if not os.path.isdir(path):
             raise StoreUnavailable('Directory {!r} does not exist'.format(path))
+        if mmap_mode not in (None, 'r', 'c'):
+            raise ValueError("Memory map mode should be None, 'r' or 'c', "
+                             "not {!r}".format(mmap_mode))
+        if fsync not in (None, 'chunk', 'batch'):
+            raise ValueError("Fsync policy should be None, 'chunk' or 'batch', "
+                             "not {!r}".format(fsync))
         self.path = path
+        self.mmap_mode = mmap_mode
+        self.fsync = fsync
+        # Directories that are known to exist, to avoid a makedirs per chunk
+        self._dirs = set()
+
+    # Read a few files in parallel to hide disk latency in get_chunks()
+    max_concurrency = 8
 
+    @_instrumented('get')
     def get_chunk(self, array_name, slices, dtype):
         """See the docstring of :meth:`ChunkStore.get_chunk`."""
+        dtype = np.dtype(dtype)
         chunk_name, shape = self.chunk_metadata(array_name, slices, dtype=dtype)
+        if self.mmap_mode:
+            with self._open(chunk_name, shape, dtype) as (npy_file, header):
+                chunk = self._memmap(chunk_name, npy_file, shape, dtype,
+                                     *header)
+            if chunk is not None:
+                return chunk
+        chunk = np.empty(shape, dtype)
+        self.get_chunk_into(array_name, slices, dtype, chunk)
+        return chunk
+
+    def _memmap(self, chunk_name, npy_file, shape, dtype, fortran_order,
+                codec):
+        """Memory-map array data of open NPY file (None if not possible)."""
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        # Encoded chunks need decoding and mmap cannot map empty regions
+        if codec is not None or nbytes == 0:
+            return None
+        data_offset = npy_file.tell()
+        with self._standard_errors(chunk_name):
+            file_size = os.fstat(npy_file.fileno()).st_size
+        if file_size < data_offset + nbytes:
+            raise BadChunk('Chunk {!r}: NPY file has {} bytes of array data, '
+                           'expected {}'.format(chunk_name,
+                                                file_size - data_offset,
+                                                nbytes))
+        # The memory map stays valid after the file is closed
+        with self._standard_errors(chunk_name):
+            return np.memmap(npy_file, dtype, self.mmap_mode, data_offset,
+                             shape, 'F' if fortran_order else 'C')
+
+    @_instrumented('get')
+    def get_chunk_into(self, array_name, slices, dtype, out):
+        """See the docstring of :meth:`ChunkStore.get_chunk_into`.
+
+        This reads the NPY file straight into `out` without a temporary copy.
+        """
+        dtype = np.dtype(dtype)
+        chunk_name, shape = self.chunk_metadata(array_name, slices,
+                                                chunk=out, dtype=dtype)
+        with self._open(chunk_name, shape, dtype) as (npy_file, header):
+            fortran_order, codec = header
+            with self._standard_errors(chunk_name):
+                read_chunk_into(npy_file, out, fortran_order, dtype, codec)
+
+    # Merge byte ranges of partial reads if they are this close together
+    region_max_gap = 4096
+    # Maximum number of separate byte ranges (i.e. seeks) of a partial read
+    region_max_ranges = 4096
+
+    @_instrumented('get')
+    def get_chunk_region(self, array_name, slices, dtype, subregion):
+        """See the docstring of :meth:`ChunkStore.get_chunk_region`.
+
+        This only reads the parts of an uncompressed C-order NPY file that
+        contain the region, if that is a small part of the file. If the store
+        uses memory maps, the region is a view of the memory-mapped chunk.
+        """
+        dtype = np.dtype(dtype)
+        chunk_name, shape = self.chunk_metadata(array_name, slices, dtype=dtype)
+        region = _normalise_region(shape, subregion)
+        with self._open(chunk_name, shape, dtype) as (npy_file, header):
+            fortran_order, codec = header
+            if self.mmap_mode:
+                chunk = self._memmap(chunk_name, npy_file, shape, dtype,
+                                     fortran_order, codec)
+                if chunk is not None:
+                    return chunk[region]
+            ranges = None
+            if codec is None and not fortran_order:
+                ranges = _plan_region(shape, dtype, region,
+                                      self.region_max_gap,
+                                      self.region_max_ranges)
+            with self._standard_errors(chunk_name):
+                if ranges is None:
+                    chunk = np.empty(shape, dtype)
+                    read_chunk_into(npy_file, chunk, fortran_order,
+                                    dtype, codec)
+                    _report_transferred_bytes(chunk.nbytes)
+                    return chunk[region]
+                data_offset = npy_file.tell()
+
+                def read_into(offset, view):
+                    """Read part of NPY file into `view`."""
+                    npy_file.seek(data_offset + offset)
+                    if npy_file.readinto(view) != len(view):
+                        raise BadChunk('NPY file ended prematurely')
+
+                return _read_region(read_into, shape, dtype, region, ranges)
+
+    @contextlib.contextmanager
+    def _open(self, chunk_name, shape, dtype):
+        """Open NPY file of chunk and check its header against shape / dtype.
+
+        This yields the open file positioned at the start of the array data,
+        together with its Fortran order flag and codec.
+        """
         filename = os.path.join(self.path, chunk_name) + '.npy'
         with self._standard_errors(chunk_name):
-            chunk = np.load(filename, allow_pickle=False)
-        if chunk.shape != shape or chunk.dtype != dtype:
-            raise BadChunk('Chunk {!r}: NPY file dtype {} and/or shape {} '
-                           'differs from expected dtype {} and shape {}'
-                           .format(chunk_name, chunk.dtype, chunk.shape,
-                                   dtype, shape))
-        return chunk
+            npy_file = io.open(filename, 'rb')
+        with npy_file:
+            with self._standard_errors(chunk_name):
+                header = read_chunk_header(npy_file)
+            chunk_shape, fortran_order, chunk_dtype, codec = header
+            if chunk_shape != shape or chunk_dtype != dtype:
+                raise BadChunk('Chunk {!r}: NPY file dtype {} and/or shape {} '
+                               'differs from expected dtype {} and shape {}'
+                               .format(chunk_name, chunk_dtype, chunk_shape,
+                                       dtype, shape))
+            yield npy_file, (fortran_order, codec)
 
-    def put_chunk(self, array_name, slices, chunk):
-        """See the docstring of :meth:`ChunkStore.put_chunk`."""
-        chunk_name, _ = self.chunk_metadata(array_name, slices, chunk=chunk)
-        base_filename = os.path.join(self.path, chunk_name)
-        # Ensure any subdirectories are in place
+    def _make_dir(self, dir_name):
+        """Ensure that directory exists (and remember that it does)."""
+        if dir_name in self._dirs:
+            return
         try:
-            os.makedirs(os.path.dirname(base_filename))
+            os.makedirs(dir_name)
         except OSError as e:
             # Be happy if someone already created the path
             if e.errno != os.errno.EEXIST:
                 raise
-        with self._standard_errors(chunk_name):
-            # Rename the file when done writing to make put_chunk() atomic
-            temp_filename = base_filename + '.writing.npy'
-            np.save(temp_filename, chunk, allow_pickle=False)
-            os.rename(temp_filename, base_filename + '.npy')
+        self._dirs.add(dir_name)
+
+    @staticmethod
+    def _fsync_dir(dir_name):
+        """Flush directory entries (e.g. renamed files) to disk."""
+        fd = os.open(dir_name, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _put(self, chunk_name, chunk, codec=None, elide_constant=False):
+        """Write chunk to NPY file in existing directory, returning its size."""
+        base_filename = os.path.join(self.path, chunk_name)
+        try:
+            with self._standard_errors(chunk_name):
+                # Rename the file when done writing to make put_chunk() atomic
+                temp_filename = base_filename + '.writing.npy'
+                with io.open(temp_filename, 'wb') as npy_file:
+                    write_chunk(npy_file, chunk, codec, elide_constant)
+                    if self.fsync:
+                        npy_file.flush()
+                        os.fsync(npy_file.fileno())
+                    nbytes = npy_file.tell()
+                os.rename(temp_filename, base_filename + '.npy')
+        except ChunkNotFound:
+            # Maybe the directory disappeared: make it again next time
+            self._dirs.discard(os.path.dirname(base_filename))
+            raise
+        if self.fsync == 'chunk':
+            self._fsync_dir(os.path.dirname(base_filename))
+        return nbytes
+
+    @_instrumented('put')
+    def put_chunk(self, array_name, slices, chunk, codec=None,
+                  elide_constant=False):
+        """See the docstring of :meth:`ChunkStore.put_chunk`."""
+        chunk_name, _ = self.chunk_metadata(array_name, slices, chunk=chunk)
+        dir_name = os.path.dirname(os.path.join(self.path, chunk_name))
+        # Ensure any subdirectories are in place
+        self._make_dir(dir_name)
+        self._put(chunk_name, chunk, codec, elide_constant)
+        if self.fsync == 'batch':
+            self._fsync_dir(dir_name)
+
+    def put_chunks_noraise(self, array_name, slices_list, chunks, codec=None,
+                           elide_constant=False):
+        """See the docstring of :meth:`ChunkStore.put_chunks_noraise`.
+
+        This creates the necessary directories once per batch, writes up to
+        :attr:`max_concurrency` chunks in parallel and, if the store syncs
+        per batch, syncs each directory once after all the chunks are written.
+        """
+        start_time = time.time()
+        chunks = list(chunks)
+        success = len(slices_list) * [None]
+        chunk_names = {}
+        for n, (slices, chunk) in enumerate(zip(slices_list, chunks)):
+            try:
+                chunk_names[n], _ = self.chunk_metadata(array_name, slices,
+                                                        chunk=chunk)
+            except BadChunk as err:
+                success[n] = err
+        dir_names = set(os.path.dirname(os.path.join(self.path, chunk_name))
+                        for chunk_name in chunk_names.values())
+        for dir_name in dir_names:
+            self._make_dir(dir_name)
+
+        def put(n):
+            """Write n'th chunk, returning its size (0 if it failed)."""
+            start = time.time()
+            try:
+                nbytes = self._put(chunk_names[n], chunks[n],
+                                   codec, elide_constant)
+            except ChunkStoreError as err:
+                success[n] = err
+                self._record('put', time.time() - start, error=err)
+                return 0
+            self._record('put', time.time() - start, chunks[n].nbytes)
+            return nbytes
+
+        nbytes = sum(_map_concurrently(put, sorted(chunk_names),
+                                       self.max_concurrency, self._threads))
+        if self.fsync == 'batch':
+            for dir_name in dir_names:
+                self._fsync_dir(dir_name)
+        duration = time.time() - start_time
+        logger.debug('Stored %d chunks (%d bytes) of %r in %.3f s (%.1f MB/s)',
+                     len(chunk_names), nbytes, array_name, duration,
+                     nbytes / max(duration, 1e-6) / 1e6)
+        return success
 
+    @_instrumented('has')
     def has_chunk(self, array_name, slices, dtype):
         """See the docstring of :meth:`ChunkStore.has_chunk`."""
         chunk_name, _ = self.chunk_metadata(array_name, slices, dtype=dtype)
         filename = os.path.join(self.path, chunk_name) + '.npy'
         return os.path.exists(filename)
 
-    def list_chunk_ids(self, array_name):
+    @_instrumented('list')
+    def list_chunk_ids(self, array_name, prefixes=None):
         """See the docstring of :meth:`ChunkStore.list_chunk_ids`."""
         array_dir = os.path.join(self.path, array_name)
+        prefixes = tuple(prefixes) if prefixes else ('',)
         # Strip the .npy extension to get the chunk ID string
-        return [fn[:-4] for fn in os.listdir(array_dir) if fn.endswith('.npy')]
+        return [fn[:-4] for fn in os.listdir(array_dir)
+                if fn.endswith('.npy') and fn.startswith(prefixes)]
 
     get_chunk.__doc__ = ChunkStore.get_chunk.__doc__
     put_chunk.__doc__ = ChunkStore.put_chunk.__doc__
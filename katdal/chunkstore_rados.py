@@ -16,6 +16,13 @@
 
 """A store of chunks (i.e. N-dimensional arrays) based on the Ceph RADOS API."""
 
+import errno
+import functools
+import io
+import os
+import threading
+import time
+
 import numpy as np
 try:
     import rados
@@ -25,7 +32,11 @@ except ImportError as e:
     rados = None
     _rados_import_error = e
 
-from .chunkstore import ChunkStore, StoreUnavailable, ChunkNotFound, BadChunk
+from .chunkstore import (ChunkStore, ChunkStoreError, StoreUnavailable,
+                         ChunkNotFound, BadChunk, _instrumented,
+                         _normalise_region, _plan_region, _read_region)
+from .chunk_codecs import (CODEC_MAGIC, write_chunk, chunk_from_bytes,
+                           is_constant)
 
 
 class RadosChunkStore(ChunkStore):
@@ -37,12 +48,18 @@ class RadosChunkStore(ChunkStore):
      "<array>/<idx>"
 
     where "<array>" is the name of the parent array of the chunk and "<idx>" is
-    the index string of each chunk (e.g. "00001_00512").
+    the index string of each chunk (e.g. "00001_00512"). The object contains
+    the raw array data, unless it is compressed by a codec, in which case it
+    has the format described in :mod:`katdal.chunk_codecs`.
 
     Parameters
     ----------
     ioctx : :class:`rados.Ioctx` object
         RADOS input/output context (ioctx) used to read from / write to Ceph
+    max_concurrency : int, optional
+        Number of asynchronous reads or writes kept in flight by
+        :meth:`get_chunks` and :meth:`put_chunks_noraise` (and hence by
+        batched dask arrays), overriding the class default if specified
 
     Raises
     ------
@@ -50,7 +67,7 @@ class RadosChunkStore(ChunkStore):
         If rados is not installed (it's an optional dependency otherwise)
     """
 
-    def __init__(self, ioctx):
+    def __init__(self, ioctx, max_concurrency=None):
         if not rados:
             raise _rados_import_error
         # From now on, ObjectNotFound refers to RADOS objects i.e. chunks
@@ -58,9 +75,12 @@ class RadosChunkStore(ChunkStore):
                      rados.ObjectNotFound: ChunkNotFound}
         super(RadosChunkStore, self).__init__(error_map)
         self.ioctx = ioctx
+        if max_concurrency is not None:
+            self.max_concurrency = max_concurrency
 
     @classmethod
-    def from_config(cls, config, pool, keyring=None, timeout=5.):
+    def from_config(cls, config, pool, keyring=None, timeout=5.,
+                    max_concurrency=None):
         """Construct RADOS chunk store from config and specified pool.
 
         Parameters
@@ -73,6 +93,8 @@ class RadosChunkStore(ChunkStore):
             Path to client keyring file (if not provided by `conf` or override)
         timeout : float, optional
             RADOS client timeout, in seconds (set to None to leave unchanged)
+        max_concurrency : int, optional
+            Number of asynchronous operations kept in flight by batch requests
 
         Raises
         ------
@@ -97,17 +119,19 @@ class RadosChunkStore(ChunkStore):
         # A missing config file or pool also triggers ObjectNotFound
         except (rados.TimedOut, rados.ObjectNotFound) as e:
             raise StoreUnavailable(str(e))
-        return cls(ioctx)
+        return cls(ioctx, max_concurrency)
 
-    def get_chunk(self, array_name, slices, dtype):
-        """See the docstring of :meth:`ChunkStore.get_chunk`."""
-        dtype = np.dtype(dtype)
-        key, shape = self.chunk_metadata(array_name, slices, dtype=dtype)
+    def _chunk_from_bytes(self, key, shape, dtype, data_str):
+        """Turn object data into chunk, checking that it has the right size."""
         expected_bytes = int(np.prod(shape)) * dtype.itemsize
-        with self._standard_errors(key):
-            # Try to read an extra byte to see if data is more than expected
-            data_str = self.ioctx.read(key, expected_bytes + 1)
         actual_bytes = len(data_str)
+        if data_str.startswith(CODEC_MAGIC):
+            try:
+                return self._decode_chunk(key, shape, dtype, data_str)
+            except (BadChunk, ValueError):
+                # Raw chunk data that happens to start with the magic string
+                if actual_bytes != expected_bytes:
+                    raise
         if actual_bytes != expected_bytes:
             # Get the actual value via stat() to improve error reporting
             if actual_bytes > expected_bytes:
@@ -119,13 +143,229 @@ class RadosChunkStore(ChunkStore):
                                    actual_bytes))
         return np.ndarray(shape, dtype, data_str)
 
-    def put_chunk(self, array_name, slices, chunk):
+    def _decode_chunk(self, key, shape, dtype, data_str):
+        """Turn object data of chunk compressed by a codec into chunk."""
+        expected_bytes = int(np.prod(shape)) * dtype.itemsize
+        if len(data_str) > expected_bytes:
+            # The read may have been truncated, so get the whole object
+            with self._standard_errors(key):
+                actual_bytes, _ = self.ioctx.stat(key)
+                data_str = self.ioctx.read(key, actual_bytes)
+        chunk = chunk_from_bytes(data_str)
+        if chunk.shape != shape or chunk.dtype != dtype:
+            raise BadChunk('Chunk {!r}: dtype {} and/or shape {} in store '
+                           'differs from expected dtype {} and shape {}'
+                           .format(key, chunk.dtype, chunk.shape, dtype, shape))
+        return chunk
+
+    @_instrumented('get')
+    def get_chunk(self, array_name, slices, dtype):
+        """See the docstring of :meth:`ChunkStore.get_chunk`."""
+        dtype = np.dtype(dtype)
+        key, shape = self.chunk_metadata(array_name, slices, dtype=dtype)
+        expected_bytes = int(np.prod(shape)) * dtype.itemsize
+        with self._standard_errors(key):
+            # Try to read an extra byte to see if data is more than expected
+            data_str = self.ioctx.read(key, expected_bytes + 1)
+        return self._chunk_from_bytes(key, shape, dtype, data_str)
+
+    # Number of asynchronous reads / writes that batch requests keep in flight
+    max_concurrency = 16
+
+    def _aio(self, requests):
+        """Run asynchronous librados operations, a window of them at a time.
+
+        This keeps up to :attr:`max_concurrency` operations in flight from the
+        calling thread and waits until they are all done.
+
+        Parameters
+        ----------
+        requests : sequence of (key, start) pairs
+            Object key and function that starts an asynchronous operation on
+            the object when called with a completion callback
+
+        Returns
+        -------
+        outcomes : list of (int, string, float) or :exc:`ChunkStoreError`
+            Return value, data (None for writes) and duration in seconds of
+            each operation, or the error that prevented it from starting
+        """
+        outcomes = {}
+        done = threading.Condition()
+
+        def oncomplete(n):
+            """Callback that records outcome of n'th asynchronous operation."""
+            start_time = time.time()
+
+            def record_outcome(completion, data_str=None):
+                with done:
+                    outcomes[n] = (completion.get_return_value(), data_str,
+                                   time.time() - start_time)
+                    done.notify()
+            return record_outcome
+
+        errors = {}
+        started = 0
+        for n, (key, start) in enumerate(requests):
+            with done:
+                while started - len(outcomes) >= self.max_concurrency:
+                    done.wait()
+            try:
+                with self._standard_errors(key):
+                    start(oncomplete(n))
+            except ChunkStoreError as err:
+                errors[n] = err
+            else:
+                started += 1
+        with done:
+            while len(outcomes) < started:
+                done.wait()
+        outcomes.update(errors)
+        return [outcomes[n] for n in range(len(requests))]
+
+    @staticmethod
+    def _check_result(key, result):
+        """Turn negative return value of librados operation into an error."""
+        if result == -errno.ENOENT:
+            raise ChunkNotFound('Chunk {!r}: object not found'.format(key))
+        elif result < 0:
+            raise StoreUnavailable('Chunk {!r}: {}'
+                                   .format(key, os.strerror(-result)))
+
+    def get_chunks_noraise(self, array_name, slices_list, dtype):
+        """See the docstring of :meth:`ChunkStore.get_chunks_noraise`.
+
+        This uses the asynchronous I/O interface of librados to keep up to
+        :attr:`max_concurrency` reads in flight from the calling thread.
+        """
+        dtype = np.dtype(dtype)
+        chunks = len(slices_list) * [None]
+        requests = []
+        pending = []
+        for n, slices in enumerate(slices_list):
+            try:
+                key, shape = self.chunk_metadata(array_name, slices,
+                                                 dtype=dtype)
+            except BadChunk as err:
+                chunks[n] = err
+                continue
+            expected_bytes = int(np.prod(shape)) * dtype.itemsize
+            # Read an extra byte to see if data is more than expected
+            start = functools.partial(self.ioctx.aio_read, key,
+                                      expected_bytes + 1, 0)
+            requests.append((key, start))
+            pending.append((n, key, shape))
+        # Process the data in this thread and not in the librados callbacks
+        for (n, key, shape), outcome in zip(pending, self._aio(requests)):
+            duration = 0.
+            try:
+                if isinstance(outcome, ChunkStoreError):
+                    raise outcome
+                result, data_str, duration = outcome
+                self._check_result(key, result)
+                chunks[n] = self._chunk_from_bytes(key, shape, dtype, data_str)
+            except ChunkStoreError as err:
+                chunks[n] = err
+                self._record('get', duration, error=err)
+            else:
+                self._record('get', duration, chunks[n].nbytes)
+        return chunks
+
+    @staticmethod
+    def _chunk_to_bytes(chunk, codec=None, elide_constant=False):
+        """Turn chunk into object data (raw array data unless compressed)."""
+        if elide_constant and chunk.size > 1 and is_constant(chunk):
+            codec = 'constant'
+        if codec is None:
+            return chunk.tobytes()
+        fp = io.BytesIO()
+        write_chunk(fp, chunk, codec)
+        return fp.getvalue()
+
+    def put_chunks_noraise(self, array_name, slices_list, chunks, codec=None,
+                           elide_constant=False):
+        """See the docstring of :meth:`ChunkStore.put_chunks_noraise`.
+
+        This uses the asynchronous I/O interface of librados to keep up to
+        :attr:`max_concurrency` writes in flight from the calling thread.
+        """
+        success = len(slices_list) * [None]
+        requests = []
+        pending = []
+        for n, (slices, chunk) in enumerate(zip(slices_list, chunks)):
+            try:
+                key, _ = self.chunk_metadata(array_name, slices, chunk=chunk)
+            except BadChunk as err:
+                success[n] = err
+                continue
+            data_str = self._chunk_to_bytes(chunk, codec, elide_constant)
+            start = functools.partial(self.ioctx.aio_write_full, key, data_str)
+            requests.append((key, start))
+            pending.append((n, key, chunk.nbytes))
+        for (n, key, nbytes), outcome in zip(pending, self._aio(requests)):
+            duration = 0.
+            try:
+                if isinstance(outcome, ChunkStoreError):
+                    raise outcome
+                result, _, duration = outcome
+                self._check_result(key, result)
+            except ChunkStoreError as err:
+                success[n] = err
+                self._record('put', duration, error=err)
+            else:
+                self._record('put', duration, nbytes)
+        return success
+
+    # Merge byte ranges of partial reads if they are this close together
+    region_max_gap = 2 ** 16
+    # Maximum number of separate object reads of a partial read
+    region_max_ranges = 64
+
+    @_instrumented('get')
+    def get_chunk_region(self, array_name, slices, dtype, subregion):
+        """See the docstring of :meth:`ChunkStore.get_chunk_region`.
+
+        This reads only the byte ranges of the object that contain the region
+        via offset reads, if the region is a small part of the chunk and the
+        object contains raw chunk data (i.e. it is not compressed).
+        """
+        dtype = np.dtype(dtype)
+        key, shape = self.chunk_metadata(array_name, slices, dtype=dtype)
+        region = _normalise_region(shape, subregion)
+        ranges = _plan_region(shape, dtype, region, self.region_max_gap,
+                              self.region_max_ranges)
+        if ranges is None:
+            return self.get_chunk(array_name, slices, dtype)[region]
+        expected_bytes = int(np.prod(shape)) * dtype.itemsize
+        with self._standard_errors(key):
+            actual_bytes, _ = self.ioctx.stat(key)
+            prefix = self.ioctx.read(key, len(CODEC_MAGIC))
+        if actual_bytes != expected_bytes or prefix == CODEC_MAGIC:
+            # Let get_chunk deal with compressed (or bad) chunks
+            return self.get_chunk(array_name, slices, dtype)[region]
+
+        def read_into(offset, view):
+            """Read part of object into `view`."""
+            with self._standard_errors(key):
+                data_str = self.ioctx.read(key, len(view), offset)
+            if len(data_str) != len(view):
+                raise BadChunk('Chunk {!r}: expected {} bytes at offset {}, '
+                               'got {} bytes instead'
+                               .format(key, len(view), offset, len(data_str)))
+            view[:] = data_str
+
+        return _read_region(read_into, shape, dtype, region, ranges)
+
+    @_instrumented('put')
+    def put_chunk(self, array_name, slices, chunk, codec=None,
+                  elide_constant=False):
         """See the docstring of :meth:`ChunkStore.put_chunk`."""
         key, _ = self.chunk_metadata(array_name, slices, chunk=chunk)
-        data_str = chunk.tobytes()
+        data_str = self._chunk_to_bytes(chunk, codec, elide_constant)
         with self._standard_errors(key):
             self.ioctx.write_full(key, data_str)
 
+    @_instrumented('has')
     def has_chunk(self, array_name, slices, dtype):
         """See the docstring of :meth:`ChunkStore.has_chunk`."""
         dtype = np.dtype(dtype)
@@ -21,8 +21,16 @@ code to provide HTTP authentication.
 """
 
 import contextlib
+import functools
+import itertools
+import heapq
+import collections
+import random
+import time
 import io
 import threading
+import multiprocessing.pool
+import socket
 import Queue
 import sys
 import urlparse
@@ -30,6 +38,7 @@ import urllib
 import hashlib
 import base64
 import warnings
+import logging
 
 import defusedxml.ElementTree
 import defusedxml.cElementTree
@@ -37,7 +46,14 @@ import numpy as np
 import requests
 from requests.adapters import HTTPAdapter as _HTTPAdapter
 
-from .chunkstore import ChunkStore, StoreUnavailable, ChunkNotFound, BadChunk
+from .chunkstore import (ChunkStore, ChunkStoreError, StoreUnavailable,
+                         ChunkNotFound, BadChunk, _instrumented,
+                         _normalise_region, _plan_region, _read_region,
+                         _report_transferred_bytes, _map_concurrently)
+from .chunk_codecs import chunk_buffers, read_chunk_header, read_chunk_into
+
+
+logger = logging.getLogger(__name__)
 
 
 class _TimeoutHTTPAdapter(_HTTPAdapter):
@@ -52,6 +68,10 @@ class _TimeoutHTTPAdapter(_HTTPAdapter):
         return super(_TimeoutHTTPAdapter, self).send(request, stream, timeout, *args, **kwargs)
 
 
+# HTTP status codes of transient server errors (including 503 SlowDown)
+_RETRY_STATUS = (500, 502, 503, 504)
+
+
 def _raise_for_status(response):
     """Like :meth:`requests.Response.raise_for_status`, but uses ChunkStore exception types."""
     try:
@@ -91,6 +111,273 @@ class _Pool(object):
         self.put(item)
 
 
+class _BufferStream(object):
+    """Read-only file-like object that concatenates buffers without copying.
+
+    This serves as a request body that streams the NPY header and array data
+    of a chunk straight from their original memory, and that can be rewound
+    if the request needs to be retried.
+    """
+    def __init__(self, buffers):
+        self._buffers = [memoryview(buf) for buf in buffers if len(buf)]
+        self._len = sum(len(buf) for buf in self._buffers)
+        self._pos = 0
+
+    def __len__(self):
+        return self._len
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self._len
+        self._pos = min(max(offset, 0), self._len)
+        return self._pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._len - self._pos
+        pieces = []
+        start = 0
+        for buf in self._buffers:
+            if size <= 0:
+                break
+            offset = self._pos - start
+            if 0 <= offset < len(buf):
+                piece = buf[offset:offset + size]
+                pieces.append(piece.tobytes())
+                self._pos += len(piece)
+                size -= len(piece)
+            start += len(buf)
+        return b''.join(pieces)
+
+    def byte_range(self, start, stop):
+        """Stream over bytes `start` to `stop` (also without copying them)."""
+        pieces = []
+        offset = 0
+        for buf in self._buffers:
+            lower = max(start - offset, 0)
+            upper = min(stop - offset, len(buf))
+            if lower < upper:
+                pieces.append(buf[lower:upper])
+            offset += len(buf)
+        return _BufferStream(pieces)
+
+    def md5(self):
+        """Base64-encoded MD5 digest of the content, as used by Content-MD5."""
+        md5 = hashlib.md5()
+        for buf in self._buffers:
+            md5.update(buf)
+        return base64.b64encode(md5.digest())
+
+
+class _Endpoint(object):
+    """An S3 endpoint with its own pool of sessions and health status.
+
+    Parameters
+    ----------
+    url : str
+        Base URL of the endpoint
+    session_factory : callable
+        Function that creates a :class:`requests.Session` for the pool
+    """
+    def __init__(self, url, session_factory):
+        self.url = url
+        self.sessions = _Pool(session_factory)
+        self.outstanding = 0
+        self.down_until = 0.
+
+    def __repr__(self):
+        return '<_Endpoint {!r} outstanding={}>'.format(self.url,
+                                                       self.outstanding)
+
+    @property
+    def healthy(self):
+        """True if the endpoint is not being avoided after a failure."""
+        return time.time() >= self.down_until
+
+    def mark_down(self, interval):
+        """Avoid the endpoint for the next `interval` seconds."""
+        self.down_until = time.time() + interval
+
+    def check(self):
+        """Check endpoint by listing buckets, returning error or None if OK."""
+        try:
+            with self.sessions() as session:
+                with contextlib.closing(session.get(self.url)) as response:
+                    _raise_for_status(response)
+        except (requests.exceptions.RequestException, ChunkStoreError) as err:
+            return err
+        self.down_until = 0.
+        return None
+
+
+class _LatencyTracker(object):
+    """Thread-safe record of the durations of the most recent requests.
+
+    Parameters
+    ----------
+    window : int, optional
+        Number of recent requests to remember
+    min_samples : int, optional
+        Minimum number of requests needed to estimate latency percentiles
+    """
+    def __init__(self, window=1000, min_samples=20):
+        self._latencies = collections.deque(maxlen=window)
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._latencies)
+
+    def add(self, latency):
+        """Record the duration of a request, in seconds."""
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, q):
+        """Percentile `q` of latency in seconds (None if too few requests)."""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            return np.percentile(self._latencies, q)
+
+
+def _abort_response(response):
+    """Close streamed `response`, also waking up a thread reading its body."""
+    connection = getattr(response.raw, 'connection', None)
+    sock = getattr(connection, 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+    response.close()
+
+
+class _HedgeScheduler(object):
+    """A single daemon thread that calls functions once their delay is up.
+
+    The functions run in the scheduler thread and should therefore return
+    quickly (e.g. by handing the actual work to a pool of threads). The
+    thread is started on demand and stopped by :meth:`close`.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._heap = []
+        self._order = itertools.count()
+        self._thread = None
+        self._stopping = False
+
+    def schedule(self, delay, func):
+        """Call `func` after `delay` seconds and return a handle to cancel it."""
+        # Entries are [deadline, tie-breaker, func] lists (func None if done)
+        entry = [time.time() + delay, next(self._order), func]
+        with self._cond:
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='S3HedgeScheduler')
+                self._thread.daemon = True
+                self._thread.start()
+            elif self._heap[0] is entry:
+                # Wake up the thread as the next deadline is sooner
+                self._cond.notify()
+        return entry
+
+    def cancel(self, entry):
+        """Prevent scheduled function from being called (if not called yet)."""
+        with self._cond:
+            entry[2] = None
+
+    def _run(self):
+        """Call each function once its deadline has passed."""
+        with self._cond:
+            while not self._stopping:
+                # Cancelled entries are only removed once they reach the top
+                while self._heap and self._heap[0][2] is None:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                timeout = self._heap[0][0] - time.time()
+                if timeout > 0:
+                    self._cond.wait(timeout)
+                    continue
+                entry = heapq.heappop(self._heap)
+                func, entry[2] = entry[2], None
+                self._cond.release()
+                try:
+                    func()
+                except Exception:
+                    logger.exception('Scheduled hedge failed')
+                finally:
+                    self._cond.acquire()
+
+    def close(self):
+        """Stop the thread, dropping any functions that have not been called."""
+        with self._cond:
+            thread, self._thread = self._thread, None
+            self._stopping = True
+            self._cond.notify()
+        if thread is not None:
+            thread.join()
+        with self._cond:
+            self._heap = []
+            self._stopping = False
+
+
+class _HedgedRetrieval(object):
+    """Original and duplicate attempts to retrieve the same chunk.
+
+    The original attempt runs in the thread of the caller, while the
+    duplicate is scheduled to start if the original is slow. If the
+    duplicate succeeds first, it aborts the original by closing its response.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._responses = []
+        self.done = threading.Event()
+        self.started = self.won = False
+        self.chunk = self.exc_info = None
+
+    @contextlib.contextmanager
+    def original(self, response):
+        """Allow `response` of the original attempt to be aborted in block."""
+        with self._lock:
+            if self.won:
+                raise StoreUnavailable('Chunk retrieval superseded by '
+                                       'duplicate request')
+            self._responses.append(response)
+        try:
+            yield
+        finally:
+            # Don't abort connection once it is back in the pool
+            with self._lock:
+                self._responses.remove(response)
+
+    def start(self):
+        """Mark the duplicate attempt as started."""
+        with self._lock:
+            self.started = True
+
+    def finish(self, chunk=None, exc_info=None):
+        """Store the outcome of the duplicate attempt (aborting the original)."""
+        with self._lock:
+            self.chunk, self.exc_info = chunk, exc_info
+            self.won = exc_info is None
+            if self.won:
+                for response in self._responses:
+                    _abort_response(response)
+        self.done.set()
+
+
 class S3ChunkStore(ChunkStore):
     """A store of chunks (i.e. N-dimensional arrays) based on the Amazon S3 API.
 
@@ -106,7 +393,38 @@ class S3ChunkStore(ChunkStore):
     the name of the parent array of the chunk and "<idx>" is the index string
     of each chunk (e.g. "00001_00512"). The corresponding S3 key string of
     a chunk is "<path>/<idx>.npy" which reflects the fact that the chunk is
-    stored as a string representation of an NPY file (complete with header).
+    stored as a string representation of an NPY file (complete with header),
+    or the variant described in :mod:`katdal.chunk_codecs` if compressed.
+
+    Requests can also be issued asynchronously via :meth:`get_chunk_async` and
+    :meth:`put_chunk_async`. These are serviced by a pool of I/O threads owned
+    by the store (with :attr:`max_concurrency` threads, each with its own
+    session), which is shared by all callers and is also used by
+    :meth:`get_chunks` to retrieve batches of chunks. This keeps the number
+    of requests in flight independent of the number of threads calling the
+    store and avoids starting threads per request.
+
+    Requests that fail with a transient server error (HTTP 5xx, including 503
+    SlowDown) are retried after an exponential backoff with full jitter. The
+    store also tracks the latency of recent chunk retrievals per array. If
+    `hedge_percentile` is set and a chunk has not arrived by the time given
+    by that percentile of the latency distribution of its array, a duplicate
+    request is issued (*hedging*) and whichever succeeds first is used. The
+    original request runs in the calling thread, while a single scheduler
+    thread per store hands the duplicates that are due to a separate pool of
+    threads (started once the first duplicate is needed), so hedging costs
+    little if requests are fast. A
+    duplicate that wins aborts the original request once the latter is
+    receiving its response. This prevents a single slow gateway from stalling
+    a whole computation, at the cost of a few extra requests.
+
+    The store may be backed by several equivalent S3 endpoints (e.g. multiple
+    gateways of a Ceph cluster). Each endpoint has its own pool of sessions
+    (and hence connections) and each request goes to the endpoint with the
+    fewest outstanding requests. An endpoint that fails to respond is avoided
+    for `health_check_interval` seconds, after which it receives requests
+    again (see also :meth:`check_endpoints`). The number of I/O threads scales
+    with the number of endpoints.
 
     Parameters
     ----------
@@ -114,30 +432,81 @@ class S3ChunkStore(ChunkStore):
         A callable called with no arguments that returns an instance of
         :class:`requests.Session`. The returned session is only used by
         one thread at a time.
-    url : str
-        Base URL for the S3 service
+    url : str or sequence of str
+        Base URL for the S3 service, or list of URLs of equivalent endpoints
+    max_retries : int, optional
+        Number of times a request is retried after a transient server error
+    backoff_factor : float, optional
+        Maximum delay before the first retry, in seconds (doubled per retry)
+    backoff_max : float, optional
+        Upper limit on the maximum delay before a retry, in seconds
+    hedge_percentile : float or None, optional
+        Percentile of recent latencies after which a chunk retrieval is
+        duplicated, between 0 and 100 (the default None disables hedging)
+    health_check_interval : float, optional
+        Time for which an unresponsive endpoint is avoided, in seconds
+
+    Attributes
+    ----------
+    latency : dict mapping string to :class:`_LatencyTracker` object
+        Durations of recent successful chunk retrievals, per array name
+    retries : int
+        Number of requests retried due to transient server errors
+    hedges : int
+        Number of duplicate requests issued for slow chunk retrievals
 
     Raises
     ------
     ImportError
         If requests is not installed (it's an optional dependency otherwise)
+    :exc:`chunkstore.StoreUnavailable`
+        If none of the endpoints are available
     """
 
-    def __init__(self, session_factory, url):
-        try:
-            # Quick smoke test to see if the S3 server is available,
-            # by listing buckets
-            with session_factory() as session:
-                with contextlib.closing(session.get(url)) as response:
-                    _raise_for_status(response)
-        except requests.exceptions.RequestException as error:
-            raise StoreUnavailable(str(error))
+    def __init__(self, session_factory, url, max_retries=3,
+                 backoff_factor=0.1, backoff_max=10., hedge_percentile=None,
+                 health_check_interval=30.):
+        urls = [url] if isinstance(url, basestring) else list(url)
+        if not urls:
+            raise ValueError('S3 chunk store needs at least one endpoint URL')
+        endpoints = [_Endpoint(u, session_factory) for u in urls]
+        # Quick smoke test to see if the S3 servers are available,
+        # by listing buckets (concurrently, so that dead ones don't add up)
+        if len(endpoints) == 1:
+            errors = [endpoints[0].check()]
+        else:
+            pool = multiprocessing.pool.ThreadPool(len(endpoints))
+            try:
+                errors = pool.map(_Endpoint.check, endpoints)
+            finally:
+                pool.close()
+        if all(errors):
+            raise StoreUnavailable('; '.join(str(error) for error in errors))
+        for endpoint, error in zip(endpoints, errors):
+            if error:
+                endpoint.mark_down(health_check_interval)
 
         error_map = {requests.exceptions.RequestException: StoreUnavailable,
                      defusedxml.ElementTree.ParseError: StoreUnavailable}
         super(S3ChunkStore, self).__init__(error_map)
-        self._session_pool = _Pool(session_factory)
-        self._url = url
+        self._endpoints = endpoints
+        self._io_pool = None
+        self._hedge_pool = None
+        self._hedge_scheduler = _HedgeScheduler()
+        self._io_pool_lock = threading.Lock()
+        self.max_concurrency = len(endpoints) * type(self).max_concurrency
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.hedge_percentile = hedge_percentile
+        self.health_check_interval = health_check_interval
+        self.latency = {}
+        self.retries = self.hedges = 0
+
+    @property
+    def urls(self):
+        """Base URLs of the S3 endpoints."""
+        return [endpoint.url for endpoint in self._endpoints]
 
     @classmethod
     def _from_url(cls, url, timeout, **kwargs):
@@ -145,13 +514,16 @@ class S3ChunkStore(ChunkStore):
         if not requests:
             raise ImportError('Please install requests for katdal S3 support')
 
+        urls = [url] if isinstance(url, basestring) else url
+
         def session_factory():
             session = requests.Session()
             adapter = _TimeoutHTTPAdapter(max_retries=2, timeout=timeout)
-            session.mount(url, adapter)
+            for endpoint_url in urls:
+                session.mount(endpoint_url, adapter)
             return session
 
-        return cls(session_factory, url)
+        return cls(session_factory, url, **kwargs)
 
     @classmethod
     def from_url(cls, url, timeout=10, extra_timeout=1, **kwargs):
@@ -159,15 +531,17 @@ class S3ChunkStore(ChunkStore):
 
         Parameters
         ----------
-        url : string
-            Endpoint of S3 service, e.g. 'http://127.0.0.1:9000'
+        url : string or sequence of strings
+            Endpoint of S3 service, e.g. 'http://127.0.0.1:9000', or a list of
+            equivalent endpoints (e.g. gateways of the same Ceph cluster)
         timeout : int or float, optional
             Read / connect timeout, in seconds (set to None to leave unchanged)
         extra_timeout : int or float, optional
             Additional timeout, useful to terminate e.g. slow DNS lookups
             without masking read / connect errors (ignored if `timeout` is None)
         kwargs : dict
-            Extra keyword arguments: config settings or create_client arguments
+            Extra keyword arguments passed on to the :class:`S3ChunkStore`
+            constructor (e.g. retry and hedging settings)
 
         Raises
         ------
@@ -196,7 +570,8 @@ class S3ChunkStore(ChunkStore):
         try:
             result = queue.get(timeout=timeout)
         except Queue.Empty:
-            hostname = urlparse.urlparse(url).hostname
+            urls = [url] if isinstance(url, basestring) else url
+            hostname = ', '.join(urlparse.urlparse(u).hostname for u in urls)
             raise StoreUnavailable('Timed out, possibly due to DNS lookup '
                                    'of {} stalling'.format(hostname))
         else:
@@ -206,51 +581,469 @@ class S3ChunkStore(ChunkStore):
                 # Assume result is (exception type, exception value, traceback)
                 raise result[0], result[1], result[2]
 
-    def _chunk_url(self, chunk_name):
-        return urlparse.urljoin(self._url, urllib.quote(chunk_name + '.npy'))
+    # Number of I/O threads that service asynchronous requests and get_chunks()
+    max_concurrency = 16
+
+    def _io_threads(self):
+        """Pool of I/O threads for asynchronous requests (created on demand)."""
+        with self._io_pool_lock:
+            if self._io_pool is None:
+                # XXX Revisit with asyncio / concurrent.futures on Python 3
+                self._io_pool = multiprocessing.pool.ThreadPool(
+                    self.max_concurrency)
+            return self._io_pool
+
+    def _threads(self):
+        """Batched requests share the pool of I/O threads."""
+        return self._io_threads()
+
+    def _hedge_threads(self):
+        """Pool of threads for duplicate requests (created on demand).
+
+        This is separate from the I/O pool, where duplicates would otherwise
+        queue behind the rest of a batch of requests (see :meth:`get_chunks`).
+        """
+        with self._io_pool_lock:
+            if self._hedge_pool is None:
+                self._hedge_pool = multiprocessing.pool.ThreadPool(
+                    self.max_concurrency)
+            return self._hedge_pool
+
+    def close(self):
+        """See the docstring of :meth:`ChunkStore.close`."""
+        self._hedge_scheduler.close()
+        with self._io_pool_lock:
+            pools = [self._io_pool, self._hedge_pool]
+            self._io_pool = self._hedge_pool = None
+        for pool in pools:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        super(S3ChunkStore, self).close()
+
+    def get_chunk_async(self, array_name, slices, dtype, callback=None):
+        """Start getting chunk from the store and return without waiting.
+
+        See :meth:`get_chunk` for the parameters and exceptions.
+
+        Parameters
+        ----------
+        callback : callable, optional
+            Function called with the chunk once it arrives (this should
+            return quickly and not make further requests to the store)
+
+        Returns
+        -------
+        result : :class:`multiprocessing.pool.AsyncResult` object
+            Deferred result whose :meth:`get` method returns the chunk
+            (or raises the error encountered while retrieving it)
+        """
+        return self._io_threads().apply_async(
+            self.get_chunk, (array_name, slices, dtype), callback=callback)
+
+    def put_chunk_async(self, array_name, slices, chunk, callback=None,
+                        **kwargs):
+        """Start putting chunk into the store and return without waiting.
+
+        See :meth:`put_chunk` for the parameters and exceptions.
+
+        Parameters
+        ----------
+        callback : callable, optional
+            Function called with None once the chunk is stored (this should
+            return quickly and not make further requests to the store)
+
+        Returns
+        -------
+        result : :class:`multiprocessing.pool.AsyncResult` object
+            Deferred result whose :meth:`get` method waits for completion
+            (and raises the error encountered while storing the chunk)
+        """
+        return self._io_threads().apply_async(
+            self.put_chunk, (array_name, slices, chunk), kwargs,
+            callback=callback)
+
+    def get_chunks_noraise(self, array_name, slices_list, dtype):
+        """See the docstring of :meth:`ChunkStore.get_chunks_noraise`.
+
+        The chunks are retrieved by the shared pool of I/O threads.
+        """
+        def get(slices):
+            """Get a chunk from the store but return errors as well."""
+            try:
+                return self.get_chunk(array_name, slices, dtype)
+            except ChunkStoreError as err:
+                return err
+        if len(slices_list) <= 1:
+            return [get(slices) for slices in slices_list]
+        return self._io_threads().map(get, slices_list, chunksize=1)
+
+    def _chunk_path(self, chunk_name):
+        return urllib.quote(chunk_name + '.npy')
+
+    def _backoff(self, retry):
+        """Random delay before retry number `retry` (counting from 0)."""
+        return random.uniform(0., min(self.backoff_max,
+                                      self.backoff_factor * 2 ** retry))
+
+    def check_endpoints(self):
+        """Probe all endpoints and only use the responsive ones from now on.
+
+        Returns
+        -------
+        healthy : list of bool
+            True for each endpoint (in order of :attr:`urls`) that is available
+        """
+        healthy = []
+        for endpoint in self._endpoints:
+            error = endpoint.check()
+            if error:
+                logger.warning('S3 endpoint %s is unavailable: %s',
+                               endpoint.url, error)
+                endpoint.mark_down(self.health_check_interval)
+            healthy.append(error is None)
+        return healthy
 
     @contextlib.contextmanager
-    def _request(self, chunk_name, method, url, *args, **kwargs):
-        """Run a request on a session from the pool, raising HTTP errors"""
-        with self._standard_errors(chunk_name), self._session_pool() as session:
-            with contextlib.closing(session.request(method, url, *args, **kwargs)) as response:
-                _raise_for_status(response)
-                yield response
+    def _endpoint(self, avoid=None):
+        """Pick the healthy endpoint with the fewest outstanding requests."""
+        with self._io_pool_lock:
+            candidates = [e for e in self._endpoints if e.healthy] or self._endpoints
+            if len(candidates) > 1 and avoid in candidates:
+                candidates.remove(avoid)
+            fewest = min(e.outstanding for e in candidates)
+            endpoint = random.choice([e for e in candidates
+                                      if e.outstanding == fewest])
+            endpoint.outstanding += 1
+        try:
+            yield endpoint
+        finally:
+            with self._io_pool_lock:
+                endpoint.outstanding -= 1
+
+    @contextlib.contextmanager
+    def _request(self, chunk_name, method, path, *args, **kwargs):
+        """Run a request on a session from the pool, raising HTTP errors.
+
+        The `path` is relative to the base URL of the chosen endpoint.
+        Transient server and connection errors are retried with exponential
+        backoff on another endpoint if possible, and an endpoint that does not
+        respond at all is avoided for a while.
+        """
+        data = kwargs.get('data')
+        endpoint = None
+        with self._standard_errors(chunk_name):
+            for retry in itertools.count():
+                with self._endpoint(avoid=endpoint) as endpoint:
+                    url = urlparse.urljoin(endpoint.url, path)
+                    with endpoint.sessions() as session:
+                        try:
+                            response = session.request(method, url,
+                                                       *args, **kwargs)
+                        except requests.exceptions.ConnectionError:
+                            endpoint.mark_down(self.health_check_interval)
+                            if retry >= self.max_retries:
+                                raise
+                        else:
+                            if response.status_code not in _RETRY_STATUS or \
+                               retry >= self.max_retries:
+                                with contextlib.closing(response):
+                                    _raise_for_status(response)
+                                    yield response
+                                return
+                            response.close()
+                with self._io_pool_lock:
+                    self.retries += 1
+                self._count('retries')
+                time.sleep(self._backoff(retry))
+                # Rewind file-like request body, which has been consumed
+                if hasattr(data, 'seek'):
+                    data.seek(0)
+
+    def _add_latency(self, array_name, latency):
+        """Record the duration of a chunk retrieval of array `array_name`."""
+        with self._io_pool_lock:
+            tracker = self.latency.get(array_name)
+            if tracker is None:
+                tracker = self.latency[array_name] = _LatencyTracker()
+        tracker.add(latency)
+
+    def _hedge_delay(self, array_name):
+        """Time after which a chunk retrieval is hedged (None if disabled)."""
+        if self.hedge_percentile is None:
+            return None
+        with self._io_pool_lock:
+            tracker = self.latency.get(array_name)
+        if tracker is None:
+            return None
+        return tracker.percentile(self.hedge_percentile)
+
+    def _read_chunk(self, array_name, slices, dtype, out, retrieval=None):
+        """Read chunk into `out` via a single GET request.
+
+        The latency of the request is recorded. If a hedged `retrieval` is
+        given, the response is registered with it so that it can be aborted.
+        """
+        start = time.time()
+        chunk_name, shape = self.chunk_metadata(array_name, slices, dtype=dtype)
+        path = self._chunk_path(chunk_name)
+        with self._request(chunk_name, 'GET', path, stream=True) as response:
+            if retrieval is None:
+                self._read_response(response, chunk_name, shape, dtype, out)
+            else:
+                with retrieval.original(response):
+                    self._read_response(response, chunk_name, shape, dtype,
+                                        out)
+        self._add_latency(array_name, time.time() - start)
+
+    @staticmethod
+    def _read_response(response, chunk_name, shape, dtype, out):
+        """Check header of streamed chunk in `response` and read it into `out`."""
+        data = response.raw
+        header = read_chunk_header(data)
+        chunk_shape, fortran_order, chunk_dtype, codec = header
+        if chunk_shape != shape or chunk_dtype != dtype:
+            raise BadChunk('Chunk {!r}: dtype {} and/or shape {} in store '
+                           'differs from expected dtype {} and shape {}'
+                           .format(chunk_name, chunk_dtype, chunk_shape,
+                                   dtype, shape))
+        read_chunk_into(data, out, fortran_order, dtype, codec)
 
+    def _hedged_read_chunk(self, array_name, slices, dtype, out, delay):
+        """Read chunk into `out`, duplicating the request after `delay` s."""
+        retrieval = _HedgedRetrieval()
+
+        def duplicate():
+            """Get chunk via another request and hand it to the original."""
+            retrieval.start()
+            with self._io_pool_lock:
+                self.hedges += 1
+            self._count('hedges')
+            try:
+                chunk = np.empty(out.shape, dtype)
+                self._read_chunk(array_name, slices, dtype, chunk)
+            except BaseException:
+                retrieval.finish(exc_info=sys.exc_info())
+            else:
+                retrieval.finish(chunk)
+
+        def dispatch():
+            """Start the duplicate request on a hedge thread."""
+            self._hedge_threads().apply_async(duplicate)
+
+        hedge = self._hedge_scheduler.schedule(delay, dispatch)
+        exc_info = None
+        try:
+            self._read_chunk(array_name, slices, dtype, out, retrieval)
+        except BaseException:
+            exc_info = sys.exc_info()
+        finally:
+            self._hedge_scheduler.cancel(hedge)
+        # Use the first successful attempt, or else the last error
+        if exc_info is not None and retrieval.started:
+            retrieval.done.wait()
+            exc_info = retrieval.exc_info
+        if retrieval.won:
+            out[()] = retrieval.chunk
+        elif exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    @_instrumented('get')
     def get_chunk(self, array_name, slices, dtype):
         """See the docstring of :meth:`ChunkStore.get_chunk`."""
         dtype = np.dtype(dtype)
+        _, shape = self.chunk_metadata(array_name, slices, dtype=dtype)
+        chunk = np.empty(shape, dtype)
+        self._get_chunk_into(array_name, slices, dtype, chunk)
+        return chunk
+
+    @_instrumented('get')
+    def get_chunk_into(self, array_name, slices, dtype, out):
+        """See the docstring of :meth:`ChunkStore.get_chunk_into`.
+
+        This streams the response body straight into `out` after parsing the
+        NPY header, without assembling a temporary chunk first.
+        """
+        dtype = np.dtype(dtype)
+        self.chunk_metadata(array_name, slices, chunk=out, dtype=dtype)
+        self._get_chunk_into(array_name, slices, dtype, out)
+
+    def _get_chunk_into(self, array_name, slices, dtype, out):
+        """Read chunk into `out`, hedging the request if it is enabled."""
+        delay = self._hedge_delay(array_name)
+        if delay is None:
+            self._read_chunk(array_name, slices, dtype, out)
+        else:
+            self._hedged_read_chunk(array_name, slices, dtype, out, delay)
+
+    # Merge byte ranges of partial reads if they are this close together
+    region_max_gap = 2 ** 18
+    # Maximum number of separate HTTP Range requests of a partial read
+    region_max_ranges = 8
+    # Number of bytes at the start of a chunk requested to parse its header
+    region_header_bytes = 4096
+
+    def _get_range(self, chunk_name, path, start, stop):
+        """Get bytes `start` to `stop` (exclusive) of object at `path`.
+
+        Returns the bytes and True if the server honoured the byte range
+        (otherwise the bytes contain the entire object instead).
+        """
+        headers = {'Range': 'bytes={}-{}'.format(start, stop - 1)}
+        with self._request(chunk_name, 'GET', path, headers=headers) as response:
+            return response.content, response.status_code == 206
+
+    @_instrumented('get')
+    def get_chunk_region(self, array_name, slices, dtype, subregion):
+        """See the docstring of :meth:`ChunkStore.get_chunk_region`.
+
+        If the region occupies a few contiguous byte ranges that are a small
+        part of the chunk, this fetches the start of the chunk to parse its
+        header and then only requests those byte ranges via HTTP Range
+        requests (provided that the chunk is uncompressed and in C order).
+        Otherwise the entire chunk is retrieved straight away.
+        """
+        dtype = np.dtype(dtype)
         chunk_name, shape = self.chunk_metadata(array_name, slices, dtype=dtype)
-        url = self._chunk_url(chunk_name)
-        with self._request(chunk_name, 'GET', url, stream=True) as response:
-            data = response.raw
-            chunk = np.lib.format.read_array(data, allow_pickle=False)
-        if chunk.shape != shape or chunk.dtype != dtype:
+        region = _normalise_region(shape, subregion)
+        # Plan assumes C order, which is checked once the header is available
+        ranges = _plan_region(shape, dtype, region, self.region_max_gap,
+                              self.region_max_ranges)
+        if ranges is None:
+            return self.get_chunk(array_name, slices, dtype)[region]
+        path = self._chunk_path(chunk_name)
+        prefix, partial = self._get_range(chunk_name, path, 0,
+                                          self.region_header_bytes)
+        fp = io.BytesIO(prefix)
+        try:
+            header = read_chunk_header(fp)
+        except ValueError as err:
+            raise BadChunk('Chunk {!r}: {}'.format(chunk_name, err))
+        chunk_shape, fortran_order, chunk_dtype, codec = header
+        if chunk_shape != shape or chunk_dtype != dtype:
             raise BadChunk('Chunk {!r}: dtype {} and/or shape {} in store '
                            'differs from expected dtype {} and shape {}'
-                           .format(chunk_name, chunk.dtype, chunk.shape,
+                           .format(chunk_name, chunk_dtype, chunk_shape,
                                    dtype, shape))
-        return chunk
+        data_offset = fp.tell()
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        if not partial or data_offset + nbytes <= len(prefix):
+            # We already have the entire chunk
+            chunk = np.empty(shape, dtype)
+            read_chunk_into(fp, chunk, fortran_order, dtype, codec)
+            _report_transferred_bytes(chunk.nbytes)
+            return chunk[region]
+        if codec is not None or fortran_order:
+            return self.get_chunk(array_name, slices, dtype)[region]
+
+        def read_into(offset, view):
+            """Read part of chunk into `view`, reusing the prefix if possible."""
+            start = data_offset + offset
+            stop = start + len(view)
+            if stop <= len(prefix):
+                data = prefix[start:stop]
+            else:
+                data, partial = self._get_range(chunk_name, path, start, stop)
+                if not partial:
+                    data = data[start:stop]
+            if len(data) != len(view):
+                raise BadChunk('Chunk {!r}: expected {} bytes at offset {}, '
+                               'got {} bytes instead'
+                               .format(chunk_name, len(view), start, len(data)))
+            view[:] = data
+
+        return _read_region(read_into, shape, dtype, region, ranges)
+
+    # Chunks bigger than this (in bytes) are stored via multipart uploads
+    multipart_threshold = 2 ** 26
+    # Size of each part of a multipart upload (S3 requires at least 5 MiB)
+    multipart_part_size = 2 ** 24
+    # Number of parts of a single multipart upload in flight at a time
+    multipart_concurrency = 4
+
+    def _put_multipart(self, chunk_name, path, body):
+        """Upload object in parts (in parallel) via S3 multipart upload API."""
+        NS = '{http://s3.amazonaws.com/doc/2006-03-01/}'
+        with self._request(chunk_name, 'POST', path,
+                           params={'uploads': ''}) as response:
+            root = defusedxml.cElementTree.fromstring(response.content)
+        upload_id = root.findtext(NS + 'UploadId')
+        if not upload_id:
+            raise StoreUnavailable('Chunk {!r}: could not start multipart '
+                                   'upload'.format(chunk_name))
+        part_size = self.multipart_part_size
+        parts = [(number, start, min(start + part_size, len(body)))
+                 for number, start in enumerate(range(0, len(body), part_size),
+                                                start=1)]
+
+        def upload_part(part):
+            """Upload a single part and return its ETag."""
+            number, start, stop = part
+            data = body.byte_range(start, stop)
+            params = {'partNumber': number, 'uploadId': upload_id}
+            headers = {'Content-MD5': data.md5()}
+            with self._request(chunk_name, 'PUT', path, params=params,
+                               headers=headers, data=data) as response:
+                return response.headers.get('ETag', '')
 
-    def put_chunk(self, array_name, slices, chunk):
-        """See the docstring of :meth:`ChunkStore.put_chunk`."""
+        try:
+            etags = _map_concurrently(upload_part, parts,
+                                      self.multipart_concurrency)
+            xml = ''.join('<Part><PartNumber>{}</PartNumber><ETag>{}</ETag>'
+                          '</Part>'.format(part[0], etag)
+                          for part, etag in zip(parts, etags))
+            xml = '<CompleteMultipartUpload>{}</CompleteMultipartUpload>' \
+                  .format(xml)
+            with self._request(chunk_name, 'POST', path,
+                               params={'uploadId': upload_id},
+                               data=xml) as response:
+                root = defusedxml.cElementTree.fromstring(response.content)
+            # S3 reports some failures in the body of a 200 OK response
+            if root.tag.endswith('Error'):
+                raise StoreUnavailable('Chunk {!r}: multipart upload failed: '
+                                       '{}'.format(chunk_name,
+                                                   root.findtext('Message')))
+        except BaseException:
+            exc_info = sys.exc_info()
+            # Abort the upload so that its parts don't use up space forever
+            try:
+                with self._request(chunk_name, 'DELETE', path,
+                                   params={'uploadId': upload_id}):
+                    pass
+            except ChunkStoreError as err:
+                logger.warning('Could not abort multipart upload of chunk '
+                               '%r: %s', chunk_name, err)
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    @_instrumented('put')
+    def put_chunk(self, array_name, slices, chunk, codec=None,
+                  elide_constant=False):
+        """See the docstring of :meth:`ChunkStore.put_chunk`.
+
+        The NPY header and array data are streamed straight from memory as the
+        request body, instead of first being assembled into a single string.
+        Chunks bigger than :attr:`multipart_threshold` are uploaded in parts
+        of :attr:`multipart_part_size` bytes, which are sent in parallel.
+        """
         chunk_name, _ = self.chunk_metadata(array_name, slices, chunk=chunk)
-        url = self._chunk_url(chunk_name)
-        fp = io.BytesIO()
-        np.lib.format.write_array(fp, chunk, allow_pickle=False)
-        md5 = base64.b64encode(hashlib.md5(fp.getvalue()).digest())
-        fp.seek(0)
-        headers = {'Content-MD5': md5}
-        with self._request(chunk_name, 'PUT', url, headers=headers, data=fp):
+        path = self._chunk_path(chunk_name)
+        body = _BufferStream(chunk_buffers(chunk, codec, elide_constant))
+        if len(body) > self.multipart_threshold:
+            self._put_multipart(chunk_name, path, body)
+            return
+        headers = {'Content-MD5': body.md5()}
+        with self._request(chunk_name, 'PUT', path, headers=headers,
+                           data=body):
             pass
 
+    @_instrumented('has')
     def has_chunk(self, array_name, slices, dtype):
         """See the docstring of :meth:`ChunkStore.has_chunk`."""
         dtype = np.dtype(dtype)
         chunk_name, _ = self.chunk_metadata(array_name, slices, dtype=dtype)
-        url = self._chunk_url(chunk_name)
+        path = self._chunk_path(chunk_name)
         try:
-            with self._request(chunk_name, 'HEAD', url):
+            with self._request(chunk_name, 'HEAD', path):
                 pass
         except ChunkNotFound:
             return False
@@ -259,11 +1052,9 @@ class S3ChunkStore(ChunkStore):
 
     list_max_keys = 100000
 
-    def list_chunk_ids(self, array_name):
-        """See the docstring of :meth:`ChunkStore.list_chunk_ids`."""
+    def _list_keys(self, path, prefix):
+        """List all keys in bucket at `path` that start with `prefix`."""
         NS = '{http://s3.amazonaws.com/doc/2006-03-01/}'
-        bucket, prefix = self.split(array_name, 1)
-        url = urlparse.urljoin(self._url, urllib.quote(bucket))
         params = {
             'prefix': prefix,
             'max-keys': self.list_max_keys
@@ -272,24 +1063,43 @@ class S3ChunkStore(ChunkStore):
         keys = []
         more = True
         while more:
-            with self._request(None, 'GET', url, params=params) as response:
+            with self._request(None, 'GET', path, params=params) as response:
                 root = defusedxml.cElementTree.fromstring(response.content)
             keys.extend(child.text for child in root.iter(NS + 'Key'))
             truncated = root.find(NS + 'IsTruncated')
             more = (truncated is not None and truncated.text == 'true')
             if more:
                 next_marker = root.find(NS + 'NextMarker')
-                if next_marker:
+                if next_marker is not None:
                     params['marker'] = next_marker.text
                 elif keys:
                     params['marker'] = keys[-1]
                 else:
                     warnings.warn('Result had no keys but was marked as truncated')
                     more = False
-        # Strip the array name and .npy extension to get the chunk ID string
-        return [key[len(prefix) + 1:-4] for key in keys if key.endswith('.npy')]
+        return keys
+
+    @_instrumented('list')
+    def list_chunk_ids(self, array_name, prefixes=None):
+        """See the docstring of :meth:`ChunkStore.list_chunk_ids`.
+
+        Each prefix is listed separately by the shared pool of I/O threads,
+        which speeds up the listing of large arrays considerably.
+        """
+        bucket, path = self.split(array_name, 1)
+        key_prefixes = [self.join(path, prefix)
+                        for prefix in (prefixes if prefixes else [''])]
+        list_keys = functools.partial(self._list_keys, urllib.quote(bucket))
+        if len(key_prefixes) <= 1:
+            key_lists = [list_keys(prefix) for prefix in key_prefixes]
+        else:
+            key_lists = self._io_threads().map(list_keys, key_prefixes,
+                                               chunksize=1)
+        # Strip the array name and .npy extension to get the chunk ID string,
+        # skipping objects further down the hierarchy (like the manifest)
+        chunk_ids = (key[len(path) + 1:-4] for key in itertools.chain(*key_lists)
+                     if key.endswith('.npy'))
+        return [chunk_id for chunk_id in chunk_ids if self.NAME_SEP not in chunk_id]
 
     get_chunk.__doc__ = ChunkStore.get_chunk.__doc__
-    put_chunk.__doc__ = ChunkStore.put_chunk.__doc__
     has_chunk.__doc__ = ChunkStore.has_chunk.__doc__
-    list_chunk_ids.__doc__ = ChunkStore.list_chunk_ids.__doc__
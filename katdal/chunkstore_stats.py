@@ -0,0 +1,241 @@
+################################################################################
+# Copyright (c) 2018, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Throughput and latency statistics of chunk store operations.
+
+Instrumentation is opt-in: a chunk store only reports its operations once a
+:class:`ChunkStoreStats` object is assigned to its `stats` attribute, which
+is most easily done for a block of code via :func:`collect_stats`, e.g.
+
+  with collect_stats(store) as stats:
+      vis = d.vis[:100]
+  print(stats.to_prometheus())
+
+Comparing the total time spent in chunk store operations with the elapsed
+time of the block shows whether the code is I/O bound or CPU bound.
+"""
+
+import bisect
+import collections
+import contextlib
+import threading
+import time
+
+
+class ChunkStoreStats(object):
+    """Counters and latency histograms of chunk store operations.
+
+    Each operation is identified by the name of the chunk store class that
+    performed it and the type of operation ('get', 'put', 'has' or 'list').
+    For each operation there is a count of requests, the number of bytes of
+    chunk data transferred by successful requests (as stored in memory, i.e.
+    before compression), a histogram of request latencies and a count of
+    errors by exception type. Stores also count other events, such as cache
+    hits and misses or retries. All methods are thread-safe.
+    """
+
+    # Upper bounds of latency histogram buckets, in seconds
+    LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                       0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.,
+                       float('inf'))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clear all statistics and restart the clock."""
+        with self._lock:
+            self.requests = collections.Counter()
+            self.nbytes = collections.Counter()
+            self.latency = collections.Counter()
+            self.histograms = {}
+            self.errors = collections.Counter()
+            self.events = collections.Counter()
+            self.start_time = time.time()
+            self.stop_time = None
+
+    def stop(self):
+        """Stop the clock that measures elapsed time."""
+        self.stop_time = time.time()
+
+    @property
+    def elapsed(self):
+        """Time since statistics were (re)started, up to when they stopped."""
+        stop_time = self.stop_time if self.stop_time else time.time()
+        return stop_time - self.start_time
+
+    def record(self, store, op, duration, nbytes=0, error=None):
+        """Record a single chunk store operation.
+
+        Parameters
+        ----------
+        store : string
+            Name of chunk store (class) that performed the operation
+        op : string
+            Type of operation, e.g. 'get', 'put', 'has' or 'list'
+        duration : float
+            Latency of operation, in seconds
+        nbytes : int, optional
+            Number of bytes of chunk data transferred
+        error : :class:`Exception` object, optional
+            Error raised by operation, if it failed
+        """
+        key = (store, op)
+        bucket = bisect.bisect_left(self.LATENCY_BUCKETS, duration)
+        with self._lock:
+            self.requests[key] += 1
+            self.latency[key] += duration
+            histogram = self.histograms.setdefault(
+                key, len(self.LATENCY_BUCKETS) * [0])
+            histogram[bucket] += 1
+            if error is None:
+                self.nbytes[key] += nbytes
+            else:
+                self.errors[key + (type(error).__name__,)] += 1
+
+    def increment(self, store, event, n=1):
+        """Count `n` occurrences of `event` (e.g. 'cache_hits') in `store`."""
+        with self._lock:
+            self.events[(store, event)] += n
+
+    def to_dict(self):
+        """Export statistics as a plain nested dict.
+
+        Returns
+        -------
+        stats : dict
+            Dict with 'elapsed' time (in seconds) and 'stores', which maps the
+            name of each store to a dict with 'operations' and 'events'. The
+            former maps the type of each operation to a dict of 'requests',
+            'bytes', 'latency' (total seconds), 'latency_histogram' (list of
+            (upper bound, count) pairs) and 'errors' (count per error type),
+            while the latter maps each event to its count.
+        """
+        with self._lock:
+            stores = collections.defaultdict(lambda: {'operations': {},
+                                                      'events': {}})
+            for (store, op), requests in self.requests.items():
+                histogram = zip(self.LATENCY_BUCKETS,
+                                self.histograms[(store, op)])
+                stores[store]['operations'][op] = {
+                    'requests': requests,
+                    'bytes': self.nbytes[(store, op)],
+                    'latency': self.latency[(store, op)],
+                    'latency_histogram': histogram,
+                    'errors': {}
+                }
+            for (store, op, error), count in self.errors.items():
+                stores[store]['operations'][op]['errors'][error] = count
+            for (store, event), count in self.events.items():
+                stores[store]['events'][event] = count
+        return {'elapsed': self.elapsed, 'stores': dict(stores)}
+
+    def to_prometheus(self, prefix='katdal_chunkstore'):
+        """Export statistics in the Prometheus text exposition format.
+
+        Parameters
+        ----------
+        prefix : string, optional
+            Prefix of all metric names
+
+        Returns
+        -------
+        text : string
+            Metrics, one sample per line
+        """
+        lines = []
+
+        def metric(name, kind, description, samples):
+            """Add metric and its (suffix, labels, value) samples."""
+            name = prefix + '_' + name
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for suffix, labels, value in samples:
+                labels = ','.join('{}="{}"'.format(*label) for label in labels)
+                lines.append('{}{}{{{}}} {!r}'.format(name, suffix, labels,
+                                                      value))
+
+        with self._lock:
+            ops = sorted(self.requests)
+            metric('requests_total', 'counter',
+                   'Number of chunk store operations',
+                   [('', (('store', key[0]), ('op', key[1])),
+                     self.requests[key]) for key in ops])
+            metric('bytes_total', 'counter',
+                   'Bytes of chunk data transferred by chunk store operations',
+                   [('', (('store', key[0]), ('op', key[1])),
+                     self.nbytes[key]) for key in ops])
+            metric('errors_total', 'counter',
+                   'Number of failed chunk store operations',
+                   [('', (('store', store), ('op', op), ('error', error)), n)
+                    for (store, op, error), n in sorted(self.errors.items())])
+            metric('events_total', 'counter',
+                   'Number of other chunk store events (e.g. cache hits)',
+                   [('', (('store', store), ('event', event)), n)
+                    for (store, event), n in sorted(self.events.items())])
+            samples = []
+            for key in ops:
+                store, op = key
+                labels = (('store', store), ('op', op))
+                cumulative = 0
+                for bound, count in zip(self.LATENCY_BUCKETS,
+                                        self.histograms[key]):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    samples.append(('_bucket', labels + (('le', le),),
+                                    cumulative))
+                samples.append(('_count', labels, self.requests[key]))
+                samples.append(('_sum', labels, self.latency[key]))
+            metric('latency_seconds', 'histogram',
+                   'Latency of chunk store operations', samples)
+        elapsed = prefix + '_elapsed_seconds'
+        lines.append('# HELP {} Time spent collecting statistics'
+                     .format(elapsed))
+        lines.append('# TYPE {} gauge'.format(elapsed))
+        lines.append('{} {!r}'.format(elapsed, self.elapsed))
+        return '\n'.join(lines) + '\n'
+
+
+@contextlib.contextmanager
+def collect_stats(*stores):
+    """Collect statistics of chunk store operations in a block of code.
+
+    This temporarily assigns a fresh :class:`ChunkStoreStats` object to the
+    `stats` attribute of each store, which is then shared by the stores.
+    Stores that wrap other stores (like caches) only report their own
+    operations, so also pass the underlying stores if they are of interest.
+
+    Parameters
+    ----------
+    stores : :class:`~katdal.chunkstore.ChunkStore` objects
+        Chunk stores to instrument
+
+    Yields
+    ------
+    stats : :class:`ChunkStoreStats` object
+        Statistics, which stop accumulating when the block is done
+    """
+    stats = ChunkStoreStats()
+    previous = [store.stats for store in stores]
+    for store in stores:
+        store.stats = stats
+    try:
+        yield stats
+    finally:
+        stats.stop()
+        for store, old_stats in zip(stores, previous):
+            store.stats = old_stats
@@ -19,14 +19,22 @@
 import urlparse
 import os
 import logging
+import operator
+import itertools
+import functools
+import threading
+import uuid
 
 import katsdptelstate
 import numpy as np
+import dask
 import dask.array as da
 
 from .sensordata import TelstateSensorData
+from .chunkstore import ChunkNotFound, _scalar_to_chunk
 from .chunkstore_s3 import S3ChunkStore
 from .chunkstore_npy import NpyFileChunkStore
+from .chunkstore_cache import DiskCachingChunkStore
 
 
 logger = logging.getLogger(__name__)
@@ -83,11 +91,166 @@ class VisFlagsWeights(object):
     def shape(self):
         return self.vis.shape
 
+    def masked_flags(self, flagmask):
+        """Flags with only the bits in `flagmask` kept (the rest are zeroed).
 
-def _has_chunk_to_flags(has_chunk, block_id, full_chunks):
-    """Turn a has_chunk bool into chunk of flags with correct data_lost bit."""
-    shape = tuple(chk[idx] for chk, idx in zip(full_chunks, block_id))
-    return np.full(shape, 0 if has_chunk else 8, dtype=np.uint8)
+        Data sources that store flag bits separately may override this to
+        only load the selected bits.
+        """
+        return da.bitwise_and(np.uint8(flagmask), self.flags)
+
+
+# The 'data_lost' flag bit, set on data with missing chunks
+DATA_LOST = 8
+
+
+def _flags_or_data_lost(get_chunk, array_name, slices, dtype):
+    """Get chunk of flags, with 'data_lost' set everywhere if it is missing."""
+    try:
+        return get_chunk(array_name, slices, dtype)
+    except ChunkNotFound:
+        shape = tuple(s.stop - s.start for s in slices)
+        return np.full(shape, DATA_LOST, dtype)
+
+
+def _flag_plane_slices(slices):
+    """Chunk ID of bit plane of flags chunk identified by `slices`.
+
+    The bit plane is packed along the last dimension, with 8 flags per byte,
+    and shares its chunk ID string with the original flags chunk.
+    """
+    last = slices[-1]
+    packed_size = (last.stop - last.start + 7) // 8
+    return tuple(slices[:-1]) + (slice(last.start, last.start + packed_size),)
+
+
+def _flag_plane_name(store, array_name, bit):
+    """Array name of bit plane containing flag `bit` of flags `array_name`."""
+    return store.join(array_name, 'bit{}'.format(bit))
+
+
+def _get_flags_from_planes(store, bits, array_name, slices, dtype):
+    """Get chunk of flags assembled from the bit planes of the given `bits`.
+
+    The other flag bits are zero. If any of the bit planes are missing, the
+    flags chunk is considered missing.
+    """
+    shape = tuple(s.stop - s.start for s in slices)
+    flags = np.zeros(shape, dtype)
+    plane_slices = _flag_plane_slices(slices)
+    for bit in bits:
+        plane_name = _flag_plane_name(store, array_name, bit)
+        plane = store.get_chunk(plane_name, plane_slices, np.uint8)
+        plane = np.unpackbits(plane, axis=-1)[..., :shape[-1]]
+        flags |= plane << np.uint8(bit)
+    return flags
+
+
+def _put_flag_planes(store, bits, put_kwargs, array_name, slices, chunk):
+    """Put bit planes of flags chunk into store, returning any exception."""
+    plane_slices = _flag_plane_slices(slices)
+    for bit in bits:
+        plane = np.packbits((chunk >> np.uint8(bit)) & 1, axis=-1)
+        plane_name = _flag_plane_name(store, array_name, bit)
+        error = store.put_chunk_noraise(plane_name, plane_slices, plane,
+                                        **put_kwargs)
+        if error is not None:
+            return error
+    return None
+
+
+def put_flag_planes(store, array_name, flags, bits=range(8), **kwargs):
+    """Put flags into the store as separate bit planes (one per flag bit).
+
+    Each flag bit is stored as a bitmap in its own array, packed along the
+    last dimension. Flag bits that are rarely set result in sparse planes that
+    compress well, while readers that only select a few flag types only need
+    to load the corresponding planes. Record `bits` as the 'bit_planes' entry
+    of the flags chunk info so that :class:`ChunkStoreVisFlagsWeights` can
+    find the planes.
+
+    Parameters
+    ----------
+    store : :class:`ChunkStore` object
+        Chunk store
+    array_name : string
+        Identifier of flags array in chunk store
+    flags : :class:`dask.array.Array` object of uint8
+        Dask array of flags
+    bits : sequence of int, optional
+        The flag bits to store (the rest are discarded)
+    kwargs : dict, optional
+        Extra keyword arguments are passed on to :meth:`ChunkStore.put_chunk`
+        for each bit plane chunk (e.g. `codec` and `elide_constant`, as most
+        planes of a clean dataset are all zeros)
+
+    Returns
+    -------
+    success : :class:`dask.array.Array` object
+        Dask array of objects indicating success of transfer of each chunk
+        (None indicates success, otherwise there is an exception object)
+    """
+    out_name = 'store-planes-{}-{}'.format(array_name, uuid.uuid4().hex)
+    put = functools.partial(_put_flag_planes, store, tuple(bits), kwargs)
+    put = _scalar_to_chunk(put)
+    graph = da.core.getem(array_name, flags.chunks, put, out_name=out_name)
+    # Set chunk parameter of put function to corresponding key in flags
+    graph = {k: v + ((flags.name,) + k[1:],) for k, v in graph.items()}
+    dask_graph = dask.sharedict.ShareDict()
+    dask_graph.update(flags.dask)
+    dask_graph.update(graph)
+    out_chunks = tuple(len(c) * (1,) for c in flags.chunks)
+    return da.Array(dask_graph, out_name, out_chunks, np.object)
+
+
+def _has_chunk_to_flags(has_chunk, array_name, slices, dtype):
+    """Check presence of chunk and turn it into flags with data_lost bit."""
+    shape = tuple(s.stop - s.start for s in slices)
+    lost = 0 if has_chunk(array_name, slices, dtype) else DATA_LOST
+    return np.full(shape, lost, dtype=np.uint8)
+
+
+class _ChunkListing(object):
+    """Presence of the chunks of a stored array, found by a single listing.
+
+    The array is only listed once the presence of one of its chunks is first
+    needed (i.e. when the corresponding flags are computed), via
+    :meth:`ChunkStore.has_array`, which lists the chunks in parallel by
+    chunk ID prefix. Stores that cannot list their chunks are asked about
+    each chunk instead.
+    """
+
+    def __init__(self, store, chunks):
+        self.store = store
+        self._offsets = [np.cumsum((0,) + tuple(c)) for c in chunks]
+        self._chunks = chunks
+        self._present = None
+        self._lock = threading.Lock()
+
+    def has_chunk(self, array_name, slices, dtype):
+        """See the docstring of :meth:`ChunkStore.has_chunk`."""
+        with self._lock:
+            if self._present is None:
+                try:
+                    self._present = self.store.has_array(array_name,
+                                                         self._chunks)
+                except NotImplementedError:
+                    self._present = False
+        if self._present is False:
+            return self.store.has_chunk(array_name, slices, dtype)
+        index = tuple(np.searchsorted(offsets, s.start)
+                      for offsets, s in zip(self._offsets, slices))
+        return bool(self._present[index])
+
+
+def _manifest_to_flags(manifest, name, chunks):
+    """Turn missing chunks in array manifest into dask array of flags."""
+    graph = {}
+    for index in itertools.product(*[range(len(c)) for c in chunks]):
+        shape = tuple(c[i] for (c, i) in zip(chunks, index))
+        lost = 0 if manifest['present'][index] else DATA_LOST
+        graph[(name,) + index] = (np.full, shape, lost, np.uint8)
+    return da.Array(graph, name, chunks, np.uint8)
 
 
 def _multi_or_3d(*args):
@@ -99,6 +262,72 @@ def _multi_or_3d(*args):
     return out
 
 
+def _get_block(get_chunk, array_name, chunks, dtype, slices):
+    """Get block of stored array, which may straddle several of its chunks.
+
+    Returns the block along with a flag that indicates whether any of the
+    chunks that it overlaps are missing from the store (replaced by zeros).
+    """
+    # Find the chunks overlapping the block and the overlap per dimension
+    overlaps_per_dim = []
+    for s, dim_chunks in zip(slices, chunks):
+        offsets = np.cumsum((0,) + tuple(dim_chunks))
+        first = np.searchsorted(offsets, s.start, side='right') - 1
+        last = np.searchsorted(offsets, s.stop, side='left')
+        overlaps = []
+        for n in range(first, max(last, first + 1)):
+            chunk_start, chunk_stop = int(offsets[n]), int(offsets[n + 1])
+            start, stop = max(chunk_start, s.start), min(chunk_stop, s.stop)
+            overlaps.append((slice(chunk_start, chunk_stop),
+                             slice(start - chunk_start, stop - chunk_start),
+                             slice(start - s.start, stop - s.start)))
+        overlaps_per_dim.append(overlaps)
+    block = None
+    data_lost = False
+    for overlaps in itertools.product(*overlaps_per_dim):
+        chunk_slices, in_chunk, in_block = zip(*overlaps)
+        try:
+            chunk = get_chunk(array_name, chunk_slices, dtype)
+        except ChunkNotFound:
+            chunk = None
+            data_lost = True
+        if chunk is not None and chunk_slices == tuple(slices):
+            # The block is a single chunk in the store (the common case)
+            return chunk, data_lost
+        if block is None:
+            block = np.zeros(tuple(s.stop - s.start for s in slices), dtype)
+        if chunk is not None:
+            block[in_block] = chunk[in_chunk]
+    return block, data_lost
+
+
+def _get_vis_flags_weights(store, base_name, chunk_info, slices):
+    """Get visibilities, flags and weights of a single block in one go.
+
+    This retrieves the corresponding parts of all four stored arrays, sets
+    the 'data_lost' flag on the block if any of their chunks are missing and
+    combines the two types of weights, returning (vis, flags, weights).
+    """
+    blocks = {}
+    data_lost = False
+    for array in ('correlator_data', 'flags', 'weights', 'weights_channel'):
+        info = chunk_info[array]
+        array_name = store.join(base_name, array)
+        array_slices = tuple(slices[:len(info['shape'])])
+        get_chunk = store.get_chunk
+        if 'bit_planes' in info:
+            get_chunk = functools.partial(_get_flags_from_planes, store,
+                                          info['bit_planes'])
+        blocks[array], lost = _get_block(get_chunk, array_name, info['chunks'],
+                                         info['dtype'], array_slices)
+        data_lost = data_lost or lost
+    flags = blocks['flags']
+    if data_lost:
+        flags = flags | np.uint8(DATA_LOST)
+    weights = blocks['weights'] * blocks['weights_channel'][..., np.newaxis]
+    return blocks['correlator_data'], flags, weights
+
+
 class ChunkStoreVisFlagsWeights(VisFlagsWeights):
     """Correlator data stored in a chunk store.
 
@@ -109,33 +338,122 @@ class ChunkStoreVisFlagsWeights(VisFlagsWeights):
     base_name : string
         Name of dataset in store, as array name prefix (akin to a filename)
     chunk_info : dict mapping array name to info dict
-        Dict specifying dtype, shape and chunks per array
+        Dict specifying dtype, shape and chunks per array (and optionally the
+        codec that compressed its chunks, which is informational only as
+        stored chunks record their own codec)
+    fused : bool, optional
+        Load the visibilities, flags and weights of each chunk together in a
+        single task. This results in a much smaller dask graph if all three
+        are needed (e.g. for conversion to Measurement Set), but loads flags
+        and weights even if only visibilities are requested.
+
+    Notes
+    -----
+    If the flags info has a 'bit_planes' entry, the flags are stored as
+    separate bit planes (see :func:`put_flag_planes`) and
+    :meth:`masked_flags` only loads the planes of the selected flag bits.
     """
-    def __init__(self, store, base_name, chunk_info):
+    def __init__(self, store, base_name, chunk_info, fused=False):
         self.store = store
+        self._flags_name = store.join(base_name, 'flags')
+        self._flags_info = chunk_info['flags']
+        self._extra_flags = []
+        self._fused = fused
+        if fused:
+            self._init_fused(store, base_name, chunk_info)
+            return
         darray = {}
-        extra_flags = []
         for array, info in chunk_info.iteritems():
+            if array == 'flags':
+                continue
             array_name = store.join(base_name, array)
             chunk_args = (array_name, info['chunks'], info['dtype'])
             darray[array] = store.get_dask_array(*chunk_args)
-            # Find all missing chunks in array and convert to 'data_lost' flags
-            has_array = store.has_dask_array(*chunk_args)
-            chunks_lost = da.map_blocks(_has_chunk_to_flags, has_array,
-                                        token='missing-chunks-' + array_name,
-                                        chunks=info['chunks'], dtype=np.uint8,
-                                        full_chunks=info['chunks'])
-            extra_flags.append(chunks_lost)
-            extra_flags.append('ijk'[:chunks_lost.ndim])
+            lost_name = 'missing-chunks-' + array_name
+            try:
+                # The array manifest lists missing chunks in a single object
+                manifest = store.get_manifest(array_name, info['chunks'])
+            except ChunkNotFound:
+                # Check for missing chunks in other arrays only when the
+                # corresponding flags are actually computed (instead of
+                # listing all arrays up front) and convert them to flags
+                listing = _ChunkListing(store, info['chunks'])
+                has = functools.partial(_has_chunk_to_flags, listing.has_chunk,
+                                        dtype=info['dtype'])
+                graph = da.core.getem(array_name, info['chunks'], has,
+                                      out_name=lost_name)
+                chunks_lost = da.Array(graph, lost_name, info['chunks'],
+                                       np.uint8)
+            else:
+                chunks_lost = _manifest_to_flags(manifest, lost_name,
+                                                 info['chunks'])
+            self._extra_flags.append(chunks_lost)
+            self._extra_flags.append('ijk'[:chunks_lost.ndim])
         vis = darray['correlator_data']
-        # Combine original L0 flags with extras (missing chunks per array)
-        flags = da.atop(_multi_or_3d, 'ijk', darray['flags'], 'ijk',
-                        *extra_flags, token=store.join(base_name, 'flags_raw'),
-                        dtype=np.uint8)
+        flags = self._combined_flags(0xff)
         # Combine low-resolution weights and high-resolution weights_channel
         weights = darray['weights'] * darray['weights_channel'][..., np.newaxis]
         VisFlagsWeights.__init__(self, vis, flags, weights, base_name)
 
+    def _combined_flags(self, flagmask):
+        """Stored flags (only those in `flagmask` if possible) plus extras."""
+        info = self._flags_info
+        get_chunk = self.store.get_chunk
+        out_name = self._flags_name
+        if 'bit_planes' in info:
+            bits = [bit for bit in info['bit_planes'] if flagmask & (1 << bit)]
+            get_chunk = functools.partial(_get_flags_from_planes, self.store,
+                                          bits)
+            out_name += '-bits-' + ''.join(str(bit) for bit in bits)
+        # Missing flag chunks are detected while loading them
+        getter = functools.partial(_flags_or_data_lost, get_chunk,
+                                   dtype=info['dtype'])
+        graph = da.core.getem(self._flags_name, info['chunks'], getter,
+                              out_name=out_name)
+        flags = da.Array(graph, out_name, info['chunks'], info['dtype'])
+        if not self._extra_flags or not flagmask & DATA_LOST:
+            return flags
+        # Combine original L0 flags with extras (missing chunks per array)
+        return da.atop(_multi_or_3d, 'ijk', flags, 'ijk', *self._extra_flags,
+                       token=self._flags_name + '_raw', dtype=np.uint8)
+
+    def masked_flags(self, flagmask):
+        """See :meth:`VisFlagsWeights.masked_flags`.
+
+        Only the bit planes of the selected flags are loaded if the flags
+        are stored as bit planes, and only data lost to missing chunks in
+        other arrays is checked if the 'data_lost' flag is selected.
+        """
+        flagmask = np.uint8(flagmask)
+        if flagmask == 0xff:
+            return self.flags
+        if self._fused:
+            return VisFlagsWeights.masked_flags(self, flagmask)
+        return da.bitwise_and(flagmask, self._combined_flags(flagmask))
+
+    def _init_fused(self, store, base_name, chunk_info):
+        """Build vis, flags and weights on a common graph of loading tasks."""
+        vis_info = chunk_info['correlator_data']
+        chunks = vis_info['chunks']
+        fused_name = store.join(base_name, 'vis_flags_weights')
+        out_names = [store.join(fused_name, name)
+                     for name in ('vis', 'flags', 'weights')]
+        graph = {}
+        indices = itertools.product(*[range(len(c)) for c in chunks])
+        slices = da.core.slices_from_chunks(chunks)
+        for index, block_slices in zip(indices, slices):
+            fused_key = (fused_name,) + index
+            graph[fused_key] = (_get_vis_flags_weights, store, base_name,
+                                chunk_info, block_slices)
+            for n, out_name in enumerate(out_names):
+                graph[(out_name,) + index] = (operator.getitem, fused_key, n)
+        weights_dtype = np.result_type(chunk_info['weights']['dtype'],
+                                       chunk_info['weights_channel']['dtype'])
+        vis = da.Array(graph, out_names[0], chunks, vis_info['dtype'])
+        flags = da.Array(graph, out_names[1], chunks, np.uint8)
+        weights = da.Array(graph, out_names[2], chunks, weights_dtype)
+        VisFlagsWeights.__init__(self, vis, flags, weights, base_name)
+
 
 class DataSource(object):
     """A generic data source presenting both correlator data and metadata.
@@ -250,10 +568,30 @@ def _shorten_key(telstate, key):
     return ''
 
 
+def _to_bool(value):
+    """Interpret `value` as a boolean, also if it comes from a URL query."""
+    if not isinstance(value, basestring):
+        return bool(value)
+    try:
+        return {'0': False, '1': True,
+                'false': False, 'true': True}[value.lower()]
+    except KeyError:
+        raise ValueError('Expected boolean value like 0 / 1 or true / false, '
+                         'not {!r}'.format(value))
+
+
 def _infer_chunk_store(url_parts, telstate, npy_store_path=None,
-                       s3_endpoint_url=None, **kwargs):
+                       s3_endpoint_url=None, cache_dir=None, cache_size=None,
+                       timeout=None, extra_timeout=None, max_retries=None,
+                       backoff_factor=None, backoff_max=None,
+                       hedge_percentile=None, health_check_interval=None,
+                       **kwargs):
     """Construct chunk store automatically from dataset URL and telstate.
 
+    The S3 options may come from a URL query string, in which case they are
+    strings that are converted to numbers here. Options that are not provided
+    keep the defaults of :meth:`S3ChunkStore.from_url`.
+
     Parameters
     ----------
     url_parts : :class:`urlparse.ParseResult` object
@@ -262,8 +600,25 @@ def _infer_chunk_store(url_parts, telstate, npy_store_path=None,
         Telescope state
     npy_store_path : string, optional
         Top-level directory of NpyFileChunkStore (overrides the default)
-    s3_endpoint_url : string, optional
-        Endpoint of S3 service, e.g. 'http://127.0.0.1:9000' (overrides default)
+    s3_endpoint_url : string or sequence of string, optional
+        Endpoint of S3 service, e.g. 'http://127.0.0.1:9000' (overrides
+        default), or several equivalent endpoints as a sequence or a
+        comma-separated string
+    cache_dir : string, optional
+        Local directory in which to cache chunks retrieved from S3
+    cache_size : float or string, optional
+        Upper limit on size of `cache_dir`, in bytes (default is no limit)
+    timeout, extra_timeout : float or string, optional
+        Timeouts of S3 requests, in seconds (see :meth:`S3ChunkStore.from_url`)
+    max_retries : int or string, optional
+        Number of times an S3 request is retried after a transient error
+    backoff_factor, backoff_max : float or string, optional
+        Delays before retries, in seconds (see :class:`S3ChunkStore`)
+    hedge_percentile : float or string, optional
+        Percentile of recent latencies after which a chunk retrieval is
+        duplicated (hedging is disabled by default)
+    health_check_interval : float or string, optional
+        Time for which an unresponsive S3 endpoint is avoided, in seconds
     kwargs : dict, optional
         Extra keyword arguments, typically meant for other methods and ignored
 
@@ -282,17 +637,33 @@ def _infer_chunk_store(url_parts, telstate, npy_store_path=None,
     # Use overrides if provided, regardless of URL and telstate (NPY first)
     if npy_store_path:
         return NpyFileChunkStore(npy_store_path)
-    if s3_endpoint_url:
-        return S3ChunkStore.from_url(s3_endpoint_url, **kwargs)
-    # NPY chunk store is an option if the dataset is an RDB file
-    if url_parts.scheme == 'file':
-        # Look for adjacent data directory (presumably containing NPY files)
-        rdb_path = os.path.abspath(url_parts.path)
-        store_path = os.path.dirname(os.path.dirname(rdb_path))
-        data_path = os.path.join(store_path, telstate['chunk_name'])
-        if os.path.isdir(data_path):
-            return NpyFileChunkStore(store_path)
-    return S3ChunkStore.from_url(telstate['s3_endpoint_url'], **kwargs)
+    if not s3_endpoint_url:
+        # NPY chunk store is an option if the dataset is an RDB file
+        if url_parts.scheme == 'file':
+            # Look for adjacent data directory (presumably containing NPY files)
+            rdb_path = os.path.abspath(url_parts.path)
+            store_path = os.path.dirname(os.path.dirname(rdb_path))
+            data_path = os.path.join(store_path, telstate['chunk_name'])
+            if os.path.isdir(data_path):
+                return NpyFileChunkStore(store_path)
+        s3_endpoint_url = telstate['s3_endpoint_url']
+    if isinstance(s3_endpoint_url, basestring) and ',' in s3_endpoint_url:
+        s3_endpoint_url = s3_endpoint_url.split(',')
+    s3_options = [('timeout', timeout, float),
+                  ('extra_timeout', extra_timeout, float),
+                  ('max_retries', max_retries, int),
+                  ('backoff_factor', backoff_factor, float),
+                  ('backoff_max', backoff_max, float),
+                  ('hedge_percentile', hedge_percentile, float),
+                  ('health_check_interval', health_check_interval, float)]
+    s3_kwargs = {key: convert(value) for key, value, convert in s3_options
+                 if value is not None}
+    store = S3ChunkStore.from_url(s3_endpoint_url, **s3_kwargs)
+    if cache_dir:
+        # The cache size may come from a URL query string
+        cache_size = float(cache_size) if cache_size is not None else None
+        store = DiskCachingChunkStore(store, cache_dir, cache_size)
+    return store
 
 
 class TelstateDataSource(DataSource):
@@ -316,6 +687,9 @@ class TelstateDataSource(DataSource):
         Visibility timestamps, overriding (or fixing) the ones found in telstate
     source_name : string, optional
         Name of telstate source (used for metadata name)
+    fused : bool, optional
+        Load visibilities, flags and weights together in a single task per
+        chunk (see :class:`ChunkStoreVisFlagsWeights`)
 
     Raises
     ------
@@ -323,7 +697,7 @@ class TelstateDataSource(DataSource):
         If telstate lacks critical keys
     """
     def __init__(self, telstate, chunk_store=None, timestamps=None,
-                 source_name='telstate'):
+                 source_name='telstate', fused=False):
         self.telstate = telstate
         # Collect sensors
         sensors = {}
@@ -344,7 +718,8 @@ class TelstateDataSource(DataSource):
             data = None
         else:
             data = ChunkStoreVisFlagsWeights(
-                chunk_store, telstate['chunk_name'], telstate['chunk_info'])
+                chunk_store, telstate['chunk_name'], telstate['chunk_info'],
+                fused)
         # Metadata and timestamps with or without data
         DataSource.__init__(self, metadata, timestamps, data)
 
@@ -386,7 +761,8 @@ class TelstateDataSource(DataSource):
         telstate = view_capture_stream(telstate, **kwargs)
         if chunk_store == 'auto':
             chunk_store = _infer_chunk_store(url_parts, telstate, **kwargs)
-        return cls(telstate, chunk_store, source_name=url_parts.geturl())
+        return cls(telstate, chunk_store, source_name=url_parts.geturl(),
+                   fused=_to_bool(kwargs.get('fused', False)))
 
 
 def open_data_source(url, **kwargs):
@@ -18,12 +18,25 @@
 
 import copy
 import threading
+import operator
+import uuid
+import logging
 
 import numpy as np
+import dask
 import dask.array as da
+import dask.core
+import dask.optimization
 
+from .chunk_advisor import active_recorders
+
+
+logger = logging.getLogger(__name__)
 # TODO support advanced integer indexing with non-strictly increasing indices (i.e. out-of-order and duplicates)
 
+# Only request the selected part of a stored chunk if it is this small
+MAX_REGION_FRACTION = 0.25
+
 
 def _simplify_index(shape, indices):
     """Generate an equivalent index expression that is cheaper to evaluate.
@@ -382,6 +395,238 @@ class LazyIndexer(object):
                       self.transforms, self._initial_dtype)
 
 
+def _selected_chunks(chunks, index):
+    """Determine which chunks along a dimension contain selected elements.
+
+    Parameters
+    ----------
+    chunks : tuple of int
+        Chunk sizes along the dimension (dask chunk specification)
+    index : slice, int or array
+        Index expression for the dimension
+
+    Returns
+    -------
+    touched : array of bool
+        True for each chunk that contains at least one selected element
+        (all True if `index` is invalid, to let dask complain about it later)
+    """
+    offsets = np.cumsum((0,) + tuple(chunks))
+    try:
+        selected = np.arange(offsets[-1])[index]
+    except (IndexError, TypeError, ValueError):
+        return np.ones(len(chunks), dtype=np.bool_)
+    touched = np.zeros(len(chunks), dtype=np.bool_)
+    touched[np.searchsorted(offsets, np.ravel(selected), side='right') - 1] = True
+    return touched
+
+
+def _prune_chunks(dataset, keep):
+    """Drop chunks of dataset that are completely deselected by boolean masks.
+
+    Dask turns a boolean mask into fancy indexing that involves all chunks
+    along the corresponding dimension, even those without any selected
+    elements. This removes those chunks from the dask array before the
+    index is applied, by concatenating the runs of chunks that are at least
+    partially selected. The masks are adjusted to match and simplified again,
+    which could turn them into slices.
+
+    Parameters
+    ----------
+    dataset : :class:`dask.Array`
+        The full dataset, from which a subset is chosen by `keep`
+    keep : tuple
+        Simplified index expression (see :func:`_simplify_index`)
+
+    Returns
+    -------
+    pruned_dataset : :class:`dask.Array`
+        Dataset containing only the partially or fully selected chunks
+    pruned_keep : tuple
+        Index expression with the same effect on `pruned_dataset` as `keep`
+        has on `dataset`
+    """
+    if (not isinstance(keep, tuple) or len(keep) > dataset.ndim or
+            any(index is np.newaxis or index is Ellipsis for index in keep)):
+        return dataset, keep
+    pruned_keep = []
+    for axis, index in enumerate(keep):
+        chunks = dataset.chunks[axis]
+        try:
+            bool_array = (index.dtype == np.bool_ and
+                          index.shape == (dataset.shape[axis],))
+        except AttributeError:
+            bool_array = False
+        touched = _selected_chunks(chunks, index) if bool_array else None
+        if touched is None or touched.all():
+            pruned_keep.append(index)
+            continue
+        # Find runs of consecutive touched chunks and their extents
+        offsets = np.cumsum((0,) + chunks)
+        edges = np.diff(np.r_[0, touched.astype(np.int8), 0])
+        starts = offsets[np.flatnonzero(edges == 1)]
+        stops = offsets[np.flatnonzero(edges == -1)]
+        prefix = (slice(None),) * axis
+        pieces = [dataset[prefix + (slice(start, stop),)]
+                  for start, stop in zip(starts, stops)]
+        dataset = da.concatenate(pieces, axis=axis) if len(pieces) > 1 \
+            else pieces[0]
+        pruned_keep.append(index[np.repeat(touched, chunks)])
+    return dataset, _simplify_index(dataset.shape, tuple(pruned_keep))
+
+
+def _selected_nbytes(dataset, keep):
+    """Total size in bytes of all chunks of `dataset` touched by `keep`."""
+    if not isinstance(keep, tuple):
+        keep = (keep,)
+    if len(keep) > dataset.ndim or any(index is np.newaxis or index is Ellipsis
+                                       for index in keep):
+        return dataset.nbytes
+    keep += (slice(None),) * (dataset.ndim - len(keep))
+    nbytes = dataset.dtype.itemsize
+    for chunks, index in zip(dataset.chunks, keep):
+        nbytes *= np.sum(np.array(chunks)[_selected_chunks(chunks, index)])
+    return int(nbytes)
+
+
+def _selected_indices(shape, keep):
+    """Indices selected by `keep` along each dimension of array of `shape`.
+
+    Each index is applied independently to its dimension, like the fancy
+    indices of :class:`DaskLazyIndexer`. This returns a list of integer
+    arrays, which are 0-dimensional for dimensions dropped by integer indices,
+    or None if `keep` is invalid or contains ellipses or new axes.
+    """
+    if not isinstance(keep, tuple):
+        keep = (keep,)
+    if len(keep) > len(shape) or any(index is np.newaxis or index is Ellipsis
+                                     for index in keep):
+        return None
+    keep += (slice(None),) * (len(shape) - len(keep))
+    try:
+        return [np.arange(length)[index] for length, index in zip(shape, keep)]
+    except (IndexError, TypeError, ValueError):
+        return None
+
+
+def _compose_subregion(slices, indices):
+    """Part of chunk at `slices` selected by successive `indices`.
+
+    The `indices` are tuples of slices that are applied to the chunk in
+    reverse order (i.e. the last one is applied first). This returns the
+    selected part relative to the start of the chunk as a tuple of slices,
+    or None if the indices are not unit-stride slices.
+    """
+    shape = [s.stop - s.start for s in slices]
+    region = [slice(0, length) for length in shape]
+    for index in reversed(indices):
+        if len(index) > len(region):
+            return None
+        for axis, s in enumerate(index):
+            start, stop, step = s.indices(region[axis].stop - region[axis].start)
+            if step != 1:
+                return None
+            offset = region[axis].start
+            region[axis] = slice(offset + start, offset + max(start, stop))
+    return tuple(region)
+
+
+def _chunk_getter_task(graph, key):
+    """Find task that gets dask chunk `key` straight from a chunk store.
+
+    This follows aliases and simple indexing tasks (i.e. those that select a
+    rectangular part of the chunk via slices) back to the original chunk
+    getter task, which has the form ``(getter, array_name, slices)`` where
+    `getter` has a `get_into` method (see
+    :meth:`katdal.chunkstore.ChunkStore.get_dask_array`).
+
+    Returns
+    -------
+    task : tuple or None
+        Getter task, or None if the chunk is not merely (part of) a chunk in
+        the store
+    subregion : tuple of slice or None
+        Part of the stored chunk selected by the indexing tasks, relative to
+        the start of the chunk (None if the entire chunk is selected)
+    """
+    task = graph.get(key)
+    indices = []
+    while True:
+        if not dask.core.istask(task):
+            # Follow an alias to another key
+            try:
+                task = graph[task]
+            except (KeyError, TypeError):
+                return None, None
+        elif (task[0] is operator.getitem and len(task) == 3 and
+              isinstance(task[2], tuple) and
+              all(isinstance(s, slice) for s in task[2])):
+            if not all(s == slice(None) for s in task[2]):
+                indices.append(task[2])
+            task = task[1]
+        elif hasattr(task[0], 'get_into') and len(task) == 3:
+            if not indices:
+                return task, None
+            subregion = _compose_subregion(task[2], indices)
+            if subregion is None:
+                return None, None
+            full = tuple(slice(0, s.stop - s.start) for s in task[2])
+            return task, (None if subregion == full else subregion)
+        else:
+            return None, None
+
+
+def _region_fraction(slices, subregion):
+    """Fraction of chunk at `slices` that is selected by `subregion`."""
+    fraction = 1.0
+    for s, sub in zip(slices, subregion):
+        fraction *= (sub.stop - sub.start) / float(max(s.stop - s.start, 1))
+    return fraction
+
+
+def _copy_into(chunk, out):
+    """Copy `chunk` into the (preallocated) output array `out`."""
+    out[...] = chunk
+
+
+def _store_into(array, out):
+    """Compute dask `array` and write the result into ndarray `out`.
+
+    This is equivalent to ``da.store(array, out, lock=False)``, but chunks
+    that come straight from a chunk store are decoded directly into `out`.
+    If only a small part of a stored chunk is selected (at most a fraction
+    :data:`MAX_REGION_FRACTION` of it), only that part is requested from the
+    store, which may then avoid reading the rest of the chunk.
+    """
+    graph = dict(array.__dask_graph__())
+    offsets = [np.cumsum((0,) + c) for c in array.chunks]
+    out_name = 'store-into-' + uuid.uuid4().hex
+    keys = []
+    for index in np.ndindex(*array.numblocks):
+        # The ellipsis ensures that we get a view even if `out` is 0-D
+        region = tuple(slice(offset[i], offset[i + 1])
+                       for (offset, i) in zip(offsets, index)) + (Ellipsis,)
+        key = (array.name,) + index
+        getter_task, subregion = _chunk_getter_task(graph, key)
+        if getter_task is None:
+            task = (_copy_into, key, out[region])
+        elif subregion is None:
+            getter, array_name, slices = getter_task
+            task = (getter.get_into, array_name, slices, out[region])
+        elif _region_fraction(getter_task[2], subregion) <= MAX_REGION_FRACTION:
+            getter, array_name, slices = getter_task
+            task = (getter.get_region_into, array_name, slices, subregion,
+                    out[region])
+        else:
+            task = (_copy_into, key, out[region])
+        keys.append((out_name,) + index)
+        graph[keys[-1]] = task
+    # The scheduler runs every task in the graph, so drop the replaced getters
+    graph, _ = dask.optimization.cull(graph, keys)
+    scheduler = dask.base.get_scheduler(collections=[array])
+    scheduler(graph, keys)
+
+
 class DaskLazyIndexer(object):
     """Turn a dask Array into a LazyIndexer by computing it upon indexing.
 
@@ -390,7 +635,9 @@ class DaskLazyIndexer(object):
 
     Fancy indexing is supported but much slower. However, a boolean array
     for which a contiguous interval of values is selected is treated as a
-    special case and becomes a slice.
+    special case and becomes a slice. Chunks of the dataset that contain no
+    elements selected by a boolean array are dropped before indexing, which
+    may also turn the remaining selection into a slice.
 
     Parameters
     ----------
@@ -423,6 +670,7 @@ class DaskLazyIndexer(object):
         self.keep = copy.deepcopy(keep)
         self.transforms = list(transforms)
         self._orig_dataset = dataset
+        self._orig_layout = (dataset.shape, dataset.dtype, dataset.chunks)
         self._dataset = None
         self._lock = threading.Lock()
 
@@ -430,12 +678,16 @@ class DaskLazyIndexer(object):
     def dataset(self):
         with self._lock:
             if self._dataset is None:
+                # Avoid dask tasks for chunks that are not selected at all
+                dataset, keep = _prune_chunks(self._orig_dataset, self.keep)
+                logger.debug('Selection on %s touches %d of %d bytes',
+                             self.name, _selected_nbytes(dataset, keep),
+                             self._orig_dataset.nbytes)
                 try:
-                    dataset = self._orig_dataset[self.keep]
+                    dataset = dataset[keep]
                 except NotImplementedError:
                     # Dask does not like multiple boolean indices: go one dim at a time
-                    dataset = self._orig_dataset
-                    for dim, keep_per_dim in enumerate(self.keep):
+                    for dim, keep_per_dim in enumerate(keep):
                         dataset = da.take(dataset, keep_per_dim, axis=dim)
                 for transform in self.transforms:
                     dataset = transform(dataset)
@@ -446,12 +698,36 @@ class DaskLazyIndexer(object):
     def __getitem__(self, keep):
         # Workaround for https://github.com/dask/dask/issues/3595
         # This is equivalent to self.dataset[keep].compute(), but does not
-        # allocate excessive memory.
+        # allocate excessive memory. Chunks that are selected in their
+        # entirety are also decoded straight into the output array.
         kept = self.dataset[keep]
         out = np.empty(kept.shape, kept.dtype)
-        da.store(kept, out, lock=False)
+        _store_into(kept, out)
+        recorders = active_recorders()
+        if recorders:
+            self._record_access(recorders, keep)
         return out
 
+    def _record_access(self, recorders, keep):
+        """Pass selection on original dataset to access recorders."""
+        shape, dtype, chunks = self._orig_layout
+        indices = _selected_indices(shape, self.keep)
+        if indices is None:
+            return
+        kept_dims = [dim for dim, index in enumerate(indices) if index.ndim]
+        kept_shape = tuple(len(indices[dim]) for dim in kept_dims)
+        # Give up if the transforms reshaped the selection, as `keep` then
+        # no longer maps onto the kept dimensions of the original dataset
+        if kept_shape != self.shape:
+            return
+        kept_indices = _selected_indices(kept_shape, keep)
+        if kept_indices is None:
+            return
+        for dim, index in zip(kept_dims, kept_indices):
+            indices[dim] = indices[dim][index]
+        for recorder in recorders:
+            recorder.record(self.name, shape, dtype, chunks, indices)
+
     def __len__(self):
         """Length operator."""
         return self.shape[0]
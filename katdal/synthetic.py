@@ -0,0 +1,393 @@
+################################################################################
+# Copyright (c) 2018, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Synthetic MeerKAT Visibility Format (MVF) version 4 datasets.
+
+This fabricates a complete v4 dataset, i.e. a telescope state (with the
+correlator, subarray and observation attributes and the antenna activity,
+target and pointing sensors) and the chunks of its visibilities, flags and
+weights, with a configurable number of dumps, channels and antennas. This is
+useful for tests and benchmarks that would otherwise need real archive data.
+
+The visibilities follow a simple fringe model that is separable in time and
+frequency. Each chunk is the outer product of a time factor and a frequency
+factor and therefore costs a single multiplication per element, so that even
+datasets of hundreds of gigabytes are generated at the speed of the store.
+
+Here is how to create a dataset that :func:`katdal.open` finds by itself::
+
+  store = NpyFileChunkStore('/data')
+  rdb_filename = '/data/1500000000/1500000000_sdp_l0.rdb'
+  make_dataset(store, rdb_filename, n_dumps=100, n_chans=4096, n_ants=64)
+  d = katdal.open(rdb_filename)
+"""
+
+import functools
+import itertools
+import logging
+import time
+import uuid
+
+import numpy as np
+import dask.array as da
+import katpoint
+import katsdptelstate
+from katsdptelstate.rdb_writer import RDBWriter
+
+from .chunkstore import generate_chunks
+from .visdatav4 import FLAG_NAMES
+
+
+logger = logging.getLogger(__name__)
+
+# Centre of the array and size of its dishes (those of MeerKAT)
+ARRAY_CENTRE = '-30:42:39.8, 21:26:38.0, 1035.0'
+DISH_DIAMETER = 13.5
+# Speed of light, in m/s
+LIGHTSPEED = 299792458.0
+
+
+def synthetic_antennas(n_ants, radius=4000.0, seed=1):
+    """Antennas scattered randomly around the centre of the array.
+
+    Parameters
+    ----------
+    n_ants : int
+        Number of antennas, named 'm000', 'm001', etc.
+    radius : float, optional
+        Maximum east / north offset of antenna from array centre, in metres
+    seed : int, optional
+        Seed of random layout
+
+    Returns
+    -------
+    ants : list of :class:`katpoint.Antenna` objects
+        Antennas
+    """
+    offsets = np.random.RandomState(seed).uniform(-radius, radius,
+                                                  (n_ants, 2))
+    return [katpoint.Antenna('m{:03d}, {}, {}, {:.3f} {:.3f} 0.0'
+                             .format(n, ARRAY_CENTRE, DISH_DIAMETER,
+                                     east, north))
+            for n, (east, north) in enumerate(offsets)]
+
+
+def synthetic_bls_ordering(ants):
+    """All auto- and cross-correlation products of dual-pol `ants`."""
+    return [(a1.name + p1, a2.name + p2)
+            for a1, a2 in itertools.combinations_with_replacement(ants, 2)
+            for p1, p2 in itertools.product('hv', repeat=2)]
+
+
+def synthetic_telstate(n_dumps, n_chans, ants, capture_block_id='1500000000',
+                       stream_name='sdp_l0', start_time=1500000000.0,
+                       int_time=8.0, scan_dumps=10, band='l',
+                       center_freq=1284e6, bandwidth=856e6,
+                       s3_endpoint_url=None):
+    """Telescope state with the attributes and sensors of a v4 dataset.
+
+    The observation consists of scans of `scan_dumps` dumps each, which start
+    with a slew of a single dump, followed by a track of a new target. The
+    targets are near the meridian at the start of the observation and the
+    antennas point at them with perfect accuracy. This does not include the
+    chunk info, which is added by :func:`make_dataset`.
+
+    Parameters
+    ----------
+    n_dumps : int
+        Number of correlator dumps
+    n_chans : int
+        Number of frequency channels
+    ants : list of :class:`katpoint.Antenna` objects
+        Antennas in subarray (see :func:`synthetic_antennas`)
+    capture_block_id : string, optional
+        Capture block ID
+    stream_name : string, optional
+        Name of L0 visibility stream
+    start_time : float, optional
+        Start of first dump, in UTC seconds since Unix epoch
+    int_time : float, optional
+        Dump period, in seconds
+    scan_dumps : int, optional
+        Number of dumps per scan (including slew)
+    band : {'l', 'u', 's', 'x'}, optional
+        Receiver band
+    center_freq, bandwidth : float, optional
+        Centre frequency and bandwidth of the correlator stream, in Hz
+    s3_endpoint_url : string, optional
+        Endpoint of S3 service providing the chunks (not stored by default)
+
+    Returns
+    -------
+    telstate : :class:`katsdptelstate.TelescopeState` object
+        Telescope state with the usual capture block and stream views
+    """
+    telstate = katsdptelstate.TelescopeState()
+    ant_names = [ant.name for ant in ants]
+    telstate.add('capture_block_id', capture_block_id, immutable=True)
+    telstate.add('stream_name', stream_name, immutable=True)
+    telstate.add('sub_pool_resources', ','.join(ant_names + ['cbf_1', 'sdp_1']),
+                 immutable=True)
+    telstate.add('sub_band', band, immutable=True)
+    telstate.add('sub_product', 'synthetic', immutable=True)
+    stream = telstate.view(stream_name)
+    stream.add('stream_type', 'sdp.vis', immutable=True)
+    stream.add('sync_time', start_time, immutable=True)
+    stream.add('first_timestamp', 0.5 * int_time, immutable=True)
+    stream.add('int_time', int_time, immutable=True)
+    stream.add('bls_ordering', synthetic_bls_ordering(ants), immutable=True)
+    stream.add('n_chans', n_chans, immutable=True)
+    stream.add('center_freq', center_freq, immutable=True)
+    stream.add('bandwidth', bandwidth, immutable=True)
+    if s3_endpoint_url:
+        stream.add('s3_endpoint_url', s3_endpoint_url, immutable=True)
+    obs_params = {'observer': 'katdal', 'description': 'Synthetic dataset',
+                  'experiment_id': capture_block_id, 'ants': ','.join(ant_names)}
+    telstate.view(capture_block_id).add('obs_params', obs_params,
+                                        immutable=True)
+    # Pick targets spread in RA around the meridian at the start
+    scan_starts = np.arange(0, n_dumps, scan_dumps)
+    # Note that katpoint interprets a decimal RA string in degrees
+    lst = katpoint.rad2deg(ants[0].local_sidereal_time(start_time))
+    targets = [katpoint.Target('source{}, radec, {:.4f}, -30:00:00'.format(
+                   n, (lst + 7.5 * (n - len(scan_starts) // 2)) % 360.))
+               for n in range(len(scan_starts))]
+    # Events are nudged into the dumps they affect, away from dump boundaries
+    slew_times = start_time + (scan_starts + 0.01) * int_time
+    track_times = slew_times + 0.98 * int_time
+    dump_times = start_time + (np.arange(n_dumps) + 0.5) * int_time
+    dump_scans = np.arange(n_dumps) // scan_dumps
+    for ant in ants:
+        telstate.add(ant.name + '_observer', ant.description, immutable=True)
+        telstate.add(ant.name + '_activity', 'stop', ts=start_time - 1.0)
+        for target, slew, track in zip(targets, slew_times, track_times):
+            telstate.add(ant.name + '_target', target.description, ts=slew)
+            telstate.add(ant.name + '_activity', 'slew', ts=slew)
+            telstate.add(ant.name + '_activity', 'track', ts=track)
+        # Pointing is sampled once per dump, as it varies slowly
+        azel = np.empty((n_dumps, 2))
+        for n, target in enumerate(targets):
+            in_scan = (dump_scans == n)
+            azel[in_scan] = np.c_[target.azel(dump_times[in_scan], ant)]
+        azel = katpoint.rad2deg(azel)
+        for timestamp, (az, el) in zip(dump_times, azel):
+            telstate.add(ant.name + '_pos_actual_scan_azim', az, ts=timestamp)
+            telstate.add(ant.name + '_pos_actual_scan_elev', el, ts=timestamp)
+    return telstate
+
+
+def _vis_chunk(time_factor, freq_factor, array_name, slices):
+    """Chunk of visibilities as outer product of time and frequency factors."""
+    time_slice, freq_slice, corrprod_slice = slices
+    return (time_factor[time_slice, np.newaxis, corrprod_slice] *
+            freq_factor[np.newaxis, freq_slice, corrprod_slice])
+
+
+def _flags_chunk(dump_flags, array_name, slices):
+    """Chunk of flags that only depend on dump."""
+    shape = tuple(s.stop - s.start for s in slices)
+    chunk = np.empty(shape, np.uint8)
+    chunk[:] = dump_flags[slices[0], np.newaxis, np.newaxis]
+    return chunk
+
+
+def _array_from_chunks(name, chunks, dtype, get_chunk):
+    """Dask array with a task `get_chunk(name, slices)` per chunk."""
+    graph = da.core.getem(name, chunks, get_chunk)
+    return da.Array(graph, name, chunks, dtype)
+
+
+def synthetic_arrays(ants, timestamps, freqs, vis_chunks, slewing=None,
+                     seed=1):
+    """Visibilities, flags and weights of a synthetic dataset.
+
+    The visibility of each correlation product has a constant amplitude, a
+    delay proportional to its baseline length and a fringe rate (with the
+    same proportionality). Autocorrelations are real-valued, and all are
+    shaped by a smooth bandpass. The weights are uniform, and only dumps
+    during slews (if any) are flagged, via the 'cam' flag.
+
+    Parameters
+    ----------
+    ants : list of :class:`katpoint.Antenna` objects
+        Antennas in subarray (see :func:`synthetic_antennas`)
+    timestamps : array of float, shape (*T*,)
+        Timestamps of dumps, in UTC seconds since Unix epoch
+    freqs : array of float, shape (*F*,)
+        Centre frequencies of channels, in Hz
+    vis_chunks : tuple of 3 tuples of int
+        Chunks of visibility array, which also apply to flags and weights
+    slewing : array of bool, shape (*T*,), optional
+        True for each dump during which the antennas are slewing
+    seed : int, optional
+        Seed of random visibility parameters
+
+    Returns
+    -------
+    arrays : dict mapping string to :class:`dask.array.Array` object
+        Dask arrays of 'correlator_data', 'flags', 'weights' and
+        'weights_channel', as stored in a v4 dataset
+    """
+    random = np.random.RandomState(seed)
+    token = uuid.uuid4().hex
+    positions = {ant.name: np.array(ant.position_enu) for ant in ants}
+    bls_ordering = synthetic_bls_ordering(ants)
+    n_corrprods = len(bls_ordering)
+    baselines = np.array([np.linalg.norm(positions[inp2[:-1]] -
+                                         positions[inp1[:-1]])
+                          for inp1, inp2 in bls_ordering])
+    auto = np.array([inp1 == inp2 for inp1, inp2 in bls_ordering])
+    # Delays of up to 1/10th of the geometric delay along the baseline
+    delays = random.uniform(-0.1, 0.1, n_corrprods) * baselines / LIGHTSPEED
+    fringe_rates = delays * 1e4
+    amplitudes = np.where(auto, 1.0, random.uniform(0.01, 0.1, n_corrprods))
+    t = np.asarray(timestamps) - timestamps[0]
+    time_factor = np.exp(2j * np.pi * np.outer(t, fringe_rates))
+    relative_freqs = (freqs - freqs.mean()) / (freqs.max() - freqs.min())
+    bandpass = 1.0 - 0.5 * relative_freqs ** 2
+    freq_factor = np.exp(-2j * np.pi * np.outer(freqs, delays))
+    freq_factor *= bandpass[:, np.newaxis] * amplitudes
+    # Ensure that autocorrelations are real
+    freq_factor[:, auto] = freq_factor[:, auto].real
+    get_vis = functools.partial(_vis_chunk, time_factor.astype(np.complex64),
+                                freq_factor.astype(np.complex64))
+    vis = _array_from_chunks('synthetic-correlator_data-' + token, vis_chunks,
+                             np.complex64, get_vis)
+    if slewing is None:
+        slewing = np.zeros(len(timestamps), np.bool_)
+    cam_flag = 1 << FLAG_NAMES.index('cam')
+    dump_flags = np.where(slewing, cam_flag, 0).astype(np.uint8)
+    get_flags = functools.partial(_flags_chunk, dump_flags)
+    flags = _array_from_chunks('synthetic-flags-' + token, vis_chunks,
+                               np.uint8, get_flags)
+    weights = da.full(vis.shape, 255, dtype=np.uint8, chunks=vis_chunks)
+    weights_channel = da.full(vis.shape[:2], 1.0, dtype=np.float32,
+                              chunks=vis_chunks[:2])
+    return {'correlator_data': vis, 'flags': flags, 'weights': weights,
+            'weights_channel': weights_channel}
+
+
+def make_dataset(store, rdb_filename=None, n_dumps=100, n_chans=4096,
+                 n_ants=16, chunk_size=2 ** 22, vis_chunks=None,
+                 capture_block_id='1500000000', stream_name='sdp_l0',
+                 chunk_name=None, scan_dumps=10, center_freq=1284e6,
+                 bandwidth=856e6, codecs=None, elide_constant=True,
+                 batch=(), seed=1, **kwargs):
+    """Fabricate a v4 dataset, put its chunks in `store` and save its RDB file.
+
+    The chunks are generated and stored in parallel by dask. The telstate
+    gets the 'chunk_info' and 'chunk_name' keys that point to the chunks, and
+    is saved as an RDB file if `rdb_filename` is given. If `store` is an
+    :class:`~katdal.chunkstore_npy.NpyFileChunkStore` with top-level
+    directory *D*, :func:`katdal.open` finds the chunks automatically if the
+    RDB file is placed in a subdirectory of *D* (see the module docstring).
+    For S3 stores, pass the `s3_endpoint_url` instead.
+
+    Parameters
+    ----------
+    store : :class:`~katdal.chunkstore.ChunkStore` object
+        Chunk store that receives the visibilities, flags and weights
+    rdb_filename : string, optional
+        Save the telstate to this RDB file (the default is not to save it)
+    n_dumps, n_chans, n_ants : int, optional
+        Number of dumps, channels and (dual-pol) antennas, respectively
+    chunk_size : int, optional
+        Maximum size of a visibility chunk, in bytes. Chunks are split along
+        time and then frequency, like those produced by ingest.
+    vis_chunks : tuple of 3 tuples of int, optional
+        Chunks of visibility array (overrides `chunk_size`)
+    capture_block_id : string, optional
+        Capture block ID
+    stream_name : string, optional
+        Name of L0 visibility stream
+    chunk_name : string, optional
+        Name of dataset in store, i.e. the bucket that contains the arrays
+        (the default is '<capture_block_id>-<stream_name>', with hyphens)
+    scan_dumps : int, optional
+        Number of dumps per scan (including a slew of one dump)
+    center_freq, bandwidth : float, optional
+        Centre frequency and bandwidth of the correlator stream, in Hz
+    codecs : dict mapping string to string, optional
+        Codec used to compress each array (default is no compression)
+    elide_constant : bool, optional
+        Store constant chunks as a single element, which saves a lot of space
+        for the uniform weights and mostly unflagged flags
+    batch : tuple of int, optional
+        Number of neighbouring chunks put by a single task along each
+        dimension (see :meth:`ChunkStore.put_dask_array`)
+    seed : int, optional
+        Seed of random antenna layout and visibility parameters
+    kwargs : dict, optional
+        Extra keyword arguments passed on to :func:`synthetic_telstate`
+
+    Returns
+    -------
+    telstate : :class:`katsdptelstate.TelescopeState` object
+        Telescope state of dataset
+
+    Raises
+    ------
+    :exc:`katdal.chunkstore.ChunkStoreError`
+        If any chunk could not be stored
+    """
+    ants = synthetic_antennas(n_ants, seed=seed)
+    telstate = synthetic_telstate(n_dumps, n_chans, ants, capture_block_id,
+                                  stream_name, scan_dumps=scan_dumps,
+                                  center_freq=center_freq,
+                                  bandwidth=bandwidth, **kwargs)
+    stream = telstate.view(stream_name)
+    timestamps = stream['sync_time'] + stream['first_timestamp'] + \
+        np.arange(n_dumps) * stream['int_time']
+    # The centre frequency is that of channel n_chans / 2
+    freqs = center_freq + (np.arange(n_chans) - n_chans // 2) * \
+        (bandwidth / n_chans)
+    slewing = np.arange(n_dumps) % scan_dumps == 0
+    shape = (n_dumps, n_chans, len(stream['bls_ordering']))
+    if vis_chunks is None:
+        vis_chunks = generate_chunks(shape, np.complex64, chunk_size,
+                                     dims_to_split=(0, 1), power_of_two=True)
+    arrays = synthetic_arrays(ants, timestamps, freqs, vis_chunks, slewing,
+                              seed)
+    if chunk_name is None:
+        chunk_name = '{}-{}'.format(capture_block_id,
+                                    stream_name.replace('_', '-'))
+    codecs = codecs if codecs else {}
+    start = time.time()
+    puts = [store.put_dask_array(store.join(chunk_name, name), array,
+                                 codec=codecs.get(name),
+                                 elide_constant=elide_constant, batch=batch)
+            for name, array in arrays.items()]
+    for success in da.compute(*puts):
+        errors = [err for err in success.flat if err is not None]
+        if errors:
+            raise errors[0]
+    nbytes = sum(array.nbytes for array in arrays.values())
+    logger.info('Stored %.3f GB of synthetic data in %.1f seconds',
+                nbytes / 1e9, time.time() - start)
+    chunk_info = {name: {'chunks': array.chunks, 'shape': array.shape,
+                         'dtype': array.dtype.str}
+                  for name, array in arrays.items()}
+    for name, codec in codecs.items():
+        chunk_info[name]['codec'] = codec
+    capture_stream = telstate.SEPARATOR.join((capture_block_id, stream_name))
+    telstate.view(capture_stream).add('chunk_info', chunk_info,
+                                      immutable=True)
+    telstate.view(capture_stream).add('chunk_name', chunk_name,
+                                      immutable=True)
+    if rdb_filename:
+        with RDBWriter(rdb_filename) as rdb:
+            rdb.save(telstate)
+    return telstate
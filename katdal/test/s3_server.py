@@ -0,0 +1,295 @@
+################################################################################
+# Copyright (c) 2017-2018, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""An in-process, in-memory stand-in for an S3 service.
+
+This serves the subset of the S3 REST API used by
+:class:`katdal.chunkstore_s3.S3ChunkStore` (object GET / PUT / HEAD / DELETE,
+byte ranges, bucket listings with pagination and multipart uploads) over a
+real HTTP socket on localhost, without authentication. It needs no network
+or external processes, which makes it handy for tests and benchmarks, e.g.
+
+  with S3Server() as server:
+      store = S3ChunkStore.from_url(server.url)
+"""
+
+import BaseHTTPServer
+import SocketServer
+import socket
+import sys
+import threading
+import itertools
+import hashlib
+import base64
+import re
+import time
+import urllib
+import urlparse
+from xml.sax.saxutils import escape
+
+
+_NS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    """HTTP server that handles each connection in a separate thread."""
+    daemon_threads = True
+    # Many clients connect at once when the chunk store starts up
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        """Ignore clients that hang up (e.g. when they are discarded)."""
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                                                   client_address)
+
+
+class _S3RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handle a single S3 request based on the state of `self.server.s3`."""
+    # Keep connections alive, like a real S3 service
+    protocol_version = 'HTTP/1.1'
+    # Send headers and small bodies together instead of in many small packets
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        """Keep quiet instead of logging each request to stderr."""
+        pass
+
+    def _read_body(self):
+        """Read request body, which is either chunked or has known length."""
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            parts = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                if size == 0:
+                    # Skip the (empty) trailer
+                    while self.rfile.readline().strip():
+                        pass
+                    return b''.join(parts)
+                parts.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _respond(self, status, body=b'', headers=()):
+        """Send response with given status code, body and extra headers."""
+        self.send_response(status)
+        for key, value in headers:
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _error(self, status, code):
+        """Send S3-style XML error response."""
+        body = '<Error><Code>{}</Code></Error>'.format(code)
+        self._respond(status, body, [('Content-Type', 'application/xml')])
+
+    def _handle(self):
+        """Parse the request and dispatch it to the relevant method."""
+        s3 = self.server.s3
+        url = urlparse.urlsplit(self.path)
+        path = urllib.unquote(url.path)
+        params = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        body = self._read_body() if self.command in ('PUT', 'POST') else b''
+        if s3.latency:
+            time.sleep(s3.latency)
+        md5 = self.headers.get('Content-MD5')
+        if md5 and md5 != base64.b64encode(hashlib.md5(body).digest()):
+            self._error(400, 'BadDigest')
+            return
+        # An object is identified by a path that has both bucket and key
+        is_object = '/' in path.strip('/')
+        if self.command == 'GET' and not is_object:
+            self._list(s3, path, params)
+        elif self.command == 'POST' and 'uploads' in params:
+            upload_id = s3.start_upload(path)
+            self._respond(200, '<InitiateMultipartUploadResult xmlns="{}">'
+                               '<UploadId>{}</UploadId>'
+                               '</InitiateMultipartUploadResult>'
+                               .format(_NS, upload_id))
+        elif self.command == 'PUT' and 'partNumber' in params:
+            etag = s3.put_part(params['uploadId'],
+                               int(params['partNumber']), body)
+            if etag is None:
+                self._error(404, 'NoSuchUpload')
+            else:
+                self._respond(200, headers=[('ETag', etag)])
+        elif self.command == 'POST' and 'uploadId' in params:
+            etags = re.findall('<ETag>(.*?)</ETag>', body)
+            if s3.complete_upload(params['uploadId'], path, etags):
+                self._respond(200, '<CompleteMultipartUploadResult xmlns="{}"/>'
+                                   .format(_NS))
+            else:
+                self._error(400, 'InvalidPart')
+        elif self.command == 'DELETE' and 'uploadId' in params:
+            s3.abort_upload(params['uploadId'])
+            self._respond(204)
+        elif self.command == 'PUT':
+            s3.objects[path] = body
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            self._respond(200, headers=[('ETag', etag)])
+        elif self.command == 'DELETE':
+            s3.objects.pop(path, None)
+            self._respond(204)
+        elif path not in s3.objects:
+            self._error(404, 'NoSuchKey')
+        else:
+            self._get(s3.objects[path])
+
+    def _get(self, data):
+        """Send object data, honouring a single byte range if requested."""
+        byte_range = re.match(r'bytes=(\d+)-(\d*)$',
+                              self.headers.get('Range', ''))
+        if not byte_range:
+            self._respond(200, data)
+            return
+        start = int(byte_range.group(1))
+        stop = int(byte_range.group(2)) + 1 if byte_range.group(2) else len(data)
+        stop = min(stop, len(data))
+        if start >= stop:
+            self._error(416, 'InvalidRange')
+            return
+        content_range = 'bytes {}-{}/{}'.format(start, stop - 1, len(data))
+        self._respond(206, data[start:stop],
+                      [('Content-Range', content_range)])
+
+    def _list(self, s3, path, params):
+        """Send listing of buckets or of keys in a bucket."""
+        bucket = path.strip('/')
+        if not bucket:
+            buckets = ''.join('<Bucket><Name>{}</Name></Bucket>'
+                              .format(escape(name)) for name in s3.buckets())
+            self._respond(200, '<ListAllMyBucketsResult xmlns="{}"><Buckets>'
+                               '{}</Buckets></ListAllMyBucketsResult>'
+                               .format(_NS, buckets))
+            return
+        if bucket not in s3.buckets():
+            self._error(404, 'NoSuchBucket')
+            return
+        keys = s3.list_keys(bucket, params.get('prefix', ''),
+                            params.get('marker', ''))
+        max_keys = int(params.get('max-keys', 1000))
+        truncated = len(keys) > max_keys
+        keys = keys[:max_keys]
+        contents = ''.join('<Contents><Key>{}</Key></Contents>'
+                           .format(escape(key)) for key in keys)
+        marker = '<NextMarker>{}</NextMarker>'.format(escape(keys[-1])) \
+            if truncated else ''
+        self._respond(200, '<ListBucketResult xmlns="{}"><Name>{}</Name>'
+                           '<IsTruncated>{}</IsTruncated>{}{}'
+                           '</ListBucketResult>'
+                           .format(_NS, escape(bucket),
+                                   'true' if truncated else 'false',
+                                   marker, contents))
+
+    do_GET = do_PUT = do_HEAD = do_POST = do_DELETE = _handle
+
+
+class S3Server(object):
+    """In-memory S3 service running in a background thread on localhost.
+
+    Buckets spring into existence as soon as an object is stored in them.
+    The server can also be used as a context manager that stops it on exit.
+
+    Parameters
+    ----------
+    host : string, optional
+        Address on which to listen
+    port : int, optional
+        Port on which to listen (automatically assigned by default)
+    latency : float, optional
+        Extra delay added to each request, in seconds, to mimic a remote
+        service (the default is to respond as fast as possible)
+
+    Attributes
+    ----------
+    objects : dict mapping string to string
+        Object data, keyed by path of object (i.e. '/<bucket>/<key>')
+    url : string
+        Endpoint URL of service
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        self.objects = {}
+        self.latency = latency
+        self._uploads = {}
+        self._upload_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._server = _ThreadingHTTPServer((host, port), _S3RequestHandler)
+        self._server.s3 = self
+        self.url = 'http://{}:{}'.format(*self._server.server_address)
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='S3Server')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Stop the server and wait for it to finish."""
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def buckets(self):
+        """Names of buckets containing at least one object."""
+        return sorted(set(path.split('/')[1] for path in self.objects.keys()))
+
+    def list_keys(self, bucket, prefix='', marker=''):
+        """Sorted keys of objects in `bucket` after `marker` with `prefix`."""
+        bucket_path = '/' + bucket + '/'
+        keys = [path[len(bucket_path):] for path in self.objects.keys()
+                if path.startswith(bucket_path)]
+        return sorted(key for key in keys
+                      if key.startswith(prefix) and key > marker)
+
+    def start_upload(self, path):
+        """Start multipart upload of object at `path` and return upload ID."""
+        with self._lock:
+            upload_id = str(next(self._upload_ids))
+            self._uploads[upload_id] = {}
+        return upload_id
+
+    def put_part(self, upload_id, part_number, data):
+        """Store part of multipart upload and return its ETag (or None)."""
+        etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+        with self._lock:
+            if upload_id not in self._uploads:
+                return None
+            self._uploads[upload_id][etag] = (part_number, data)
+        return etag
+
+    def complete_upload(self, upload_id, path, etags):
+        """Assemble object at `path` from parts, returning success."""
+        with self._lock:
+            parts = self._uploads.get(upload_id, {})
+            if not etags or any(etag not in parts for etag in etags):
+                return False
+            del self._uploads[upload_id]
+        ordered = sorted(parts[etag] for etag in etags)
+        self.objects[path] = b''.join(data for number, data in ordered)
+        return True
+
+    def abort_upload(self, upload_id):
+        """Discard the parts of a multipart upload."""
+        with self._lock:
+            self._uploads.pop(upload_id, None)
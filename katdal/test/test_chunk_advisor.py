@@ -0,0 +1,163 @@
+################################################################################
+# Copyright (c) 2018, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Tests for :py:mod:`katdal.chunk_advisor`."""
+
+import numpy as np
+from numpy.testing import assert_array_equal
+from nose.tools import assert_equal, assert_raises
+import dask.array as da
+
+from katdal.chunkstore import generate_chunks
+from katdal.lazy_indexer import DaskLazyIndexer
+from katdal.chunk_advisor import (AccessRecorder, record_accesses,
+                                  active_recorders)
+
+
+SHAPE = (64, 1024, 16)
+CHUNK_SIZE = 2 ** 16
+
+
+def _default_chunks():
+    return generate_chunks(SHAPE, np.complex64, CHUNK_SIZE,
+                           dims_to_split=(0, 1), power_of_two=True)
+
+
+class TestRecordAccesses(object):
+    """Record selections made via DaskLazyIndexer."""
+
+    def setup(self):
+        self.x = da.zeros(SHAPE, dtype=np.complex64, chunks=_default_chunks())
+
+    def test_no_recording_outside_block(self):
+        with record_accesses() as recorder:
+            assert_equal(active_recorders(), [recorder])
+        assert_equal(active_recorders(), [])
+        DaskLazyIndexer(self.x)[0]
+        assert_equal(recorder.accesses, [])
+
+    def test_two_stage_selection(self):
+        time_keep = np.zeros(SHAPE[0], np.bool_)
+        time_keep[[2, 3, 4, 10, 11]] = True
+        corrprod_keep = np.zeros(SHAPE[2], np.bool_)
+        corrprod_keep[[1, 5, 6]] = True
+        indexer = DaskLazyIndexer(self.x, (time_keep, slice(100, 200),
+                                           corrprod_keep))
+        with record_accesses() as recorder:
+            indexer[1:4, 10]
+        assert_equal(len(recorder.accesses), 1)
+        access = recorder.accesses[0]
+        assert_equal(access.name, self.x.name)
+        assert_equal(access.shape, SHAPE)
+        assert_equal(access.itemsize, 8)
+        assert_equal(access.chunks, self.x.chunks)
+        # Dumps 3, 4 and 10, channel 110 and all selected correlation products
+        assert_array_equal(access.starts[0], [3, 10])
+        assert_array_equal(access.stops[0], [5, 11])
+        assert_array_equal(access.starts[1], [110])
+        assert_array_equal(access.stops[1], [111])
+        assert_array_equal(access.starts[2], [1, 5])
+        assert_array_equal(access.stops[2], [2, 7])
+
+    def test_transforms(self):
+        with record_accesses() as recorder:
+            DaskLazyIndexer(self.x, (), [lambda x: x.real])[0]
+            # Selections that are reshaped by transforms are ignored
+            DaskLazyIndexer(self.x, (), [lambda x: x[:, 0]])[0]
+        assert_equal(len(recorder.accesses), 1)
+        assert_array_equal(recorder.accesses[0].stops[1], [SHAPE[1]])
+
+
+class TestAccessRecorder(object):
+    """Evaluate and recommend chunk layouts for recorded selections."""
+
+    def setup(self):
+        self.recorder = AccessRecorder()
+
+    def _record(self, *indices):
+        self.recorder.record('vis', SHAPE, np.complex64, _default_chunks(),
+                             [np.arange(length)[index] for length, index
+                              in zip(SHAPE, indices)])
+
+    def test_bytes_read(self):
+        random = np.random.RandomState(42)
+        chunks = ((5, 20, 39), (1000, 24), (3, 3, 10))
+        selections = []
+        for n in range(10):
+            indices = [np.flatnonzero(random.uniform(size=length) < 0.05)
+                       for length in SHAPE]
+            selections.append(indices)
+            self._record(*indices)
+        # Compare against chunks touched by each selection, one by one
+        expected = 0
+        for indices in selections:
+            touched = 8
+            for dim_chunks, index in zip(chunks, indices):
+                offsets = np.cumsum((0,) + dim_chunks)
+                chunk_ids = np.unique(np.searchsorted(offsets, index,
+                                                      side='right') - 1)
+                touched *= np.sum(np.array(dim_chunks)[chunk_ids])
+            expected += touched
+        assert_equal(self.recorder.bytes_read(chunks), expected)
+        # An empty selection reads nothing
+        self.recorder.reset()
+        self._record(slice(0, 0), slice(None), slice(None))
+        assert_equal(self.recorder.bytes_read(), 0)
+
+    def test_spectral_line_workload(self):
+        for start in range(0, SHAPE[1], 128):
+            self._record(slice(None), slice(start, start + 4), slice(None))
+        chunks = self.recorder.recommend_chunks(CHUNK_SIZE)
+        # Chunks span all dumps but only a few channels
+        assert_equal(chunks[0], (64,))
+        assert_equal(set(chunks[1]), {8})
+        assert_equal(chunks[2], (16,))
+        assert self.recorder.bytes_read(chunks) < \
+            self.recorder.bytes_read() / 10
+
+    def test_continuum_workload(self):
+        for dump in range(SHAPE[0]):
+            self._record(dump, slice(None), slice(None))
+        chunks = self.recorder.recommend_chunks(CHUNK_SIZE)
+        # Even a single dump exceeds the chunk size
+        assert_equal(chunks, ((1,) * 64, (512, 512), (16,)))
+        # The default chunks split time first, which suits this workload
+        assert_equal(self.recorder.bytes_read(chunks),
+                     self.recorder.bytes_read())
+
+    def test_dims_to_split(self):
+        for product in range(SHAPE[2]):
+            self._record(slice(None), slice(None), product)
+        chunks = self.recorder.recommend_chunks(CHUNK_SIZE)
+        assert_equal(chunks[2], (1,) * SHAPE[2])
+        chunks = self.recorder.recommend_chunks(CHUNK_SIZE,
+                                                dims_to_split=(0, 1))
+        assert_equal(chunks[2], (SHAPE[2],))
+
+    def test_small_array(self):
+        self._record(0, 0, 0)
+        chunks = self.recorder.recommend_chunks(np.prod(SHAPE) * 8)
+        assert_equal(chunks, tuple((length,) for length in SHAPE))
+
+    def test_bad_accesses(self):
+        assert_raises(ValueError, self.recorder.recommend_chunks, CHUNK_SIZE)
+        self._record(0, 0, 0)
+        assert_raises(ValueError, self.recorder.recommend_chunks, CHUNK_SIZE,
+                      names=['flags'])
+        self.recorder.record('flags', (10, 10), np.uint8, ((10,), (10,)),
+                             [np.arange(10), np.arange(10)])
+        assert_raises(ValueError, self.recorder.recommend_chunks, CHUNK_SIZE)
+        self.recorder.recommend_chunks(CHUNK_SIZE, names=['flags'])
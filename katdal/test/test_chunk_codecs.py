@@ -0,0 +1,127 @@
+################################################################################
+# Copyright (c) 2018, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Tests for :py:mod:`katdal.chunk_codecs`."""
+
+import io
+
+import numpy as np
+from numpy.testing import assert_array_equal
+from nose.tools import assert_equal, assert_raises, assert_true
+
+from katdal.chunkstore import BadChunk
+from katdal.chunk_codecs import (CODECS, CODEC_MAGIC, get_codec, write_chunk,
+                                 read_chunk_header, read_chunk_into,
+                                 chunk_from_bytes, chunk_buffers)
+
+
+def serialise(chunk, codec=None, elide_constant=False):
+    fp = io.BytesIO()
+    write_chunk(fp, chunk, codec, elide_constant)
+    return fp.getvalue()
+
+
+class TestChunkCodecs(object):
+    def __init__(self):
+        self.flags = np.zeros((4, 256, 40), np.uint8)
+        self.flags[2, 100:120] = 3
+        self.weights = np.linspace(0, 1, 4 * 256 * 40, dtype=np.float32)
+        self.weights = self.weights.reshape(4, 256, 40)
+        self.vis = np.arange(60).reshape(3, 4, 5) * (1 + 2j)
+        self.scalar = np.array(2.)
+
+    def test_round_trip(self):
+        for name in set(CODECS) - {'constant'}:
+            for chunk in (self.flags, self.weights, self.vis, self.scalar,
+                          self.vis[:, 0:0], self.vis.T):
+                data = serialise(chunk, name)
+                assert_true(data.startswith(CODEC_MAGIC))
+                chunk_retrieved = chunk_from_bytes(data)
+                assert_equal(chunk_retrieved.dtype, chunk.dtype)
+                assert_array_equal(chunk_retrieved, chunk,
+                                   "Codec {} failed on {}".format(name, chunk))
+
+    def test_constant_chunks(self):
+        zeros = np.zeros((4, 256, 40), np.float32)
+        data = serialise(zeros, elide_constant=True)
+        # The chunk is represented by a header and a single element
+        assert_true(data.startswith(CODEC_MAGIC))
+        assert_true(len(data) < 200)
+        assert_equal(data, serialise(zeros, 'constant'))
+        assert_array_equal(chunk_from_bytes(data), zeros)
+        fp = io.BytesIO(serialise(self.vis[:1, :1, :1] * 0 + 3j, 'constant'))
+        shape, fortran_order, dtype, codec = read_chunk_header(fp)
+        out = np.zeros((2, 2, 2), np.complex128)
+        read_chunk_into(fp, out[1:, 1:, :1], fortran_order, dtype, codec)
+        assert_array_equal(out[1, 1, 0], 3j)
+        assert_array_equal(out.sum(), 3j)
+        # Constant scalars and non-constant chunks are left alone
+        data = serialise(self.scalar, elide_constant=True)
+        assert_array_equal(np.load(io.BytesIO(data)), self.scalar)
+        data = serialise(self.flags, 'zlib', elide_constant=True)
+        assert_equal(data, serialise(self.flags, 'zlib'))
+        assert_raises(ValueError, serialise, self.flags, 'constant')
+
+    def test_compression(self):
+        raw = serialise(self.flags)
+        assert_true(len(serialise(self.flags, 'zlib')) < len(raw) // 20)
+        # Byte shuffle helps to compress smoothly varying numbers
+        assert_true(len(serialise(self.weights, 'shuffle+zlib')) <
+                    len(serialise(self.weights, 'zlib')))
+
+    def test_plain_npy(self):
+        # Unencoded chunks are standard NPY files
+        data = serialise(self.vis.T)
+        assert_array_equal(np.load(io.BytesIO(data)), self.vis.T)
+        assert_array_equal(chunk_from_bytes(data), self.vis.T)
+        fp = io.BytesIO(data)
+        shape, fortran_order, dtype, codec = read_chunk_header(fp)
+        assert_equal(shape, self.vis.T.shape)
+        assert_equal(codec, None)
+        out = np.empty(shape, dtype)
+        read_chunk_into(fp, out, fortran_order, dtype, codec)
+        assert_array_equal(out, self.vis.T)
+
+    def test_chunk_buffers(self):
+        for codec in (None, 'zlib'):
+            for chunk in (self.flags, self.weights, self.vis, self.scalar,
+                          self.vis[:, 0:0], self.vis.T, self.vis[:, ::2]):
+                buffers = chunk_buffers(chunk, codec)
+                assert_equal(b''.join(memoryview(buf).tobytes() for buf in buffers),
+                             serialise(chunk, codec))
+        # Contiguous array data is not copied
+        buffers = chunk_buffers(self.weights)
+        self.weights[0, 0, 0] = 42.
+        assert_equal(buffers[1][:4].tobytes(), self.weights[0, 0, :1].tobytes())
+        zeros = np.zeros((4, 256, 40), np.float32)
+        assert_equal(b''.join(chunk_buffers(zeros, elide_constant=True)),
+                     serialise(zeros, elide_constant=True))
+
+    def test_errors(self):
+        assert_raises(ValueError, get_codec, 'no-such-codec')
+        assert_raises(ValueError, serialise, self.flags, 'no-such-codec')
+        assert_raises(ValueError, chunk_from_bytes, b'rubbish and more')
+        # Chunk compressed by a codec that is not available
+        data = serialise(self.flags, 'zlib').replace(b'zlib', b'zlix', 1)
+        assert_raises(BadChunk, chunk_from_bytes, data)
+        # Corrupted / truncated compressed data
+        data = serialise(self.flags, 'zlib')
+        assert_raises(BadChunk, chunk_from_bytes, data[:-10])
+        fp = io.BytesIO(data)
+        shape, fortran_order, dtype, codec = read_chunk_header(fp)
+        out = np.empty((2,) + shape, dtype)
+        assert_raises(BadChunk, read_chunk_into, fp, out,
+                      fortran_order, dtype, codec)
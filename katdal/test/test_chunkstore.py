@@ -16,14 +16,21 @@
 
 """Tests for :py:mod:`katdal.chunkstore`."""
 
+import zlib
+import multiprocessing.pool
+
 import numpy as np
 from numpy.testing import assert_array_equal
 from nose.tools import (assert_raises, assert_equal, assert_true, assert_false,
                         assert_is_instance)
 import dask.array as da
+import mock
 
 from katdal.chunkstore import (ChunkStore, generate_chunks,
-                               StoreUnavailable, ChunkNotFound, BadChunk)
+                               StoreUnavailable, ChunkNotFound, BadChunk,
+                               _chunk_id_prefixes)
+from katdal.chunkstore_stats import collect_stats
+from katdal.chunkstore_dict import DictChunkStore
 
 
 class TestGenerateChunks(object):
@@ -74,6 +81,17 @@ class TestGenerateChunks(object):
         assert_equal(chunks, ((10,), 60 * (512,), (144,)))
 
 
+def test_chunk_id_prefixes():
+    chunk_ids = ['{:05d}_00000'.format(i) for i in range(1200)]
+    assert_equal(_chunk_id_prefixes(chunk_ids, 1), ['0'])
+    assert_equal(_chunk_id_prefixes(chunk_ids, 2), ['00', '01'])
+    assert_equal(len(_chunk_id_prefixes(chunk_ids, 16)), 120)
+    assert_equal(len(_chunk_id_prefixes(chunk_ids, 5000)), 1200)
+    assert_equal(_chunk_id_prefixes(['00003_00000', '00003_00001'], 8),
+                 ['00003'])
+    assert_equal(_chunk_id_prefixes([''], 8), [''])
+
+
 class TestChunkStore(object):
     """This tests the base class functionality."""
 
@@ -112,6 +130,27 @@ class TestChunkStore(object):
             with store._standard_errors():
                 {}['ha']
 
+    def test_thread_pool_is_reused(self):
+        x = np.arange(10.)
+        store = DictChunkStore(x=x.copy())
+        store.max_concurrency = 4
+        slices_list = [(slice(n, n + 1),) for n in range(10)]
+        with mock.patch('multiprocessing.pool.ThreadPool',
+                        wraps=multiprocessing.pool.ThreadPool) as pool:
+            for n in range(3):
+                chunks = store.get_chunks('x', slices_list, x.dtype)
+                store.put_chunks_noraise('x', slices_list, chunks)
+        assert_equal(pool.call_count, 1)
+        assert_array_equal(store.arrays['x'], x)
+        # Closing the store stops its threads, which restart on demand
+        thread_pool = store._thread_pool
+        store.close()
+        assert_equal(store._thread_pool, None)
+        assert_equal(thread_pool._state, multiprocessing.pool.TERMINATE)
+        chunks = store.get_chunks('x', slices_list, x.dtype)
+        assert_array_equal(np.hstack(chunks), x)
+        store.close()
+
 
 class ChunkStoreTestBase(object):
     """Standard tests performed on all types of ChunkStore."""
@@ -219,6 +258,40 @@ class ChunkStoreTestBase(object):
         # Try an empty slice on a zero-dimensional array (but why?)
         self.put_has_get_chunk('z', ())
 
+    def test_put_get_chunk_with_codec(self):
+        name = self.array_name('big_y2')
+        s = (slice(3, 5), slice(0, 6), slice(0, 2))
+        chunk = self.big_y2[s]
+        self.store.put_chunk(name, s, chunk, codec='shuffle+zlib')
+        assert_true(self.store.has_chunk(name, s, chunk.dtype))
+        assert_array_equal(self.store.get_chunk(name, s, chunk.dtype), chunk)
+        out = np.empty_like(chunk)
+        self.store.get_chunk_into(name, s, chunk.dtype, out)
+        assert_array_equal(out, chunk)
+        # Check that the dask array interface passes on the codec too
+        array_name, dask_array, offset = self.make_dask_array('big_y')
+        push = self.store.put_dask_array(array_name, dask_array, offset,
+                                         codec='zlib')
+        divisions_per_dim = [len(c) for c in dask_array.chunks]
+        assert_array_equal(push.compute(), np.full(divisions_per_dim, None))
+        self.get_dask_array('big_y')
+
+    def test_put_get_constant_chunk(self):
+        name = self.array_name('big_y2')
+        s = (slice(5, 8), slice(0, 6), slice(0, 2))
+        chunk = np.full((3, 6, 2), 7, dtype=self.big_y2.dtype)
+        self.store.put_chunk(name, s, chunk, elide_constant=True)
+        assert_true(self.store.has_chunk(name, s, chunk.dtype))
+        assert_array_equal(self.store.get_chunk(name, s, chunk.dtype), chunk)
+        out = np.zeros((4, 6, 2), chunk.dtype)
+        self.store.get_chunk_into(name, s, chunk.dtype, out[1:])
+        assert_array_equal(out[1:], chunk)
+        assert_array_equal(out[0], 0)
+        # Non-constant chunks are stored in full
+        chunk = self.big_y2[s]
+        self.store.put_chunk(name, s, chunk, elide_constant=True)
+        assert_array_equal(self.store.get_chunk(name, s, chunk.dtype), chunk)
+
     def test_put_chunk_noraise(self):
         result = self.store.put_chunk_noraise("x", (1, 2), [])
         assert_is_instance(result, BadChunk)
@@ -250,6 +323,172 @@ class ChunkStoreTestBase(object):
         self.put_dask_array('big_y2', np.s_[3:8, 30:60, 0:2])
         self.get_dask_array('big_y2')
 
+    def test_manifest(self):
+        array_name, dask_array, offset = self.make_dask_array(
+            'big_y', np.s_[3:8, 0:60, 0:2])
+        push = self.store.put_dask_array(array_name, dask_array, offset,
+                                         manifest=True)
+        results = push.compute()
+        try:
+            manifest = self.store.get_manifest(array_name, dask_array.chunks,
+                                               offset)
+        except ChunkNotFound:
+            # The store is unable to add the manifest as a new array
+            assert_true(self.preloaded_chunks)
+            assert_is_instance(results.flat[0], ChunkNotFound)
+            return
+        assert_array_equal(results, None)
+        divisions_per_dim = tuple(len(c) for c in dask_array.chunks)
+        assert_equal(manifest.shape, divisions_per_dim)
+        assert_equal(manifest.dtype, ChunkStore.MANIFEST_DTYPE)
+        assert_array_equal(manifest['present'], True)
+        slices_list = da.core.slices_from_chunks(dask_array.chunks)
+        for slices, entry in zip(slices_list, manifest.flat):
+            chunk = np.ascontiguousarray(dask_array[slices].compute())
+            assert_equal(entry['nbytes'], chunk.nbytes)
+            assert_equal(entry['crc32'], zlib.crc32(chunk) & 0xffffffff)
+        has = self.store.has_array(array_name, dask_array.chunks, offset)
+        assert_array_equal(has, np.full(divisions_per_dim, True))
+        # The manifest only applies to the same chunks and offset
+        assert_raises(ChunkNotFound, self.store.get_manifest,
+                      array_name, dask_array.chunks)
+        assert_raises(ChunkNotFound, self.store.get_manifest,
+                      array_name, dask_array.chunks[:2] + ((1, 1),), offset)
+
+    def test_get_chunks(self):
+        self.put_dask_array('big_y')
+        array_name, dask_array, offset = self.make_dask_array('big_y')
+        slices_list = da.core.slices_from_chunks(dask_array.chunks)
+        chunks = self.store.get_chunks(array_name, slices_list, self.big_y.dtype)
+        assert_equal(len(chunks), len(slices_list))
+        for slices, chunk in zip(slices_list, chunks):
+            assert_array_equal(chunk, self.big_y[slices])
+        # Mix in a missing chunk and a bad one
+        missing_name = self.array_name('haha')
+        missing = (slice(0, 1), slice(0, 1), slice(0, 1))
+        bad = (slice(0, 4, 2), slice(0, 1), slice(0, 1))
+        results = self.store.get_chunks_noraise(
+            array_name, [slices_list[0], bad], self.big_y.dtype)
+        assert_array_equal(results[0], self.big_y[slices_list[0]])
+        assert_is_instance(results[1], BadChunk)
+        assert_raises(ChunkNotFound, self.store.get_chunks, missing_name,
+                      [missing], self.big_y.dtype)
+        zeros = self.store.get_chunks_or_zeros(missing_name, [missing],
+                                               self.big_y.dtype)
+        assert_array_equal(zeros[0], np.zeros((1, 1, 1)))
+        assert_equal(zeros[0].dtype, self.big_y.dtype)
+
+    def test_get_chunk_into(self):
+        name = self.array_name('y')
+        s = (slice(3, 7), slice(2, 5), slice(1, 2))
+        self.put_has_get_chunk('y', s)
+        # Decode chunk into a (non-contiguous) view of a bigger array
+        out = np.zeros_like(self.y)
+        self.store.get_chunk_into(name, s, self.y.dtype, out[s])
+        expected = np.zeros_like(self.y)
+        expected[s] = self.y[s]
+        assert_array_equal(out, expected)
+        # Output array with a different dtype
+        out = np.zeros((4, 3, 1), np.float32)
+        self.store.get_chunk_into(name, s, self.y.dtype, out)
+        assert_array_equal(out, self.y[s])
+        assert_raises(BadChunk, self.store.get_chunk_into, name, s,
+                      self.y.dtype, np.zeros((3, 3, 1)))
+        assert_raises(BadChunk, self.store.get_chunk_into, name, s,
+                      self.x.dtype, np.zeros((4, 3, 1), self.x.dtype))
+        assert_raises(ChunkNotFound, self.store.get_chunk_into,
+                      self.array_name('haha'), s, self.y.dtype, out)
+        # Zero-dimensional chunk
+        self.put_has_get_chunk('z', ())
+        out = np.zeros(())
+        self.store.get_chunk_into(self.array_name('z'), (), self.z.dtype, out)
+        assert_array_equal(out, self.z)
+
+    def test_get_chunk_region(self):
+        name = self.array_name('big_y')
+        s = (slice(0, 8), slice(0, 60), slice(0, 2))
+        chunk = self.big_y[s]
+        self.store.put_chunk(name, s, chunk)
+        for subregion in [(slice(2, 3), slice(10, 12)),
+                          (slice(0, 8), slice(5, 6), slice(1, 2)),
+                          (slice(1, 7),), (), (slice(3, 3),)]:
+            region = self.store.get_chunk_region(name, s, self.big_y.dtype,
+                                                 subregion)
+            assert_array_equal(region, chunk[subregion])
+        assert_raises(BadChunk, self.store.get_chunk_region, name, s,
+                      self.big_y.dtype, (slice(0, 8, 2),))
+        assert_raises(BadChunk, self.store.get_chunk_region, name, s,
+                      self.x.dtype, (slice(2, 3),))
+        assert_raises(ChunkNotFound, self.store.get_chunk_region,
+                      self.array_name('haha'), s, self.big_y.dtype,
+                      (slice(2, 3),))
+        # Compressed chunks are decoded in full
+        name = self.array_name('big_y2')
+        chunk = self.big_y2[s]
+        self.store.put_chunk(name, s, chunk, codec='zlib')
+        region = self.store.get_chunk_region(name, s, self.big_y2.dtype,
+                                             (slice(2, 3), slice(10, 12)))
+        assert_array_equal(region, chunk[2:3, 10:12])
+
+    def test_dask_array_batch(self):
+        self.put_dask_array('big_y')
+        array_name, dask_array, offset = self.make_dask_array('big_y')
+        pull = self.store.get_dask_array(array_name, dask_array.chunks,
+                                         dask_array.dtype, batch=(3, 2))
+        # Store has 8 x 2 x 1 chunks, which become 3 x 1 x 1 dask chunks
+        assert_equal(pull.numblocks, (3, 1, 1))
+        assert_array_equal(pull.compute(), self.big_y)
+        # Batches on part of the array, which requires an offset
+        array_name, dask_array, offset = self.make_dask_array(
+            'big_y', np.s_[2:8, 30:60, 0:2])
+        pull = self.store.get_dask_array(array_name, dask_array.chunks,
+                                         dask_array.dtype, offset, (4,))
+        assert_array_equal(pull.compute(), self.big_y[2:8, 30:60, 0:2])
+
+    def test_dask_array_put_batch(self):
+        # Use new array names to leave other tests of big_y2 unaffected
+        _, dask_array, offset = self.make_dask_array(
+            'big_y2', np.s_[3:8, 0:60, 0:2])
+        array_name = self.array_name('batch_y2')
+        push = self.store.put_dask_array(array_name, dask_array, offset,
+                                         batch=(2, 2))
+        # The success array still has one element per chunk
+        results = push.compute()
+        divisions_per_dim = tuple(len(c) for c in dask_array.chunks)
+        assert_equal(results.shape, divisions_per_dim)
+        if self.preloaded_chunks:
+            # The store is unable to add new arrays
+            assert_is_instance(results.flat[0], ChunkNotFound)
+            return
+        assert_array_equal(results, np.full(divisions_per_dim, None))
+        pull = self.store.get_dask_array(array_name, dask_array.chunks,
+                                         dask_array.dtype, offset)
+        assert_array_equal(pull.compute(), self.big_y2[3:8, 0:60, 0:2])
+        # Batches of chunks are also compatible with manifests
+        array_name = self.array_name('batch_manifest_y2')
+        push = self.store.put_dask_array(array_name, dask_array, offset,
+                                         manifest=True, batch=(4,))
+        assert_array_equal(push.compute(), None)
+        manifest = self.store.get_manifest(array_name, dask_array.chunks,
+                                           offset)
+        assert_array_equal(manifest['present'], True)
+
+    def test_stats(self):
+        name = self.array_name('y')
+        s = (slice(3, 7), slice(2, 5), slice(1, 2))
+        with collect_stats(self.store) as stats:
+            self.put_has_get_chunk('y', s)
+        store_stats = stats.to_dict()['stores'][type(self.store).__name__]
+        ops = store_stats['operations']
+        chunk_bytes = self.y[s].nbytes
+        assert_equal(ops['put']['requests'], 1)
+        assert_equal(ops['put']['bytes'], chunk_bytes)
+        assert_equal(ops['has']['requests'], 1)
+        assert_equal(ops['get']['requests'], 1)
+        assert_equal(ops['get']['bytes'], chunk_bytes)
+        assert_true(self.store.stats is None)
+        assert_true(self.store.has_chunk(name, s, self.y.dtype))
+
     def test_list_chunk_ids(self):
         array_name, dask_array, offset = self.make_dask_array('big_y2')
         try:
@@ -260,3 +499,10 @@ class ChunkStoreTestBase(object):
             slices = da.core.slices_from_chunks(dask_array.chunks)
             ref_chunk_ids = [self.store.chunk_id_str(s) for s in slices]
             assert_equal(set(chunk_ids), set(ref_chunk_ids))
+            # Partition the listing by prefixes of the first index
+            prefixes = _chunk_id_prefixes(ref_chunk_ids, 4)
+            chunk_ids = self.store.list_chunk_ids(array_name, prefixes)
+            assert_equal(set(chunk_ids), set(ref_chunk_ids))
+            chunk_ids = self.store.list_chunk_ids(array_name, prefixes[:1])
+            assert_equal(set(chunk_ids),
+                         set(c for c in ref_chunk_ids if c.startswith(prefixes[0])))
@@ -0,0 +1,306 @@
+################################################################################
+# Copyright (c) 2018, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Tests for :py:mod:`katdal.chunkstore_cache`."""
+
+import tempfile
+import shutil
+import os
+
+import numpy as np
+import mock
+from numpy.testing import assert_array_equal
+from nose.tools import assert_equal, assert_raises, assert_true
+
+from katdal.chunkstore import ChunkNotFound, StoreUnavailable
+from katdal.chunkstore_cache import (CachingChunkStore, DiskCachingChunkStore,
+                                     TieredChunkStore)
+from katdal.chunkstore_dict import DictChunkStore
+from katdal.chunkstore_npy import NpyFileChunkStore
+from katdal.test.test_chunkstore import ChunkStoreTestBase
+
+
+class TestCachingChunkStore(ChunkStoreTestBase):
+    """Test the memory cache in front of an NPY file chunk store."""
+
+    @classmethod
+    def setup_class(cls):
+        """Create temp dir to store NPY files and build ChunkStore on that."""
+        cls.tempdir = tempfile.mkdtemp()
+        cls.store = CachingChunkStore(NpyFileChunkStore(cls.tempdir), 2000)
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tempdir)
+
+
+class TestDiskCachingChunkStore(ChunkStoreTestBase):
+    """Test the disk cache in front of an NPY file chunk store."""
+
+    @classmethod
+    def setup_class(cls):
+        """Create temp dirs for the underlying store and the cache."""
+        cls.tempdir = tempfile.mkdtemp()
+        store_path = os.path.join(cls.tempdir, 'store')
+        os.mkdir(store_path)
+        cache_path = os.path.join(cls.tempdir, 'cache')
+        cls.store = DiskCachingChunkStore(NpyFileChunkStore(store_path),
+                                          cache_path, 100000)
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tempdir)
+
+
+class TestTieredChunkStore(ChunkStoreTestBase):
+    """Test a local NPY staging tier in front of an NPY file chunk store."""
+
+    @classmethod
+    def setup_class(cls):
+        """Create temp dirs for the two tiers."""
+        cls.tempdir = tempfile.mkdtemp()
+        fast_path = os.path.join(cls.tempdir, 'fast')
+        slow_path = os.path.join(cls.tempdir, 'slow')
+        os.mkdir(fast_path)
+        os.mkdir(slow_path)
+        cls.store = TieredChunkStore([NpyFileChunkStore(fast_path),
+                                      NpyFileChunkStore(slow_path)],
+                                     staging_tier=0)
+
+    @classmethod
+    def teardown_class(cls):
+        cls.store.flush()
+        shutil.rmtree(cls.tempdir)
+
+
+class _BrokenChunkStore(DictChunkStore):
+    """A dict chunk store that refuses all writes."""
+
+    def put_chunk(self, array_name, slices, chunk, **kwargs):
+        raise StoreUnavailable('Store is read-only')
+
+
+class TestCacheBehaviour(object):
+    """Check the LRU policy and statistics of the cache."""
+
+    def setup(self):
+        self.x = np.arange(40.).reshape(4, 10)
+        # Each row of 10 float64 values is 80 bytes - room for 2 rows
+        self.store = CachingChunkStore(DictChunkStore(x=self.x), 200)
+
+    def get_row(self, row):
+        return self.store.get_chunk('x', (slice(row, row + 1), slice(0, 10)),
+                                    self.x.dtype)
+
+    def test_hits_misses_evictions(self):
+        assert_array_equal(self.get_row(0), self.x[0:1])
+        assert_array_equal(self.get_row(1), self.x[1:2])
+        assert_equal((self.store.hits, self.store.misses), (0, 2))
+        assert_equal(self.store.nbytes, 160)
+        # Touch row 0 so that row 1 becomes the least recently used one
+        self.get_row(0)
+        assert_equal((self.store.hits, self.store.misses), (1, 2))
+        self.get_row(2)
+        assert_equal(self.store.evictions, 1)
+        assert_equal(len(self.store), 2)
+        # Row 0 is still there but row 1 is gone
+        self.get_row(0)
+        assert_equal(self.store.hits, 2)
+        self.get_row(1)
+        assert_equal((self.store.misses, self.store.evictions), (4, 2))
+
+    def test_read_only_chunks(self):
+        chunk = self.get_row(3)
+        with assert_raises(ValueError):
+            chunk[0, 0] = 1.
+
+    def test_underlying_array_stays_writeable(self):
+        # The dict store returns its backing array itself for empty slices
+        store = CachingChunkStore(DictChunkStore(y=np.zeros(())), 200)
+        chunk = store.get_chunk('y', (), np.float64)
+        assert_true(store.store.arrays['y'].flags.writeable)
+        store.store.put_chunk('y', (), np.ones(()))
+        with assert_raises(ValueError):
+            chunk[()] = 2.
+
+    def test_oversized_chunk_not_cached(self):
+        chunk = self.store.get_chunk('x', (slice(0, 4), slice(0, 10)),
+                                     self.x.dtype)
+        assert_array_equal(chunk, self.x)
+        assert_equal(len(self.store), 0)
+
+    def test_put_invalidates(self):
+        slices = (slice(1, 2), slice(0, 10))
+        self.get_row(1)
+        assert_true(self.store.has_chunk('x', slices, self.x.dtype))
+        self.store.put_chunk('x', slices, np.zeros((1, 10)))
+        assert_equal(len(self.store), 0)
+        assert_array_equal(self.get_row(1), np.zeros((1, 10)))
+        self.store.clear()
+        assert_equal(self.store.nbytes, 0)
+
+
+class TestDiskCacheBehaviour(object):
+    """Check the persistence and size limit of the disk cache."""
+
+    def setup(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.tempdir, 'cache')
+        self.x = np.arange(40.).reshape(4, 10)
+        self.remote = DictChunkStore(x=self.x)
+
+    def teardown(self):
+        shutil.rmtree(self.tempdir)
+
+    def get_row(self, store, row):
+        return store.get_chunk('x', (slice(row, row + 1), slice(0, 10)),
+                               self.x.dtype)
+
+    def test_persistence(self):
+        store = DiskCachingChunkStore(self.remote, self.cache_path)
+        assert_array_equal(self.get_row(store, 1), self.x[1:2])
+        assert_array_equal(self.get_row(store, 1), self.x[1:2])
+        assert_equal((store.hits, store.misses), (1, 1))
+        assert_true(os.path.isfile(os.path.join(self.cache_path, 'x',
+                                                '00001_00000.npy')))
+        # A new session picks up the cached files
+        store = DiskCachingChunkStore(self.remote, self.cache_path)
+        assert_equal(len(store), 1)
+        assert_array_equal(self.get_row(store, 1), self.x[1:2])
+        assert_equal((store.hits, store.misses), (1, 0))
+        # A cached file that disappears is fetched again
+        shutil.rmtree(self.cache_path)
+        os.mkdir(self.cache_path)
+        assert_array_equal(self.get_row(store, 1), self.x[1:2])
+        assert_equal((store.hits, store.misses), (1, 1))
+
+    def test_mismatched_files(self):
+        store = DiskCachingChunkStore(self.remote, self.cache_path)
+        self.get_row(store, 1)
+        filename = os.path.join(self.cache_path, 'x', '00001_00000.npy')
+        for bad_chunk in [np.arange(5.), np.arange(10, dtype=np.int32)]:
+            # A file with the wrong shape or dtype is a cache miss
+            np.save(filename, bad_chunk)
+            misses = store.misses
+            assert_array_equal(self.get_row(store, 1), self.x[1:2])
+            assert_equal(store.misses, misses + 1)
+            # The file is replaced by the correct chunk
+            assert_array_equal(np.load(filename), self.x[1:2])
+
+    def test_eviction(self):
+        store = DiskCachingChunkStore(self.remote, self.cache_path)
+        self.get_row(store, 0)
+        file_size = store.nbytes
+        # Make room for two files only
+        store = DiskCachingChunkStore(self.remote, self.cache_path,
+                                      2 * file_size)
+        self.get_row(store, 1)
+        self.get_row(store, 0)
+        self.get_row(store, 2)
+        assert_equal(store.evictions, 1)
+        assert_equal(store.nbytes, 2 * file_size)
+        cached = sorted(os.listdir(os.path.join(self.cache_path, 'x')))
+        assert_equal(cached, ['00000_00000.npy', '00002_00000.npy'])
+        # Shrinking the cache evicts files on startup
+        store = DiskCachingChunkStore(self.remote, self.cache_path, file_size)
+        assert_equal((len(store), store.evictions), (1, 1))
+
+
+class TestTieredBehaviour(object):
+    """Check the promotion and write-back of the tiered store."""
+
+    def setup(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.x = np.arange(40.).reshape(4, 10)
+        self.local = NpyFileChunkStore(self.tempdir)
+        self.remote = DictChunkStore(x=self.x.copy())
+        self.slices = (slice(1, 2), slice(0, 10))
+
+    def teardown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_promotion(self):
+        store = TieredChunkStore([self.local, self.remote])
+        assert_raises(ChunkNotFound, self.local.get_chunk,
+                      'x', self.slices, self.x.dtype)
+        assert_array_equal(store.get_chunk('x', self.slices, self.x.dtype),
+                           self.x[1:2])
+        assert_array_equal(store.get_chunk('x', self.slices, self.x.dtype),
+                           self.x[1:2])
+        assert_equal(store.hits, [1, 1])
+        assert_array_equal(self.local.get_chunk('x', self.slices,
+                                                self.x.dtype), self.x[1:2])
+        # Batched requests only go to the remote tier for missing chunks
+        slices_list = [self.slices, (slice(2, 3), slice(0, 10))]
+        chunks = store.get_chunks('x', slices_list, self.x.dtype)
+        assert_array_equal(np.vstack(chunks), self.x[1:3])
+        assert_equal(store.hits, [2, 2])
+
+    def test_no_promotion(self):
+        store = TieredChunkStore([self.local, self.remote], promote=False)
+        store.get_chunk('x', self.slices, self.x.dtype)
+        assert_true(not self.local.has_chunk('x', self.slices, self.x.dtype))
+
+    def test_write_through(self):
+        store = TieredChunkStore([self.local, self.remote])
+        store.put_chunk('x', self.slices, np.zeros((1, 10)))
+        assert_array_equal(self.remote.arrays['x'][1:2], np.zeros((1, 10)))
+        assert_array_equal(self.local.get_chunk('x', self.slices,
+                                                self.x.dtype),
+                           np.zeros((1, 10)))
+
+    def test_write_back(self):
+        store = TieredChunkStore([self.local, self.remote], staging_tier=0)
+        store.put_chunk('x', self.slices, np.zeros((1, 10)))
+        assert_array_equal(store.get_chunk('x', self.slices, self.x.dtype),
+                           np.zeros((1, 10)))
+        store.flush()
+        assert_equal(store.pending, 0)
+        assert_array_equal(self.remote.arrays['x'][1:2], np.zeros((1, 10)))
+
+    def test_write_back_errors(self):
+        remote = _BrokenChunkStore(x=self.x)
+        store = TieredChunkStore([self.local, remote], staging_tier=0)
+        store.put_chunk('x', self.slices, np.zeros((1, 10)))
+        assert_raises(StoreUnavailable, store.flush)
+        # Errors are only reported once
+        store.flush()
+        assert_raises(ValueError, TieredChunkStore, [self.local, remote],
+                      staging_tier=1)
+
+    def test_promotion_of_cast_output(self):
+        store = TieredChunkStore([self.local, self.remote])
+        out = np.empty((3, 10), np.float32)[1:2]
+        store.get_chunk_into('x', self.slices, self.x.dtype, out)
+        assert_array_equal(out, self.x[1:2])
+        promoted = self.local.get_chunk('x', self.slices, self.x.dtype)
+        assert_equal(promoted.dtype, self.x.dtype)
+        assert_array_equal(promoted, self.x[1:2])
+
+    def test_write_back_options(self):
+        local = mock.Mock(wraps=self.local)
+        store = TieredChunkStore([local, self.remote], staging_tier=0)
+        store.put_chunk('x', self.slices, np.zeros((1, 10)), codec='zlib')
+        store.close()
+        local.put_chunk.assert_called_once_with('x', self.slices, mock.ANY,
+                                                codec='zlib')
+        assert_equal(store.pending, 0)
+        assert_array_equal(self.remote.arrays['x'][1:2], np.zeros((1, 10)))
+        local.close.assert_called_once_with()
+        # The store can still be used after it is closed
+        store.put_chunk('x', self.slices, np.ones((1, 10)))
+        store.close()
+        assert_array_equal(self.remote.arrays['x'][1:2], np.ones((1, 10)))
@@ -18,11 +18,15 @@
 
 import tempfile
 import shutil
+import os
 
-from nose.tools import assert_raises
+import numpy as np
+from numpy.testing import assert_array_equal
+from nose.tools import assert_raises, assert_true, assert_false, assert_equal
+import mock
 
 from katdal.chunkstore_npy import NpyFileChunkStore
-from katdal.chunkstore import StoreUnavailable
+from katdal.chunkstore import StoreUnavailable, BadChunk
 from katdal.test.test_chunkstore import ChunkStoreTestBase
 
 
@@ -41,3 +45,92 @@ class TestNpyFileChunkStore(ChunkStoreTestBase):
 
     def test_store_unavailable(self):
         assert_raises(StoreUnavailable, NpyFileChunkStore, 'hahahahahaha')
+
+    def test_constant_chunk_size(self):
+        slices = (slice(0, 100), slice(0, 100))
+        chunk = np.zeros((100, 100), np.float32)
+        self.store.put_chunk('constant', slices, chunk, elide_constant=True)
+        filename = os.path.join(self.tempdir, 'constant', '00000_00000.npy')
+        # Header plus a single element instead of 40 kB of zeros
+        assert_true(os.path.getsize(filename) < 200)
+        chunk_retrieved = self.store.get_chunk('constant', slices, chunk.dtype)
+        assert_array_equal(chunk_retrieved, chunk)
+
+
+class TestNpyFileChunkStoreMmap(TestNpyFileChunkStore):
+    """Test NPY file functionality with memory-mapped chunks."""
+
+    @classmethod
+    def setup_class(cls):
+        """Create temp dir to store NPY files and build ChunkStore on that."""
+        cls.tempdir = tempfile.mkdtemp()
+        cls.store = NpyFileChunkStore(cls.tempdir, mmap_mode='r')
+
+    def test_bad_mmap_mode(self):
+        assert_raises(ValueError, NpyFileChunkStore, self.tempdir, 'r+')
+
+    def test_memmap_chunks(self):
+        slices = (slice(0, 8), slice(0, 60), slice(0, 2))
+        self.store.put_chunk('mmap', slices, self.big_y)
+        chunk = self.store.get_chunk('mmap', slices, self.big_y.dtype)
+        assert_true(isinstance(chunk, np.memmap))
+        assert_false(chunk.flags.writeable)
+        assert_array_equal(chunk, self.big_y)
+        region = self.store.get_chunk_region('mmap', slices, self.big_y.dtype,
+                                             (slice(2, 3), slice(10, 12)))
+        assert_true(isinstance(region, np.memmap))
+        assert_array_equal(region, self.big_y[2:3, 10:12])
+        # Fortran-order chunks are mapped too
+        self.store.put_chunk('mmap_f', slices, np.asfortranarray(self.big_y))
+        chunk = self.store.get_chunk('mmap_f', slices, self.big_y.dtype)
+        assert_true(isinstance(chunk, np.memmap))
+        assert_array_equal(chunk, self.big_y)
+        # Compressed chunks are decoded into ordinary arrays
+        self.store.put_chunk('mmap_zlib', slices, self.big_y, codec='zlib')
+        chunk = self.store.get_chunk('mmap_zlib', slices, self.big_y.dtype)
+        assert_false(isinstance(chunk, np.memmap))
+        assert_array_equal(chunk, self.big_y)
+
+    def test_truncated_chunk(self):
+        slices = (slice(0, 10),)
+        self.store.put_chunk('truncated', slices, np.arange(10.))
+        filename = os.path.join(self.tempdir, 'truncated', '00000.npy')
+        with open(filename, 'rb+') as f:
+            f.truncate(os.path.getsize(filename) - 8)
+        assert_raises(BadChunk, self.store.get_chunk, 'truncated', slices,
+                      np.float64)
+
+
+class TestNpyFileChunkStoreFsync(TestNpyFileChunkStore):
+    """Test NPY file functionality with durable writes."""
+
+    @classmethod
+    def setup_class(cls):
+        """Create temp dir to store NPY files and build ChunkStore on that."""
+        cls.tempdir = tempfile.mkdtemp()
+        cls.store = NpyFileChunkStore(cls.tempdir, fsync='batch')
+
+    def test_bad_fsync_policy(self):
+        assert_raises(ValueError, NpyFileChunkStore, self.tempdir,
+                      fsync='always')
+
+    def _count_syscalls(self, fsync, array_name):
+        """Put 8 chunks in a batch and count makedirs and fsync calls."""
+        store = NpyFileChunkStore(self.tempdir, fsync=fsync)
+        slices_list = [(slice(n, n + 1), slice(0, 60), slice(0, 2))
+                       for n in range(8)]
+        chunks = [self.big_y[s] for s in slices_list]
+        with mock.patch('os.makedirs', side_effect=os.makedirs) as makedirs, \
+                mock.patch('os.fsync', side_effect=os.fsync) as fsync_call:
+            success = store.put_chunks_noraise(array_name, slices_list, chunks)
+        assert_equal(success, 8 * [None])
+        for slices, chunk in zip(slices_list, chunks):
+            assert_array_equal(store.get_chunk(array_name, slices, chunk.dtype),
+                               chunk)
+        return makedirs.call_count, fsync_call.call_count
+
+    def test_fsync_policies(self):
+        # A single directory is created per batch and synced once per batch
+        assert_equal(self._count_syscalls(None, 'fsync_none'), (1, 0))
+        assert_equal(self._count_syscalls('chunk', 'fsync_chunk'), (1, 16))
+        assert_equal(self._count_syscalls('batch', 'fsync_batch'), (1, 9))
@@ -14,17 +14,159 @@
 # limitations under the License.
 ################################################################################
 
-"""Tests for :py:mod:`katdal.chunkstore_s3`."""
+"""Tests for :py:mod:`katdal.chunkstore_rados`."""
 
+import errno
+import threading
+from multiprocessing.pool import ThreadPool
+
+from numpy.testing import assert_array_equal
 from nose import SkipTest
-from nose.tools import assert_raises
+from nose.tools import assert_raises, assert_equal, assert_true
+import mock
 
 import katdal.chunkstore_rados
 from katdal.chunkstore_rados import RadosChunkStore, rados
-from katdal.chunkstore import StoreUnavailable
+from katdal.chunkstore import StoreUnavailable, ChunkNotFound
 from katdal.test.test_chunkstore import ChunkStoreTestBase
 
 
+class FakeRados(object):
+    """Stand-in for the parts of the rados module used by the chunk store."""
+
+    class TimedOut(Exception):
+        pass
+
+    class ObjectNotFound(Exception):
+        pass
+
+
+# Use the exceptions of the real thing if it is installed
+rados_module = rados if rados else FakeRados
+
+
+class FakeCompletion(object):
+    """Stand-in for :class:`rados.Completion`."""
+
+    def __init__(self, return_value):
+        self.return_value = return_value
+
+    def get_return_value(self):
+        return self.return_value
+
+
+class FakeIoctx(object):
+    """Stand-in for :class:`rados.Ioctx` that keeps objects in memory.
+
+    Asynchronous requests are serviced by a pool of threads, while keeping
+    track of the maximum number of requests in flight.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.in_flight = self.max_in_flight = 0
+        self.fail_writes = False
+        self._pool = ThreadPool(8)
+
+    def stat(self, key):
+        try:
+            return len(self.objects[key]), None
+        except KeyError:
+            raise rados_module.ObjectNotFound(key)
+
+    def read(self, key, length=8192, offset=0):
+        try:
+            return self.objects[key][offset:offset + length]
+        except KeyError:
+            raise rados_module.ObjectNotFound(key)
+
+    def write_full(self, key, data):
+        self.objects[key] = bytes(data)
+
+    def _start(self, operation, oncomplete, with_data):
+        """Run `operation` asynchronously and pass result to `oncomplete`."""
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        def run():
+            data = b''
+            try:
+                result = operation()
+            except rados_module.ObjectNotFound:
+                return_value = -errno.ENOENT
+            except IOError:
+                return_value = -errno.EIO
+            else:
+                return_value = len(result) if with_data else 0
+                data = result
+            with self.lock:
+                self.in_flight -= 1
+            completion = FakeCompletion(return_value)
+            if with_data:
+                oncomplete(completion, data)
+            else:
+                oncomplete(completion)
+        self._pool.apply_async(run)
+
+    def aio_read(self, key, length, offset, oncomplete):
+        self._start(lambda: self.read(key, length, offset), oncomplete, True)
+
+    def aio_write_full(self, key, data, oncomplete):
+        def write():
+            if self.fail_writes:
+                raise IOError('Disk on fire')
+            self.write_full(key, data)
+        self._start(write, oncomplete, False)
+
+
+class TestRadosChunkStoreFake(ChunkStoreTestBase):
+    """Test RADOS chunk store against an in-memory fake of librados."""
+
+    @classmethod
+    def setup_class(cls):
+        # Pretend that rados is installed if it isn't (restore it afterwards)
+        cls.patcher = mock.patch('katdal.chunkstore_rados.rados', rados_module)
+        cls.patcher.start()
+        cls.ioctx = FakeIoctx()
+        cls.store = RadosChunkStore(cls.ioctx, max_concurrency=3)
+
+    @classmethod
+    def teardown_class(cls):
+        cls.patcher.stop()
+
+    def test_in_flight_window(self):
+        slices_list = [(slice(n, n + 1), slice(0, 60), slice(0, 2))
+                       for n in range(8)]
+        chunks = [self.big_y[s] for s in slices_list]
+        self.ioctx.max_in_flight = 0
+        success = self.store.put_chunks_noraise('window', slices_list, chunks)
+        assert_equal(success, 8 * [None])
+        retrieved = self.store.get_chunks('window', slices_list,
+                                          self.big_y.dtype)
+        for chunk, chunk_retrieved in zip(chunks, retrieved):
+            assert_array_equal(chunk_retrieved, chunk)
+        assert_true(0 < self.ioctx.max_in_flight <= 3)
+
+    def test_put_chunks_errors(self):
+        slices_list = [(slice(0, 1),), (slice(0, 2),)]
+        chunks = [self.x[:1], self.x[:1]]
+        success = self.store.put_chunks_noraise('errors', slices_list, chunks)
+        assert_equal(success[0], None)
+        assert_true(isinstance(success[1], katdal.chunkstore.BadChunk))
+        self.ioctx.fail_writes = True
+        try:
+            success = self.store.put_chunks_noraise('errors', slices_list[:1],
+                                                    chunks[:1])
+        finally:
+            self.ioctx.fail_writes = False
+        assert_true(isinstance(success[0], StoreUnavailable))
+        results = self.store.get_chunks_noraise('missing', slices_list[:1],
+                                                self.x.dtype)
+        assert_true(isinstance(results[0], ChunkNotFound))
+
+
 class TestRadosChunkStore(ChunkStoreTestBase):
     """Test Ceph functionality by connecting to an actual RADOS service."""
 
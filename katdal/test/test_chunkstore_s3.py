@@ -24,14 +24,24 @@ import threading
 import Queue
 import os
 import time
+import io
+import hashlib
+import base64
+import urlparse
 
 from nose import SkipTest
-from nose.tools import assert_raises, timed
+from nose.tools import assert_raises, assert_equal, assert_true, timed
+from numpy.testing import assert_array_equal
 import mock
+import numpy as np
+import requests
 
-from katdal.chunkstore_s3 import S3ChunkStore
-from katdal.chunkstore import StoreUnavailable
+from katdal.chunkstore_s3 import (S3ChunkStore, _LatencyTracker, _BufferStream,
+                                  _HedgeScheduler)
+from katdal.chunkstore import StoreUnavailable, ChunkNotFound
+from katdal.chunk_codecs import write_chunk, read_chunk_into
 from katdal.test.test_chunkstore import ChunkStoreTestBase
+from katdal.test.s3_server import S3Server
 
 
 def consume_stderr_find_port(process, queue):
@@ -55,6 +65,99 @@ def gethostbyname_slow(host):
     return '127.0.0.1'
 
 
+def make_response(status_code):
+    """Construct a bodiless HTTP response with the given status code."""
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = b''
+    response._content_consumed = True
+    return response
+
+
+class FakeSession(object):
+    """Session that returns a canned sequence of responses to requests.
+
+    Requests to URLs starting with any of the `down` prefixes fail instead.
+    """
+    def __init__(self, status_codes=(), down=()):
+        self.status_codes = list(status_codes)
+        self.down = down
+        self.urls = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def get(self, url):
+        return self.request('GET', url)
+
+    def request(self, method, url, *args, **kwargs):
+        if any(url.startswith(prefix) for prefix in self.down):
+            raise requests.exceptions.ConnectionError('Endpoint is down')
+        self.urls.append(url)
+        return make_response(self.status_codes.pop(0)
+                             if self.status_codes else 200)
+
+
+class FakeS3Session(FakeSession):
+    """Session that stores objects in memory, including multipart uploads.
+
+    Part uploads fail with the given status code if `fail_parts` is set.
+    """
+    def __init__(self, fail_parts=None):
+        super(FakeS3Session, self).__init__()
+        self.objects = {}
+        self.uploads = {}
+        self.fail_parts = fail_parts
+        self.requests = []
+
+    def request(self, method, url, params=None, headers=None, data=None,
+                **kwargs):
+        params = params or {}
+        path = urlparse.urlparse(url).path
+        self.requests.append((method, path, sorted(params)))
+        if hasattr(data, 'read'):
+            data = data.read()
+        if 'Content-MD5' in (headers or {}):
+            md5 = base64.b64encode(hashlib.md5(data).digest())
+            if md5 != headers['Content-MD5']:
+                return make_response(400)
+        response = make_response(200)
+        if method == 'POST' and 'uploads' in params:
+            upload_id = str(len(self.uploads))
+            self.uploads[upload_id] = {}
+            response._content = (
+                '<InitiateMultipartUploadResult xmlns="{}"><UploadId>{}'
+                '</UploadId></InitiateMultipartUploadResult>'
+                .format('http://s3.amazonaws.com/doc/2006-03-01/', upload_id))
+        elif method == 'PUT' and 'partNumber' in params:
+            if self.fail_parts:
+                return make_response(self.fail_parts)
+            etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+            self.uploads[params['uploadId']][etag] = data
+            response.headers['ETag'] = etag
+        elif method == 'POST' and 'uploadId' in params:
+            parts = self.uploads.pop(params['uploadId'])
+            etags = re.findall('<ETag>(.*?)</ETag>', data)
+            self.objects[path] = b''.join(parts[etag] for etag in etags)
+            response._content = '<CompleteMultipartUploadResult/>'
+        elif method == 'DELETE' and 'uploadId' in params:
+            del self.uploads[params['uploadId']]
+        elif method == 'PUT':
+            self.objects[path] = data
+        elif path == '/':
+            # Endpoint health check
+            pass
+        elif path not in self.objects:
+            return make_response(404)
+        elif method == 'GET':
+            response._content = self.objects[path]
+            response.raw = io.BytesIO(self.objects[path])
+        return response
+
+
 class TestS3ChunkStore(ChunkStoreTestBase):
     """Test S3 functionality against an actual (fake) S3 service."""
 
@@ -123,6 +226,17 @@ class TestS3ChunkStore(ChunkStoreTestBase):
         bucket = 'katdal-unittest'
         return self.store.join(bucket, path)
 
+    def test_async_requests(self):
+        name = self.array_name('x')
+        slices = (slice(3, 5),)
+        chunk = self.x[slices]
+        self.store.put_chunk_async(name, slices, chunk).get()
+        result = self.store.get_chunk_async(name, slices, chunk.dtype)
+        assert_array_equal(result.get(), chunk)
+        result = self.store.get_chunk_async(self.array_name('haha'), slices,
+                                            chunk.dtype)
+        assert_raises(ChunkNotFound, result.get)
+
     @timed(0.1 + 0.05)
     def test_store_unavailable_invalid_url(self):
         # Ensure that timeouts work
@@ -137,3 +251,262 @@ class TestS3ChunkStore(ChunkStoreTestBase):
         assert_raises(StoreUnavailable, S3ChunkStore.from_url,
                       'http://a-valid-domain-is-somehow-harder.kat.ac.za/',
                       timeout=0.1, extra_timeout=1)
+
+
+class TestS3ChunkStoreStandIn(TestS3ChunkStore):
+    """Test S3 functionality against the in-process S3 stand-in."""
+
+    @classmethod
+    def setup_class(cls):
+        """Start S3 stand-in and ChunkStore on that."""
+        cls.server = S3Server()
+        cls.store = S3ChunkStore.from_url(cls.server.url, timeout=1)
+        # Ensure that pagination is tested
+        cls.store.list_max_keys = 3
+
+    @classmethod
+    def teardown_class(cls):
+        cls.store.close()
+        cls.server.close()
+
+    def test_range_requests(self):
+        name = self.array_name('range')
+        slices = (slice(0, 8), slice(0, 60), slice(0, 2))
+        self.store.put_chunk(name, slices, self.big_y)
+        path = self.store._chunk_path(self.store.chunk_metadata(name, slices)[0])
+        data, partial = self.store._get_range(None, path, 10, 20)
+        assert_true(partial)
+        assert_equal(data, self.server.objects['/' + path][10:20])
+        # Regions that span most of the chunk skip the header request
+        with mock.patch.object(self.store, '_get_range') as get_range:
+            region = self.store.get_chunk_region(
+                name, slices, self.big_y.dtype,
+                (slice(0, 8), slice(5, 6), slice(1, 2)))
+        assert_array_equal(region, self.big_y[slices][:, 5:6, 1:2])
+        assert_equal(get_range.call_count, 0)
+
+    def _force_hedging(self, name):
+        """Enable hedging and pretend that requests used to be instantaneous."""
+        self.store.hedge_percentile = 95.
+        latency = self.store.latency[name] = _LatencyTracker()
+        for n in range(latency.min_samples):
+            latency.add(0.)
+
+    def _stop_hedging(self, name):
+        self.store.hedge_percentile = None
+        del self.store.latency[name]
+        self.server.latency = 0.
+
+    def test_hedged_requests(self):
+        name = self.array_name('hedged')
+        slices = (slice(3, 5),)
+        chunk = self.x[slices]
+        self.store.put_chunk(name, slices, chunk)
+        # Hedging is disabled by default
+        hedges = self.store.hedges
+        self.store.get_chunk(name, slices, chunk.dtype)
+        assert_equal(self.store.hedges, hedges)
+        self._force_hedging(name)
+        self.server.latency = 0.05
+        try:
+            assert_array_equal(self.store.get_chunk(name, slices, chunk.dtype),
+                               chunk)
+            assert_equal(self.store.hedges, hedges + 1)
+            out = np.empty_like(chunk)
+            self.store.get_chunk_into(name, slices, chunk.dtype, out)
+            assert_array_equal(out, chunk)
+            assert_equal(self.store.hedges, hedges + 2)
+            assert_raises(ChunkNotFound, self.store.get_chunk,
+                          name, (slice(0, 2),), chunk.dtype)
+        finally:
+            self._stop_hedging(name)
+
+    def test_hedged_request_wins(self):
+        name = self.array_name('hedged')
+        slices = (slice(3, 5),)
+        chunk = self.x[slices]
+        self.store.put_chunk(name, slices, chunk)
+        caller = threading.current_thread()
+
+        def slow_original(data, out, *args):
+            """Original request stalls and would then produce garbage."""
+            if threading.current_thread() is caller:
+                time.sleep(0.2)
+                out[()] = 0
+            else:
+                read_chunk_into(data, out, *args)
+
+        self._force_hedging(name)
+        try:
+            with mock.patch('katdal.chunkstore_s3.read_chunk_into',
+                            side_effect=slow_original):
+                assert_array_equal(self.store.get_chunk(name, slices,
+                                                        chunk.dtype), chunk)
+        finally:
+            self._stop_hedging(name)
+
+
+class TestHedgeScheduler(object):
+    """Test the single thread that starts duplicate requests."""
+
+    def setup(self):
+        self.scheduler = _HedgeScheduler()
+        self.calls = Queue.Queue()
+
+    def teardown(self):
+        self.scheduler.close()
+
+    def test_order_and_cancel(self):
+        self.scheduler.schedule(0.06, lambda: self.calls.put('late'))
+        cancelled = self.scheduler.schedule(0.02,
+                                            lambda: self.calls.put('never'))
+        self.scheduler.schedule(0.04, lambda: self.calls.put('early'))
+        self.scheduler.cancel(cancelled)
+        threads = threading.active_count()
+        assert_equal(self.calls.get(timeout=1), 'early')
+        assert_equal(self.calls.get(timeout=1), 'late')
+        assert_true(self.calls.empty())
+        # More requests do not need more threads
+        self.scheduler.schedule(0., lambda: self.calls.put('now'))
+        assert_equal(self.calls.get(timeout=1), 'now')
+        assert_equal(threading.active_count(), threads)
+
+    def test_close(self):
+        self.scheduler.schedule(10., lambda: self.calls.put('dropped'))
+        self.scheduler.close()
+        # The scheduler restarts on demand
+        self.scheduler.schedule(0., lambda: self.calls.put('restarted'))
+        assert_equal(self.calls.get(timeout=1), 'restarted')
+
+
+class TestS3Retries(object):
+    """Test retries, latency tracking and endpoints without an S3 service."""
+
+    def store(self, status_codes, **kwargs):
+        session = FakeSession([200] + status_codes)
+        return S3ChunkStore(lambda: session, 'http://s3.invalid/',
+                            backoff_factor=0.001, **kwargs)
+
+    def test_retry_transient_errors(self):
+        store = self.store([503, 500, 200])
+        assert_true(store.has_chunk('bucket/x', (slice(0, 1),), float))
+        assert_equal(store.retries, 2)
+
+    def test_give_up_retrying(self):
+        store = self.store([503, 503, 503], max_retries=1)
+        assert_raises(StoreUnavailable, store.has_chunk,
+                      'bucket/x', (slice(0, 1),), float)
+        assert_equal(store.retries, 1)
+
+    def test_no_retry_of_client_errors(self):
+        store = self.store([404, 200])
+        assert_true(not store.has_chunk('bucket/x', (slice(0, 1),), float))
+        assert_equal(store.retries, 0)
+
+    def test_latency_percentile(self):
+        latency = _LatencyTracker(window=100, min_samples=10)
+        for n in range(9):
+            latency.add(0.01 * n)
+        assert_equal(latency.percentile(95), None)
+        for n in range(9, 200):
+            latency.add(0.01 * n)
+        assert_equal(len(latency), 100)
+        assert_true(1.9 < latency.percentile(95) < 2.)
+
+    def test_endpoint_routing(self):
+        urls = ['http://a.invalid/', 'http://b.invalid/', 'http://c.invalid/']
+        session = FakeSession(down=['http://c.invalid/'])
+        store = S3ChunkStore(lambda: session, urls)
+        assert_equal(store.max_concurrency, 3 * S3ChunkStore.max_concurrency)
+        assert_equal(store.urls, urls)
+        session.urls = []
+        for n in range(20):
+            store.has_chunk('bucket/x', (slice(0, 1),), float)
+        # Requests are spread over the healthy endpoints only
+        hosts = set(url[:len(urls[0])] for url in session.urls)
+        assert_equal(hosts, set(urls[:2]))
+        assert_equal(store.check_endpoints(), [True, True, False])
+        # All endpoints down
+        session.down = urls
+        assert_equal(store.check_endpoints(), [False, False, False])
+        assert_raises(StoreUnavailable, store.has_chunk,
+                      'bucket/x', (slice(0, 1),), float)
+        assert_raises(StoreUnavailable, S3ChunkStore, lambda: session, urls)
+
+    def test_failed_endpoint_avoided(self):
+        urls = ['http://a.invalid/', 'http://b.invalid/']
+        session = FakeSession()
+        store = S3ChunkStore(lambda: session, urls, backoff_factor=0.001)
+        session.down = ['http://a.invalid/']
+        # Requests to the failed endpoint are retried on the other one
+        for n in range(20):
+            assert_true(store.has_chunk('bucket/x', (slice(0, 1),), float))
+        assert_true(store.retries <= 1)
+        assert_equal(store.check_endpoints(), [False, True])
+
+
+class TestS3Uploads(object):
+    """Test streaming and multipart uploads without an S3 service."""
+
+    def setup(self):
+        self.session = FakeS3Session()
+        self.store = S3ChunkStore(lambda: self.session, 'http://s3.invalid/',
+                                  backoff_factor=0.001, max_retries=1,
+                                  hedge_percentile=None)
+        self.store.multipart_threshold = 1000
+        self.store.multipart_part_size = 300
+        self.chunk = np.arange(200.).reshape(20, 10)
+
+    def stored_object(self, array_name, slices, chunk, **kwargs):
+        """Put chunk and check stored object against standard serialisation."""
+        self.store.put_chunk(array_name, slices, chunk, **kwargs)
+        fp = io.BytesIO()
+        write_chunk(fp, chunk, **kwargs)
+        path = '/' + self.store.chunk_metadata(array_name, slices)[0] + '.npy'
+        assert_equal(self.session.objects[path], fp.getvalue())
+        assert_array_equal(self.store.get_chunk(array_name, slices,
+                                                chunk.dtype), chunk)
+
+    def test_buffer_stream(self):
+        stream = _BufferStream([b'abc', b'', np.arange(4, dtype=np.uint8)])
+        assert_equal(len(stream), 7)
+        assert_equal(stream.read(2), b'ab')
+        assert_equal(stream.read(), b'c\x00\x01\x02\x03')
+        assert_equal(stream.read(), b'')
+        stream.seek(0)
+        assert_equal(stream.read(4), b'abc\x00')
+        assert_equal(stream.byte_range(2, 5).read(), b'c\x00\x01')
+        assert_equal(stream.md5(),
+                     base64.b64encode(hashlib.md5(b'abc\x00\x01\x02\x03')
+                                      .digest()))
+
+    def test_single_put(self):
+        small = self.chunk[:2]
+        self.stored_object('bucket/small', (slice(0, 2), slice(0, 10)), small)
+        self.stored_object('bucket/small_f', (slice(0, 10), slice(0, 2)),
+                           np.asfortranarray(small.T))
+        methods = [request[0] for request in self.session.requests]
+        assert_equal(methods.count('POST'), 0)
+
+    def test_multipart_put(self):
+        slices = (slice(0, 20), slice(0, 10))
+        self.stored_object('bucket/big', slices, self.chunk)
+        # The 1600 bytes of data and NPY header need 6 parts of 300 bytes
+        part_puts = [request for request in self.session.requests
+                     if request[0] == 'PUT' and 'partNumber' in request[2]]
+        assert_equal(len(part_puts), 6)
+        assert_equal(self.session.uploads, {})
+        # Compressed chunks (and non-contiguous chunks) work too
+        self.stored_object('bucket/big_zlib', slices, self.chunk[:, ::-1],
+                           codec='shuffle+zlib')
+
+    def test_failed_multipart_put(self):
+        self.session.fail_parts = 503
+        slices = (slice(0, 20), slice(0, 10))
+        assert_raises(StoreUnavailable, self.store.put_chunk,
+                      'bucket/big', slices, self.chunk)
+        # The upload was aborted
+        assert_equal(self.session.uploads, {})
+        assert_equal(self.session.requests[-1][0], 'DELETE')
+        assert_raises(ChunkNotFound, self.store.get_chunk,
+                      'bucket/big', slices, self.chunk.dtype)
@@ -0,0 +1,129 @@
+################################################################################
+# Copyright (c) 2017-2018, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Tests for :py:mod:`katdal.chunkstore_stats`."""
+
+import tempfile
+import shutil
+
+import numpy as np
+from nose.tools import assert_equal, assert_true, assert_raises, assert_in
+
+from katdal.chunkstore import ChunkNotFound
+from katdal.chunkstore_dict import DictChunkStore
+from katdal.chunkstore_cache import CachingChunkStore
+from katdal.chunkstore_npy import NpyFileChunkStore
+from katdal.chunkstore_stats import ChunkStoreStats, collect_stats
+
+
+class TestChunkStoreStats(object):
+    def setup(self):
+        self.x = np.arange(100.)
+        self.store = DictChunkStore(x=self.x)
+        self.slices = (slice(10, 20),)
+
+    def test_collect_stats(self):
+        with collect_stats(self.store) as stats:
+            self.store.get_chunk('x', self.slices, self.x.dtype)
+            # This calls get_chunk internally but only counts once
+            out = np.empty(10)
+            self.store.get_chunk_into('x', self.slices, self.x.dtype, out)
+            self.store.put_chunk('x', self.slices, out)
+            assert_raises(ChunkNotFound, self.store.get_chunk, 'y',
+                          self.slices, self.x.dtype)
+            assert_true(not self.store.has_chunk('y', self.slices,
+                                                 self.x.dtype))
+        assert_equal(self.store.stats, None)
+        ops = stats.to_dict()['stores']['DictChunkStore']['operations']
+        assert_equal(ops['get']['requests'], 3)
+        assert_equal(ops['get']['bytes'], 160)
+        assert_equal(ops['get']['errors'], {'ChunkNotFound': 1})
+        assert_equal(sum(n for bound, n in ops['get']['latency_histogram']), 3)
+        assert_equal(ops['put']['bytes'], 80)
+        assert_equal(ops['has'], {'requests': 1, 'bytes': 0, 'errors': {},
+                                  'latency': ops['has']['latency'],
+                                  'latency_histogram':
+                                      ops['has']['latency_histogram']})
+        # Nothing is recorded outside the block
+        self.store.get_chunk('x', self.slices, self.x.dtype)
+        assert_equal(stats.requests[('DictChunkStore', 'get')], 3)
+
+    def test_cache_events(self):
+        cache = CachingChunkStore(self.store)
+        with collect_stats(cache, self.store) as stats:
+            for n in range(3):
+                cache.get_chunk('x', self.slices, self.x.dtype)
+        stores = stats.to_dict()['stores']
+        assert_equal(stores['CachingChunkStore']['events'],
+                     {'cache_hits': 2, 'cache_misses': 1})
+        assert_equal(stores['CachingChunkStore']['operations']['get']
+                     ['requests'], 3)
+        assert_equal(stores['DictChunkStore']['operations']['get']
+                     ['requests'], 1)
+
+    def test_region_bytes(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            npy_store = NpyFileChunkStore(tempdir)
+            y = np.arange(10000.).reshape(100, 100)
+            slices = (slice(0, 100), slice(0, 100))
+            npy_store.put_chunk('y', slices, y)
+            with collect_stats(self.store, npy_store) as stats:
+                # The base implementation retrieves the full chunk
+                self.store.get_chunk_region('x', self.slices, self.x.dtype,
+                                            (slice(0, 2),))
+                # A partial read only retrieves the byte range of the region
+                npy_store.get_chunk_region('y', slices, y.dtype,
+                                           (slice(10, 12), slice(0, 50)))
+                # A region spanning most of the chunk needs all of it
+                npy_store.get_chunk_region('y', slices, y.dtype,
+                                           (slice(0, 100), slice(0, 50)))
+        finally:
+            shutil.rmtree(tempdir)
+        stores = stats.to_dict()['stores']
+        assert_equal(stores['DictChunkStore']['operations']['get']['bytes'],
+                     80)
+        assert_equal(stores['NpyFileChunkStore']['operations']['get']
+                     ['bytes'], 150 * 8 + 10000 * 8)
+
+    def test_prometheus(self):
+        stats = ChunkStoreStats()
+        stats.record('S3ChunkStore', 'get', 0.02, 1000)
+        stats.record('S3ChunkStore', 'get', 20., error=ChunkNotFound())
+        stats.increment('S3ChunkStore', 'retries', 2)
+        stats.stop()
+        text = stats.to_prometheus()
+        for line in [
+                '# TYPE katdal_chunkstore_requests_total counter',
+                'katdal_chunkstore_requests_total{store="S3ChunkStore",'
+                'op="get"} 2',
+                'katdal_chunkstore_bytes_total{store="S3ChunkStore",'
+                'op="get"} 1000',
+                'katdal_chunkstore_errors_total{store="S3ChunkStore",'
+                'op="get",error="ChunkNotFound"} 1',
+                'katdal_chunkstore_events_total{store="S3ChunkStore",'
+                'event="retries"} 2',
+                'katdal_chunkstore_latency_seconds_bucket{store="S3ChunkStore",'
+                'op="get",le="0.025"} 1',
+                'katdal_chunkstore_latency_seconds_bucket{store="S3ChunkStore",'
+                'op="get",le="10.0"} 1',
+                'katdal_chunkstore_latency_seconds_bucket{store="S3ChunkStore",'
+                'op="get",le="+Inf"} 2',
+                'katdal_chunkstore_latency_seconds_count{store="S3ChunkStore",'
+                'op="get"} 2']:
+            assert_in(line, text.splitlines())
+        stats.reset()
+        assert_equal(stats.to_dict()['stores'], {})
@@ -20,15 +20,20 @@ import tempfile
 import shutil
 import os
 import random
+import urlparse
 
 import numpy as np
 from numpy.testing import assert_array_equal
-from nose.tools import assert_equal
+from nose.tools import assert_equal, assert_true, assert_raises
 import dask.array as da
+import mock
 
 from katdal.chunkstore import generate_chunks
 from katdal.chunkstore_npy import NpyFileChunkStore
-from katdal.datasources import ChunkStoreVisFlagsWeights
+from katdal.chunkstore_s3 import S3ChunkStore
+from katdal.datasources import (ChunkStoreVisFlagsWeights, TelstateDataSource,
+                                put_flag_planes, _infer_chunk_store)
+from katdal.synthetic import make_dataset
 
 
 def ramp(shape, offset=1.0, slope=1.0, dtype=np.float_):
@@ -49,16 +54,22 @@ def to_dask_array(x):
     return da.from_array(x, chunks)
 
 
-def put_fake_dataset(store, base_name, shape):
+def put_fake_dataset(store, base_name, shape, manifest=False):
     """Write a fake dataset into the chunk store."""
     data = {'correlator_data': ramp(shape, dtype=np.float32) * (1 - 1j),
             'flags': np.ones(shape, dtype=np.uint8),
             'weights': ramp(shape, slope=255. / np.prod(shape), dtype=np.uint8),
             'weights_channel': ramp(shape[:-1], dtype=np.float32)}
+    # Compress the highly compressible flags and weights
+    codecs = {'flags': 'zlib', 'weights': 'shuffle+zlib'}
     ddata = {k: to_dask_array(array) for k, array in data.items()}
     chunk_info = {k: {'chunks': darray.chunks, 'dtype': darray.dtype,
                       'shape': darray.shape} for k, darray in ddata.items()}
-    push = [store.put_dask_array(store.join(base_name, k), darray)
+    for k, codec in codecs.items():
+        chunk_info[k]['codec'] = codec
+    push = [store.put_dask_array(store.join(base_name, k), darray,
+                                 manifest=manifest,
+                                 codec=chunk_info[k].get('codec'))
             for k, darray in ddata.items()]
     da.compute(*push)
     return data, chunk_info
@@ -90,9 +101,147 @@ class TestChunkStoreVisFlagsWeights(object):
         assert_array_equal(vfw.weights.compute(), weights)
 
     def test_missing_chunks(self):
+        self._test_missing_chunks('cb2', fused=False)
+
+    def test_lazy_missing_chunk_detection(self):
+        store = NpyFileChunkStore(self.tempdir)
+        base_name = 'cb5'
+        shape = (10, 64, 30)
+        data, chunk_info = put_fake_dataset(store, base_name, shape)
+        with mock.patch.object(store, 'has_chunk',
+                               wraps=store.has_chunk) as has_chunk, \
+                mock.patch.object(store, 'list_chunk_ids',
+                                  wraps=store.list_chunk_ids) as list_chunk_ids:
+            vfw = ChunkStoreVisFlagsWeights(store, base_name, chunk_info)
+            # Opening the dataset does not check for any chunks
+            assert_equal(list_chunk_ids.call_count, 0)
+            # The vis / weights arrays are only listed when flags are needed
+            # (flags chunks report their own absence as they get loaded)
+            assert_array_equal(vfw.flags[3, 4:8].compute(),
+                               data['flags'][3, 4:8])
+            calls = list_chunk_ids.call_count
+            assert_true(0 < calls <= 3 * store.max_concurrency)
+            # Each array is listed once, instead of checking each chunk
+            assert_array_equal(vfw.flags.compute(), data['flags'])
+            assert_equal(list_chunk_ids.call_count, calls)
+            assert_equal(has_chunk.call_count, 0)
+
+    def test_missing_chunks_without_listing(self):
+        store = NpyFileChunkStore(self.tempdir)
+        base_name = 'cb9'
+        shape = (10, 64, 30)
+        data, chunk_info = put_fake_dataset(store, base_name, shape)
+        # The uint8 weights have 32 channels per chunk
+        missing = (slice(2, 3), slice(0, 32), slice(0, 30))
+        chunk_name, _ = store.chunk_metadata('cb9/weights', missing)
+        os.remove(os.path.join(store.path, chunk_name) + '.npy')
+        # Stores that cannot list chunks are asked about each chunk instead
+        with mock.patch.object(store, 'has_chunk',
+                               wraps=store.has_chunk) as has_chunk, \
+                mock.patch.object(store, 'list_chunk_ids',
+                                  side_effect=NotImplementedError):
+            vfw = ChunkStoreVisFlagsWeights(store, base_name, chunk_info)
+            flags = data['flags']
+            flags[missing] |= 8
+            assert_array_equal(vfw.flags[2:4].compute(), flags[2:4])
+            # Two dumps of 16 vis, 2 weights and 1 weights_channel chunks
+            assert_equal(has_chunk.call_count, 2 * (16 + 2 + 1))
+
+    def test_manifest(self):
+        store = NpyFileChunkStore(self.tempdir)
+        base_name = 'cb6'
+        shape = (10, 64, 30)
+        data, chunk_info = put_fake_dataset(store, base_name, shape,
+                                            manifest=True)
+        # Pretend that a vis chunk failed to be written
+        array_name = store.join(base_name, 'correlator_data')
+        chunks = chunk_info['correlator_data']['chunks']
+        manifest = store.get_manifest(array_name, chunks)
+        manifest['present'][2, 3, 0] = False
+        manifest_slices = tuple(slice(0, len(c)) for c in chunks)
+        store.put_chunk(store.join(array_name, 'manifest'), manifest_slices,
+                        manifest)
+        with mock.patch.object(store, 'has_chunk') as has_chunk:
+            vfw = ChunkStoreVisFlagsWeights(store, base_name, chunk_info)
+            flags = data['flags']
+            flags[2, 12:16] |= 8
+            assert_array_equal(vfw.flags.compute(), flags)
+            # The manifests replace the checks on individual chunks
+            assert_equal(has_chunk.call_count, 0)
+
+    def test_masked_flags(self):
+        store = NpyFileChunkStore(self.tempdir)
+        base_name = 'cb7'
+        shape = (10, 64, 30)
+        data, chunk_info = put_fake_dataset(store, base_name, shape)
+        vfw = ChunkStoreVisFlagsWeights(store, base_name, chunk_info)
+        assert_array_equal(vfw.masked_flags(0x01), data['flags'])
+        assert_array_equal(vfw.masked_flags(0xfe), 0)
+        assert_true(vfw.masked_flags(0xff) is vfw.flags)
+
+    def test_flag_bit_planes(self):
+        store = NpyFileChunkStore(self.tempdir)
+        base_name = 'cb8'
+        shape = (10, 64, 30)
+        data, chunk_info = put_fake_dataset(store, base_name, shape)
+        # Replace flags by bit planes, with a few types of flags set
+        rs = np.random.RandomState(8)
+        flags = np.zeros(shape, np.uint8)
+        for bit in (1, 4, 6):
+            flags |= (rs.random_sample(shape) < 0.1).astype(np.uint8) << bit
+        info = chunk_info['flags']
+        dask_flags = da.from_array(flags, info['chunks'])
+        push = put_flag_planes(store, store.join(base_name, 'flags'),
+                               dask_flags, codec='zlib')
+        assert_array_equal(push.compute(), None)
+        info['bit_planes'] = range(8)
+        vfw = ChunkStoreVisFlagsWeights(store, base_name, chunk_info)
+        assert_array_equal(vfw.flags.compute(), flags)
+        with mock.patch.object(store, 'get_chunk',
+                               wraps=store.get_chunk) as get_chunk:
+            # Select 'cal_rfi' and 'data_lost', which loads 2 planes per chunk
+            cal_rfi_and_data_lost = 0x48
+            masked_flags = vfw.masked_flags(cal_rfi_and_data_lost)
+            assert_array_equal(masked_flags.compute(),
+                               flags & cal_rfi_and_data_lost)
+            plane_names = set(call[0][0] for call in get_chunk.call_args_list)
+            assert_equal(plane_names, {'cb8/flags/bit3', 'cb8/flags/bit6'})
+            num_chunks = np.prod([len(c) for c in info['chunks']])
+            assert_equal(get_chunk.call_count, 2 * num_chunks)
+        # The fused loader assembles flags from all bit planes too
+        vfw = ChunkStoreVisFlagsWeights(store, base_name, chunk_info,
+                                        fused=True)
+        assert_array_equal(vfw.flags.compute(), flags)
+        assert_array_equal(vfw.masked_flags(0x10).compute(), flags & 0x10)
+        # Missing planes are reported as lost data
+        missing = (slice(2, 3), slice(0, 32), slice(0, 30))
+        chunk_name, _ = store.chunk_metadata('cb8/flags/bit4', missing)
+        os.remove(os.path.join(store.path, chunk_name) + '.npy')
+        vfw = ChunkStoreVisFlagsWeights(store, base_name, chunk_info)
+        flags[2, :32] = 8
+        assert_array_equal(vfw.flags.compute(), flags)
+
+    def test_fused(self):
+        store = NpyFileChunkStore(self.tempdir)
+        base_name = 'cb3'
+        shape = (10, 64, 30)
+        data, chunk_info = put_fake_dataset(store, base_name, shape)
+        vfw = ChunkStoreVisFlagsWeights(store, base_name, chunk_info,
+                                        fused=True)
+        weights = data['weights'] * data['weights_channel'][..., np.newaxis]
+        vis, flags, weights_retrieved = da.compute(vfw.vis, vfw.flags,
+                                                   vfw.weights)
+        assert_array_equal(vis, data['correlator_data'])
+        assert_array_equal(flags, data['flags'])
+        assert_array_equal(weights_retrieved, weights)
+        assert_equal(weights_retrieved.dtype, vfw.weights.dtype)
+        # Vis, flags and weights of each chunk are all loaded by a single task
+        assert_equal(len(vfw.vis.dask), 4 * np.prod(vfw.vis.numblocks))
+        self._test_missing_chunks('cb4', fused=True)
+
+    def _test_missing_chunks(self, base_name, fused):
         # Put fake dataset into chunk store
         store = NpyFileChunkStore(self.tempdir)
-        base_name = 'cb2'
         shape = (10, 64, 30)
         data, chunk_info = put_fake_dataset(store, base_name, shape)
         # Delete a random chunk in each array of the dataset
@@ -105,7 +254,7 @@ class TestChunkStoreVisFlagsWeights(object):
             missing_chunks[array] = culled_slice
             chunk_name, shape = store.chunk_metadata(array_name, culled_slice)
             os.remove(os.path.join(store.path, chunk_name) + '.npy')
-        vfw = ChunkStoreVisFlagsWeights(store, base_name, chunk_info)
+        vfw = ChunkStoreVisFlagsWeights(store, base_name, chunk_info, fused)
         # Check that (only) missing chunks have been replaced by zeros
         vis = data['correlator_data']
         vis[missing_chunks['correlator_data']] = 0.
@@ -122,3 +271,57 @@ class TestChunkStoreVisFlagsWeights(object):
         flags[missing_chunks['weights_channel']] |= 8
         flags[missing_chunks['flags']] |= 8
         assert_array_equal(vfw.flags, flags)
+
+
+class TestInferChunkStore(object):
+    """Construct an S3 chunk store from options in a dataset URL."""
+
+    def test_s3_options(self):
+        url_parts = urlparse.urlparse('redis://localhost:6379')
+        telstate = {'s3_endpoint_url': 'http://a.invalid/'}
+        with mock.patch.object(S3ChunkStore, 'from_url') as from_url:
+            # Options from URL query strings are strings
+            _infer_chunk_store(url_parts, telstate, timeout='5',
+                               max_retries='2', hedge_percentile='99',
+                               health_check_interval=10., fused=True)
+            from_url.assert_called_once_with(
+                'http://a.invalid/', timeout=5., max_retries=2,
+                hedge_percentile=99., health_check_interval=10.)
+            from_url.reset_mock()
+            _infer_chunk_store(url_parts, telstate,
+                               s3_endpoint_url='http://b.invalid/,'
+                                               'http://c.invalid/',
+                               backoff_factor=0.5, backoff_max='2')
+            from_url.assert_called_once_with(
+                ['http://b.invalid/', 'http://c.invalid/'],
+                backoff_factor=0.5, backoff_max=2.)
+
+
+class TestTelstateDataSource(object):
+    """Open a small synthetic dataset via its URL."""
+
+    @classmethod
+    def setup_class(cls):
+        cls.tempdir = tempfile.mkdtemp()
+        store = NpyFileChunkStore(cls.tempdir)
+        os.mkdir(os.path.join(cls.tempdir, '1500000000'))
+        cls.rdb_filename = os.path.join(cls.tempdir, '1500000000',
+                                        '1500000000_sdp_l0.rdb')
+        make_dataset(store, cls.rdb_filename, n_dumps=4, n_chans=16,
+                     n_ants=2, chunk_size=2 ** 10, scan_dumps=2)
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tempdir)
+
+    def test_fused_option(self):
+        for query, fused in [('', False), ('?fused=0', False),
+                             ('?fused=False', False), ('?fused=1', True),
+                             ('?fused=TRUE', True)]:
+            source = TelstateDataSource.from_url(self.rdb_filename + query)
+            assert_equal(source.data._fused, fused)
+        # Keyword arguments can be proper booleans
+        source = TelstateDataSource.from_url(self.rdb_filename, fused=True)
+        assert_true(source.data._fused)
+        assert_raises(ValueError, TelstateDataSource.from_url,
+                      self.rdb_filename + '?fused=maybe')
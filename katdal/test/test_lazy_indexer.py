@@ -18,10 +18,13 @@
 
 import numpy as np
 import dask.array as da
+import mock
 
-from nose.tools import assert_raises
+from nose.tools import assert_raises, assert_equal
 
-from katdal.lazy_indexer import _simplify_index, DaskLazyIndexer
+from katdal.lazy_indexer import (_simplify_index, _prune_chunks,
+                                 _selected_nbytes, DaskLazyIndexer)
+from katdal.chunkstore_dict import DictChunkStore
 
 
 class TestSimplifyIndices(object):
@@ -87,3 +90,63 @@ class TestDaskLazyIndexer(object):
         stage1 = tuple([True] * d for d in self.data.shape)
         indexer = DaskLazyIndexer(self.data_dask, stage1)
         np.testing.assert_array_equal(indexer[:], self.data)
+
+    def test_stage1_pruned_chunks(self):
+        # Select elements in 2 of the 5 chunks along axis 1 (size 4)
+        freqs = np.zeros(20, dtype=np.bool_)
+        freqs[[1, 3, 13]] = True
+        # Select elements in chunks 0, 2 and 3 along axis 2 (size 5)
+        corrprods = np.zeros(30, dtype=np.bool_)
+        corrprods[[2, 10, 16, 18]] = True
+        stage1 = (slice(2, 4), freqs, corrprods)
+        pruned, keep = _prune_chunks(self.data_dask, stage1)
+        assert_equal(pruned.chunks, ((1,) * 10, (4, 4), (5, 5, 5)))
+        np.testing.assert_array_equal(
+            pruned.compute()[keep[0]][:, keep[1]][:, :, keep[2]],
+            self.data[2:4][:, freqs][:, :, corrprods])
+        assert_equal(_selected_nbytes(pruned, keep),
+                     2 * 8 * 15 * self.data.dtype.itemsize)
+        # A mask spanning consecutive chunks becomes a slice after pruning
+        freqs = np.zeros(20, dtype=np.bool_)
+        freqs[[6, 7, 12, 13]] = True
+        pruned, keep = _prune_chunks(self.data_dask, (slice(None), freqs))
+        assert_equal(pruned.chunks[1], (4, 4))
+        assert_equal(keep[1], slice(2, 6))
+        indexer = DaskLazyIndexer(self.data_dask, stage1)
+        np.testing.assert_array_equal(indexer[:], self.data[stage1[0]]
+                                      [:, stage1[1]][:, :, stage1[2]])
+
+    def test_chunk_store_into_output(self):
+        store = DictChunkStore(data=self.data)
+        dataset = store.get_dask_array('data', self.data_dask.chunks,
+                                       self.data.dtype)
+        stage1 = np.s_[2:6, :, 5:25]
+        indexer = DaskLazyIndexer(dataset, stage1)
+        with mock.patch.object(store, 'get_chunk_into',
+                               wraps=store.get_chunk_into) as get_into, \
+                mock.patch.object(store, 'get_chunk',
+                                  wraps=store.get_chunk) as get:
+            np.testing.assert_array_equal(indexer[:], self.data[stage1])
+            # Chunk-aligned selection is decoded straight into the output
+            assert_equal(get_into.call_count, 4 * 5 * 4)
+            # ... and each chunk is only retrieved once (via get_chunk_into)
+            assert_equal(get.call_count, 4 * 5 * 4)
+            get_into.reset_mock()
+            # Partially selected chunks are copied instead
+            np.testing.assert_array_equal(indexer[:, 1:, 2:],
+                                          self.data[stage1][:, 1:, 2:])
+            assert_equal(get_into.call_count, 4 * 4 * 3)
+            get_into.reset_mock()
+            # Transforms result in ordinary computation of the dask array
+            indexer = DaskLazyIndexer(dataset, stage1, [lambda x: x + 1])
+            np.testing.assert_array_equal(indexer[:], self.data[stage1] + 1)
+            assert_equal(get_into.call_count, 0)
+        # Small parts of chunks are requested from the store as such
+        indexer = DaskLazyIndexer(dataset, stage1)
+        with mock.patch.object(store, 'get_chunk_region',
+                               wraps=store.get_chunk_region) as get_region:
+            np.testing.assert_array_equal(indexer[1:3, 5:6, 7:8],
+                                          self.data[stage1][1:3, 5:6, 7:8])
+            assert_equal(get_region.call_count, 2)
+            assert_equal(get_region.call_args[0][3],
+                         (slice(0, 1), slice(1, 2), slice(2, 3)))
@@ -0,0 +1,84 @@
+################################################################################
+# Copyright (c) 2018, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Tests for :py:mod:`katdal.synthetic`."""
+
+import tempfile
+import shutil
+import os
+
+import numpy as np
+from numpy.testing import assert_array_equal, assert_allclose
+from nose.tools import assert_equal
+
+import katdal
+from katdal.chunkstore_npy import NpyFileChunkStore
+from katdal.synthetic import make_dataset
+
+
+class TestMakeDataset(object):
+    """Generate a small dataset in a temporary NPY chunk store and open it."""
+
+    @classmethod
+    def setup_class(cls):
+        cls.tempdir = tempfile.mkdtemp()
+        store = NpyFileChunkStore(cls.tempdir)
+        # Place RDB file next to chunks so that katdal.open finds them
+        os.mkdir(os.path.join(cls.tempdir, '1500000000'))
+        cls.rdb_filename = os.path.join(cls.tempdir, '1500000000',
+                                        '1500000000_sdp_l0.rdb')
+        cls.telstate = make_dataset(store, cls.rdb_filename, n_dumps=20,
+                                    n_chans=64, n_ants=3, chunk_size=2 ** 12,
+                                    scan_dumps=5, codecs={'flags': 'zlib'})
+        cls.data = katdal.open(cls.rdb_filename)
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tempdir)
+
+    def test_shape_and_chunks(self):
+        assert_equal(self.data.shape, (20, 64, 24))
+        chunk_info = self.telstate['1500000000_sdp_l0_chunk_info']
+        vis_chunks = chunk_info['correlator_data']['chunks']
+        assert max(vis_chunks[0]) * max(vis_chunks[1]) * 24 * 8 <= 2 ** 12
+        assert_equal(chunk_info['flags']['codec'], 'zlib')
+        assert_equal(self.telstate['1500000000_sdp_l0_chunk_name'],
+                     '1500000000-sdp-l0')
+
+    def test_scans(self):
+        scans = [(state, target.name) for _, state, target in self.data.scans()]
+        expected = [(state, 'source{}'.format(n))
+                    for n in range(4) for state in ('slew', 'track')]
+        assert_equal(scans, expected)
+        slew_dumps = np.flatnonzero(self.data.sensor['Observation/scan_state']
+                                    == 'slew')
+        assert_array_equal(slew_dumps, [0, 5, 10, 15])
+
+    def test_flags(self):
+        flagged_dumps = np.flatnonzero(self.data.flags[:].any(axis=(1, 2)))
+        assert_array_equal(flagged_dumps, [0, 5, 10, 15])
+        assert_equal(self.data.flags[:, :, :].sum(), 4 * 64 * 24)
+
+    def test_vis(self):
+        vis = self.data.vis[:]
+        weights = self.data.weights[:]
+        assert_array_equal(weights, weights[0, 0, 0])
+        auto = self.data.corr_products[:, 0] == self.data.corr_products[:, 1]
+        assert_array_equal(vis[:, :, auto].imag, 0)
+        assert np.all(vis[:, :, auto].real > 0)
+        # The visibilities are the outer product of time and frequency factors
+        reference = vis[0] / vis[0, 0]
+        assert_allclose(vis, vis[:, :1] * reference, rtol=1e-4, atol=1e-6)
@@ -20,7 +20,6 @@ import logging
 
 import numpy as np
 import katpoint
-import dask.array as da
 
 from .dataset import (DataSet, BrokenFile, Subarray, SpectralWindow,
                       DEFAULT_SENSOR_PROPS, DEFAULT_VIRTUAL_SENSORS,
@@ -359,13 +358,12 @@ class VisibilityDataV4(DataSet):
                 # Cache dask graphs for the data fields
                 self._vis = DaskLazyIndexer(self.source.data.vis, stage1)
                 self._weights = DaskLazyIndexer(self.source.data.weights, stage1)
-            flag_transforms = []
+            flags = self.source.data.flags
             if ~self._flags_select != 0:
-                # Copy so that the lambda isn't affected by future changes
-                select = self._flags_select.copy()
-                flag_transforms.append(lambda flags: da.bitwise_and(select, flags))
-            flag_transforms.append(lambda flags: flags.view(np.bool_))
-            self._flags = DaskLazyIndexer(self.source.data.flags, stage1, flag_transforms)
+                # Let the data source only load the selected flag types
+                flags = self.source.data.masked_flags(self._flags_select[0])
+            flag_transforms = [lambda flags: flags.view(np.bool_)]
+            self._flags = DaskLazyIndexer(flags, stage1, flag_transforms)
 
     @property
     def timestamps(self):
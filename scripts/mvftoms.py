@@ -242,7 +242,7 @@ def main():
     # Open dataset
     open_args = args[0] if len(args) == 1 else args
     # katdal can handle a list of files, which get virtually concatenated internally
-    dataset = katdal.open(open_args, ref_ant=options.ref_ant)
+    dataset = katdal.open(open_args, ref_ant=options.ref_ant, fused=True)
 
     # Get list of unique polarisation products in the file
     pols_in_file = np.unique([(cp[0][-1] + cp[1][-1]).upper() for cp in dataset.corr_products])